@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Time-to-first-command benchmark for app commands, with and without `ras <app> up`.
+
+Cases:
+    cold run        `docker run --rm ...` sourcing env.sh, what `ras <app> run` does
+    up + env.sh     `docker exec` into the up container, still sourcing env.sh
+    up + snapshot   `docker exec` sourcing the pre-sourced environment, what
+                    run/dev/build do while the app is up
+
+Needs docker and a built app image, and the app must not be running. The up
+container started for the benchmark is stopped at the end.
+
+Usage:
+    python3 scripts/benchmarks/first_command.py robot [--runs N] [--command CMD]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+SCRIPTS_PATH = Path(__file__).absolute().parent.parent
+sys.path.insert(0, str(SCRIPTS_PATH))
+os.environ.setdefault("RAS_DOCKER_PATH", str(SCRIPTS_PATH.parent))
+
+from ras_docker.arg_parser import supported_apps
+from ras_docker.docker import check_container_already_running, inspect_container_state, docker_image_inspect
+from ras_docker.app import AppCoreConf, get_app_spacific_docker_cmd, get_app_env_script, up_app, kill_app
+
+def wait_removed(container_name: str, timeout=10.0):
+    """
+    Waits for a --rm container to be gone, so the next run can reuse its name.
+    """
+    deadline = time.monotonic() + timeout
+    while inspect_container_state(container_name).status != "missing":
+        if time.monotonic() > deadline:
+            raise SystemExit(f"{container_name} was not removed")
+        time.sleep(0.05)
+
+def time_app_command(app: str, env_script: str, command: str, runs: int, after_run=None):
+    """
+    Runs `command` in the app environment `runs` times and returns the wall times in milliseconds.
+    """
+    run_spec = get_app_spacific_docker_cmd(argparse.Namespace(app=app, command="run"))
+    # no terminal is attached while timing
+    docker_cmd = run_spec.argv(["bash", "-c", f"source {env_script} && {command}"], tty=False)
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        ret = subprocess.run(docker_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        timings.append((time.perf_counter() - start) * 1000)
+        if ret.returncode != 0:
+            raise SystemExit(f"Command failed: {' '.join(docker_cmd)}\n{ret.stderr.decode(errors='replace')}")
+        if after_run is not None:
+            after_run()
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark time-to-first-command with and without ras <app> up")
+    parser.add_argument("app", choices=supported_apps, help="App to benchmark")
+    parser.add_argument("--runs", type=int, default=5, help="Number of runs per case")
+    parser.add_argument("--command", default="true", help="Command to run in the app environment")
+    args = parser.parse_args()
+
+    app_conf = AppCoreConf(args.app)
+    if docker_image_inspect(app_conf.image_name) is None:
+        raise SystemExit(f"{app_conf.image_name} does not exist, run ras {args.app} build first")
+    if check_container_already_running(app_conf.container_name):
+        raise SystemExit(f"{app_conf.container_name} is running, stop it with ras {args.app} kill first")
+
+    env_sh = get_app_env_script(args.app, up=False)
+    results = {}
+    results["cold run"] = time_app_command(args.app, env_sh, args.command, args.runs,
+                                           after_run=lambda: wait_removed(app_conf.container_name))
+    start = time.perf_counter()
+    up_app(argparse.Namespace(app=args.app, command="up"))
+    up_time = (time.perf_counter() - start) * 1000
+    try:
+        results["up + env.sh"] = time_app_command(args.app, env_sh, args.command, args.runs)
+        results["up + snapshot"] = time_app_command(args.app, get_app_env_script(args.app, up=True), args.command, args.runs)
+    finally:
+        kill_app(argparse.Namespace(app=args.app, command="down"))
+
+    print(f"{'ras ' + args.app + ' up':<16} | once   {up_time:8.1f} ms")
+    for case, timings in results.items():
+        print(f"{case:<16} | median {statistics.median(timings):8.1f} ms | min {min(timings):8.1f} ms")
+
+if __name__ == "__main__":
+    main()
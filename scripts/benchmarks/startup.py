@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Startup latency benchmark for the `ras` CLI.
+
+Times `ras --help` and argcomplete completion requests for the current tree
+and, optionally, for another git revision checked out in a temporary worktree.
+Times are also shown on top of a bare interpreter start (`python -c pass`),
+which ras cannot influence.
+
+Cases:
+    --help          `ras --help`
+    complete app    completion of `ras robot `, what a <TAB> runs
+    complete build  completion of `ras build `, with the app choices completer
+
+For the current tree, one extra run per case with `-X importtime` lists the
+slowest imports and any of HANDLER_MODULES that were imported. With --budget
+it exits with 1 if a case is over budget or imports a handler module.
+tests/test_cli_startup.py runs the same check with a generous budget.
+
+Usage:
+    python3 scripts/benchmarks/startup.py [--runs N] [--ref REV] [--budget MS]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+SCRIPTS_PATH = Path(__file__).absolute().parent.parent
+REPO_PATH = SCRIPTS_PATH.parent
+# Modules only the handlers need, importing them while parsing is a regression
+HANDLER_MODULES = ["vcstool", "yaml", "ras_docker.app", "ras_docker.vcs", "ras_docker.docker", "ras_docker.common"]
+
+def get_cases(scripts_path: Path, comp_out: str):
+    """
+    Returns the benchmark cases as {name: (argv, env)} for the `ras` script in scripts_path.
+    The env holds the variables argcomplete expects when invoked by the shell hook.
+    """
+    ras_script = str(scripts_path/"ras")
+    cases = {"--help": ([ras_script, "--help"], {})}
+    for name, line in (("complete app", "ras robot "), ("complete build", "ras build ")):
+        cases[name] = ([ras_script], {
+            "_ARGCOMPLETE": "1",
+            "_ARGCOMPLETE_IFS": " ",
+            "_ARGCOMPLETE_STDOUT_FILENAME": comp_out,
+            "COMP_LINE": line,
+            "COMP_POINT": str(len(line)),
+        })
+    return cases
+
+def get_env():
+    env = dict(os.environ)
+    env.setdefault("RAS_DOCKER_PATH", str(REPO_PATH))
+    return env
+
+def run_case(argv: list, env: dict, runs: int, check=True):
+    """
+    Runs the case `runs` times and returns the wall times in milliseconds,
+    or None if it failed and `check` is False.
+    """
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        ret = subprocess.run([sys.executable] + argv, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        timings.append((time.perf_counter() - start) * 1000)
+        if ret.returncode != 0:
+            if not check:
+                return None
+            raise SystemExit(f"{' '.join(argv)} failed:\n{ret.stderr.decode(errors='replace')}")
+    return timings
+
+def get_interpreter_time(env: dict, runs: int):
+    """Returns the median time of a bare interpreter start in milliseconds."""
+    return statistics.median(run_case(["-c", "pass"], env, runs))
+
+def get_imports(argv: list, env: dict):
+    """
+    Returns the cumulative import time in microseconds of every module imported by the case.
+    """
+    ret = subprocess.run([sys.executable, "-X", "importtime"] + argv, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    imports = {}
+    for _line in ret.stderr.decode(errors="replace").splitlines():
+        if not _line.startswith("import time:") or "|" not in _line:
+            continue
+        _, cumulative, name = _line.split("|")
+        if cumulative.strip().isdigit():
+            imports[name.strip()] = int(cumulative)
+    return imports
+
+def get_handler_imports(imports: dict):
+    return [_m for _m in HANDLER_MODULES if _m in imports]
+
+def bench_tree(label: str, scripts_path: Path, runs: int, interpreter: float, check_imports=False, budget: float = None,
+               check=True):
+    """
+    Benchmarks the cases for the `ras` script in scripts_path. Without `check`
+    a failing case is reported instead of ending the benchmark.
+
+    Returns:
+        bool: False if a case is over budget or imports a handler module.
+    """
+    env = get_env()
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for case, (argv, case_env) in get_cases(scripts_path, str(Path(tmp_dir)/"completions")).items():
+            run_env = {**env, **case_env}
+            timings = run_case(argv, run_env, runs, check)
+            if timings is None:
+                print(f"{label:>10} | {case:<16} | failed")
+                continue
+            median = statistics.median(timings)
+            line = f"{label:>10} | {case:<16} | median {median:6.1f} ms | min {min(timings):6.1f} ms | ras {median-interpreter:6.1f} ms"
+            over = (budget is not None) and (median - interpreter > budget)
+            handlers = []
+            if check_imports:
+                imports = get_imports(argv, run_env)
+                handlers = get_handler_imports(imports)
+            if budget is not None:
+                line += f" | budget {budget:.0f} ms | {'FAIL' if (over or handlers) else 'ok'}"
+            print(line)
+            if handlers:
+                print(f"{'':>10} | {'':<16} | imports handler modules: {', '.join(handlers)}")
+            if check_imports:
+                top_level = sorted(((_t, _m) for _m, _t in imports.items() if "." not in _m), reverse=True)[:5]
+                print(f"{'':>10} | {'':<16} | slowest imports: " + ", ".join(f"{_m} {_t/1000:.1f} ms" for _t, _m in top_level))
+            ok &= not (over or handlers)
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ras startup and completion latency")
+    parser.add_argument("--runs", type=int, default=10, help="Number of runs per case")
+    parser.add_argument("--ref", default=None, help="Git revision to compare against (e.g. HEAD~1)")
+    parser.add_argument("--budget", type=float, default=None,
+                        help="Fail if the median of a case on top of the interpreter start exceeds this many milliseconds")
+    args = parser.parse_args()
+
+    interpreter = get_interpreter_time(get_env(), args.runs)
+    print(f"{'':>10} | {'python -c pass':<16} | median {interpreter:6.1f} ms")
+    if args.ref:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            worktree = Path(tmp_dir)/"ref"
+            subprocess.run(["git", "-C", str(REPO_PATH), "worktree", "add", "--detach", str(worktree), args.ref],
+                           check=True, capture_output=True)
+            try:
+                bench_tree(args.ref, worktree/"scripts", args.runs, interpreter, check=False)
+            finally:
+                subprocess.run(["git", "-C", str(REPO_PATH), "worktree", "remove", "--force", str(worktree)],
+                               capture_output=True)
+    if not bench_tree("current", SCRIPTS_PATH, args.runs, interpreter, check_imports=True, budget=args.budget):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
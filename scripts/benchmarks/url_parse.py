@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for remote url parsing (VcsRemote.from_url).
+
+Compares the previous format-string based parser, which rebuilt its regex
+on every call, against the precompiled patterns with a cold and a warm cache.
+
+Usage:
+    python3 scripts/benchmarks/url_parse.py [--count N] [--rounds N]
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+from pathlib import Path
+from string import Formatter
+
+SCRIPTS_PATH = Path(__file__).absolute().parent.parent
+sys.path.insert(0, str(SCRIPTS_PATH))
+os.environ.setdefault("RAS_DOCKER_PATH", str(SCRIPTS_PATH.parent))
+
+import ras_docker.arg_parser
+from ras_docker.vcs import VcsRemote, GitUrlType, parse_remote_url
+
+def legacy_parse_with_format(format_string, input_string):
+    pattern = "^"
+    for literal_text, field_name, format_spec, conversion in Formatter().parse(format_string):
+        if literal_text:
+            pattern += re.escape(literal_text)
+        if field_name:
+            pattern += r"(?P<" + field_name + r">[^/]+)"
+    pattern += "$"
+    match = re.match(pattern, input_string)
+    if not match:
+        raise ValueError(f"Input string does not match the format: {input_string}")
+    return match.groupdict()
+
+def legacy_from_url(url):
+    for url_type in GitUrlType._member_map_.values():
+        try:
+            return url_type, legacy_parse_with_format(url_type.value, url)
+        except Exception:
+            pass
+    raise ValueError(url)
+
+def generate_urls(count: int):
+    """
+    Generates a mix of the url forms found in .repos files, half of them repeated.
+    """
+    forms = [
+        "https://github.com/org{i}/repo{i}.git",
+        "git@github.com:org{i}/repo{i}",
+        "https://github.com/org{i}/repo{i}",
+        "git@gitlab.com:org{i}/repo{i}.git",
+    ]
+    unique = [forms[i % len(forms)].format(i=i) for i in range(count // 2)]
+    return unique + unique
+
+def run(label, func, urls, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for url in urls:
+            func(url)
+    elapsed = time.perf_counter() - start
+    per_call = elapsed / (rounds * len(urls)) * 1e6
+    print(f"{label:<28} {elapsed * 1000:9.1f} ms total  {per_call:7.2f} us/url")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark remote url parsing")
+    parser.add_argument("--count", type=int, default=4000, help="Number of urls")
+    parser.add_argument("--rounds", type=int, default=5, help="Passes over the url list")
+    args = parser.parse_args()
+    urls = generate_urls(args.count)
+    extra = ["ssh://git@example.org:2222/org/repo.git", "https://example.org:8443/org/repo/"]
+    for url in extra:
+        VcsRemote.from_url(url)
+
+    run("legacy (regex per call)", legacy_from_url, urls, args.rounds)
+
+    def cold(url):
+        parse_remote_url.cache_clear()
+        return VcsRemote.from_url(url)
+    run("compiled, cold cache", cold, urls, args.rounds)
+    parse_remote_url.cache_clear()
+    run("compiled, warm cache", VcsRemote.from_url, urls, args.rounds)
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,24 @@
-from .arg_parser import argparse
-from .common import WORKING_PATH,partial,get_display_var,subprocess,WORKSPACE_BUILD_CMD as workspace_build_cmd,Path,get_docker_cmd_fmt,DockerCmdType,is_wsl
+import argparse
+from .common import WORKING_PATH,ROS2_PKGS_PATH,subprocess,Path,DockerCmdType,is_wsl,\
+        TaskExecutor,output_prefix,task_print
 from .vcs import init_setup,init_app_setup
-from .docker import pull_from_docker_repo,TAG_SUFFIX,regen_docker_fmt,CoreDockerConf,\
-        docker_check_image_exists,run_image_command_core,DOCKERHUB_REPO,kill_docker_container
-from dataclasses import dataclass, field, InitVar
+from .docker import pull_images_from_docker_repo,TAG_SUFFIX,regen_run_spec,CoreDockerConf,\
+        run_image_command_core,DOCKERHUB_REPO,kill_docker_container,\
+        docker_commit_container,docker_remove_container,watch_container_status,\
+        docker_container_inspect,docker_exec_output,check_container_already_running,docker_image_inspect,\
+        get_registry_mirrors,warm_registry_mirror,RegistryMirror,RAS_CONF_PATH
+from .run_spec import DockerRunSpec,get_base_run_spec,is_dry_run,format_argv
+from .host_probe import get_host_capabilities
+from .snapshot import snapshot_container
+from .image_transport import save_images,load_images,read_inventory,write_inventory
+from .docker_api import get_docker_client
+from .workspace_build import plan_workspace_build,get_workspace_build_cmd,get_ccache_path
+from .image_build import ensure_app_images,ensure_image,get_base_build_spec,get_app_build_spec,use_buildx,ensure_buildx_builder
+from dataclasses import dataclass, field, InitVar, asdict
+import json
+import shlex
+import shutil
+import time
 
 def init_app(args: argparse.Namespace):
     """
@@ -21,8 +36,7 @@ def init_app(args: argparse.Namespace):
     if not init_app_setup(args):
         return
     force_pull = (hasattr(args,"image_pull") and args.image_pull)
-    pull_from_docker_repo("ras_base",force_pull)
-    pull_from_docker_repo(app_name,force_pull)
+    pull_images_from_docker_repo(["ras_base",app_name],force_pull)
 
 @dataclass
 class AppCoreConf(CoreDockerConf):
@@ -43,57 +57,127 @@ class AppCoreConf(CoreDockerConf):
         self.container_name = f"ras_{app_ns}_app"
         self.work_dir = f"/{self.app_name}/ros2_ws"
 
-def get_app_spacific_docker_cmd(args: argparse.Namespace, docker_cmd_fmt_src, remove_cn=True, extra_docker_args=""):
+# Label of containers started by `ras <app> up`, which later commands exec into
+UP_LABEL = "org.ras.up"
+# Variables that belong to the exec'd shell rather than to the app environment
+UP_ENV_SKIP_VARS = ["BASHOPTS","SHELLOPTS","BASH_VERSINFO","EUID","PPID","UID","SHLVL","_","PWD","OLDPWD","HOME","USER","HOSTNAME","TERM"]
+
+def get_up_env_path(app: str):
+    """
+    Host path of the environment snapshot of an up container, inside the
+    cache dir mounted at /ras_<app>_app/cache.
+    """
+    return WORKING_PATH/"cache"/"up_env"/f"{app}.sh"
+
+def is_app_up(app: str):
+    """
+    Check if the app has a long-lived container from `ras <app> up` with an
+    environment snapshot to exec into.
+    """
+    app_conf = AppCoreConf(app)
+    info = docker_container_inspect(app_conf.container_name)
+    if (info is None) or (info.get("Name") != f"/{app_conf.container_name}"):
+        return False
+    labels = (info.get("Config") or {}).get("Labels") or {}
+    running = (info.get("State") or {}).get("Status") == "running"
+    return running and (labels.get(UP_LABEL) == "1") and get_up_env_path(app).exists()
+
+def warn_if_up_image_changed(app: str):
+    """
+    Warn when the image was rebuilt after the up container was started from it.
+    """
+    if not is_app_up(app):
+        return
+    app_conf = AppCoreConf(app)
+    container_image = (docker_container_inspect(app_conf.container_name) or {}).get("Image")
+    image_info = docker_image_inspect(app_conf.image_name)
+    if (image_info is not None) and (container_image != image_info["Id"]):
+        task_print(f"Warning: {app_conf.image_name} changed since ras {app} up, run ras {app} down && ras {app} up to use it")
+
+def get_app_env_script(app: str, up=None):
     """
-    Prepare the Docker command template for a specific app with appropriate
-    volumes, environment variables, and paths.
+    The script that sets up the app environment inside the container: the
+    pre-sourced snapshot of an up container, otherwise the app env.sh.
+    """
+    app_name = f"ras_{app}_app"
+    if up is None:
+        up = is_app_up(app)
+    if up:
+        return f"/{app_name}/cache/up_env/{app}.sh"
+    return f"/{app_name}/scripts/env.sh"
+
+def capture_up_env(app: str):
+    """
+    Source the app env.sh once in the up container and store the resulting
+    variables and functions, so later commands only read plain assignments.
+    Aliases are not kept, bash -c does not expand them on the sourcing line.
+
+    Returns:
+        bool: True if the snapshot was written.
+    """
+    app_conf = AppCoreConf(app)
+    skip_vars = "|".join(UP_ENV_SKIP_VARS)
+    script = (f"source /{app_conf.app_name}/scripts/env.sh >/dev/null 2>&1; "
+              f"for _v in $(compgen -e); do case $_v in {skip_vars}) continue;; esac; declare -p $_v; done; "
+              "declare -f")
+    output = docker_exec_output(app_conf.container_name,["bash","-c",script],work_dir=app_conf.work_dir)
+    if output is None:
+        return False
+    env_path = get_up_env_path(app)
+    env_path.parent.mkdir(parents=True,exist_ok=True)
+    env_path.write_text(f"# Environment of /{app_conf.app_name}/scripts/env.sh, written by ras {app} up\n{output}")
+    return True
+
+def get_app_spacific_docker_cmd(args: argparse.Namespace, cmd_type=DockerCmdType.FULL, remove_cn=True,
+                                extra_mounts: dict = None, labels: dict = None, detach=False):
+    """
+    Prepare the run spec of a specific app: the shared base spec with the
+    app volumes, environment variables, and paths layered on top.
     
     Args:
         args: Parsed CLI arguments containing app name and command type.
-        docker_cmd_fmt_src: Source Docker command formatter function.
+        cmd_type: DockerCmdType.FULL for the app container, RAW for a bare one.
         remove_cn: Flag indicating if container should be removed after exit.
-        extra_docker_args: Additional Docker command-line arguments.
+        extra_mounts: Additional mounts, host path to container path.
+        labels: Additional container labels.
+        detach: Start the container in the background.
     
     Returns:
-        A callable that generates the formatted Docker command.
+        DockerRunSpec: The run spec, attached if the container is already running.
     """
     app_conf = AppCoreConf(args.app)
     app_path = WORKING_PATH / 'apps' / app_conf.app_name
-    config_dir = str(WORKING_PATH / 'configs')
-    asset_dir = str(WORKING_PATH / 'assets')
+    config_dir = WORKING_PATH / 'configs'
+    asset_dir = WORKING_PATH / 'assets'
 
     if not app_path.exists():
         print(f"Error: {app_path} does not exist")
         print(f"Please run the init command first")
         exit(1)
 
-    docker_args = ""
-    if remove_cn:
-        docker_args += " --rm "
-    
-    if app_conf.app_name == "ras_server_app":
-        docker_args += f" -v {asset_dir}:/{app_conf.app_name}/ros2_ws/src/assets "
-    
-    # Mount cache directory similar to configs directory
-    cache_dir = str(WORKING_PATH / 'cache')
-    docker_args = f"-v {config_dir}:/{app_conf.app_name}/configs -v {cache_dir}:/{app_conf.app_name}/cache {docker_args}"
-
-    docker_cmd_fmt_local = partial(
-        docker_cmd_fmt_src,
-        display_env=f"{get_display_var()}",
-        app_dir=str(app_path),
-        work_dir="/" + app_conf.app_name,
-        extra_docker_args=docker_args
-    )
-
-    allow_login = args.command in ["dev", "run"]
-    docker_cmd_fmt_new = regen_docker_fmt(docker_cmd_fmt_local, app_conf, allow_login=allow_login)
-
-    if docker_cmd_fmt_new is None:
+    run_spec = get_base_run_spec(app_conf.image_name,app_conf.container_name,app_conf.work_dir,cmd_type,app_type=args.app)
+    run_spec.remove = remove_cn
+    run_spec.detach = detach
+    run_spec.labels.update(labels or {})
+    if cmd_type == DockerCmdType.FULL:
+        run_spec.add_mount(app_path,f"/{app_conf.app_name}/")
+        run_spec.add_mount(ROS2_PKGS_PATH,f"/{app_conf.app_name}/ros2_ws/src/common_pkgs")
+        run_spec.add_mount(config_dir,f"/{app_conf.app_name}/configs")
+        # Mount cache directory similar to configs directory
+        run_spec.add_mount(WORKING_PATH / 'cache',f"/{app_conf.app_name}/cache")
+        if app_conf.app_name == "ras_server_app":
+            run_spec.add_mount(asset_dir,f"/{app_conf.app_name}/ros2_ws/src/assets")
+        for _source, _target in (extra_mounts or {}).items():
+            run_spec.add_mount(_source,_target)
+
+    allow_login = (args.command in ["dev", "run"]) or (args.command == "build" and is_app_up(args.app))
+    run_spec = regen_run_spec(run_spec, app_conf, allow_login=allow_login)
+
+    if run_spec is None:
         print("Already Running")
         exit(1)
 
-    return docker_cmd_fmt_new
+    return run_spec
 
 def build_image_app(args : argparse.Namespace):
     """
@@ -108,56 +192,130 @@ def build_image_app(args : argparse.Namespace):
     if args.clean:
         clean_option = True
 
-    app_name = f"ras_{args.app}_app"
-    image_name = f"ras_{args.app}_app"
-    image_tag = f"ras_{args.app}_app:{TAG_SUFFIX}"
+    run_spec = get_app_spacific_docker_cmd(args)
 
-    docker_cmd_fmt_local = get_app_spacific_docker_cmd(args,get_docker_cmd_fmt(DockerCmdType.FULL))
+    if not ensure_app_images(args.app,force=force_option):
+        print("*****Image build failed*****")
+        return
 
-    def _build_image():
-        print(f"*****Building Existing Docker Image: {image_name}*****")
-        context_path = WORKING_PATH/'context'
-        app_dockerfile = context_path/f"apps/Dockerfile.{args.app}"
-        subprocess.run(f"docker build -t ras_base:{TAG_SUFFIX} -f Dockerfile.base .",shell=True,cwd=str(context_path))
-        subprocess.run(f"docker build -t {image_tag} -f {app_dockerfile} .",shell=True,cwd=str(context_path))
-    
-    image_exists = docker_check_image_exists(image_tag)
-    if (not image_exists) or force_option:
-        _build_image()
+    warn_if_up_image_changed(args.app)
+    status = build_workspace_app(args.app,run_spec,clean_option)
+    if status:
+        print("*****Build Successful, Ready for execution*****")
+    else:
+        print("*****Build error occurred. Image buuild will not be executed*****")
+
+def build_workspace_app(app: str, run_spec: DockerRunSpec, clean=False):
+    """
+    Build the app's colcon workspace inside its container.
+
+    Args:
+        app: The app namespace (robot/server).
+        run_spec: Run spec of the app container.
+        clean: Remove build, log and install before building.
 
+    Returns:
+        True if the workspace built successfully.
+    """
+    app_name = f"ras_{app}_app"
+    image_tag = f"ras_{app}_app:{TAG_SUFFIX}"
+    plan = plan_workspace_build(app,clean)
+    if plan.up_to_date:
+        task_print(f"*****Workspace up to date: {plan.reason} (use --clean to rebuild)*****")
+        return True
+    task_print(f"*****Workspace build: {plan.reason}*****")
+    get_ccache_path(app).mkdir(parents=True,exist_ok=True)
+    workspace_build_cmd = get_workspace_build_cmd(app,plan.packages)
     setup_cmd = f"cd /{app_name}/scripts && ./setup.sh"
     workspace_path = f"/{app_name}/ros2_ws"
     run_command = f"{setup_cmd} && cd {workspace_path} && {workspace_build_cmd}"
 
-    if clean_option:
-        print("*****Clean Build Enabled*****")
+    if clean:
+        task_print("*****Clean Build Enabled*****")
         run_command = f"cd {workspace_path} && rm -rf build log install && {setup_cmd} && cd {workspace_path} && {workspace_build_cmd}"
-    command_str =f"/bin/bash -c \"source /{app_name}/scripts/env.sh && {run_command}\""
-    print(f"Building packages from docker file: {image_tag}")
-    status = run_image_command_core(docker_cmd_fmt_local,command_str,as_root=False)
-    if status:
-        print("*****Build Successful, Ready for execution*****")
-    else:
-        print("*****Build error occurred. Image buuild will not be executed*****")
+    up = is_app_up(app)
+    command = ["/bin/bash","-c",f"source {get_app_env_script(app,up)} && {run_command}"]
+    task_print(f"Building packages from docker file: {image_tag}")
+    status = run_image_command_core(run_spec,command,as_root=False)
+    if status and not is_dry_run():
+        plan.record()
+        if up:
+            # the workspace install space changed, refresh the snapshot
+            capture_up_env(app)
+    return status
 
-def run_image_command(args : argparse.Namespace, command_str):
+def build_all_apps(args : argparse.Namespace):
+    """
+    Build several apps at once: the base image once, then every app image and
+    colcon workspace concurrently, with output lines prefixed by app and a
+    timing summary at the end.
     """
-    Run a shell command inside the app's Docker container. Optionally supports
+    apps = args.apps
+    run_specs = {}
+    for _app in apps:
+        app_args = argparse.Namespace(app=_app,command="build")
+        run_specs[_app] = get_app_spacific_docker_cmd(app_args)
+
+    timings = {}
+    start = time.monotonic()
+    if use_buildx():
+        ensure_buildx_builder()
+    with output_prefix("base"):
+        base_ok = ensure_image(get_base_build_spec())
+    timings["base"] = {"ok": base_ok, "image": time.monotonic()-start}
+    if not base_ok:
+        print("*****Base image build failed*****")
+        return
+
+    def _build_app(app: str):
+        app_timings = {"ok": False}
+        timings[app] = app_timings
+        with output_prefix(app):
+            _start = time.monotonic()
+            image_ok = ensure_image(get_app_build_spec(app),force=args.force)
+            app_timings["image"] = time.monotonic()-_start
+            if not image_ok:
+                return False
+            warn_if_up_image_changed(app)
+            _start = time.monotonic()
+            app_timings["ok"] = build_workspace_app(app,run_specs[app],args.clean)
+            app_timings["workspace"] = time.monotonic()-_start
+        return app_timings["ok"]
+
+    with TaskExecutor(max_workers=len(apps)) as executor:
+        for _app in apps:
+            executor.submit(_build_app,_app,name=_app)
+        results = executor.wait()
+
+    print("*****Build Summary*****")
+    for _name, _timing in timings.items():
+        image_time = f"{_timing['image']:.1f}s" if "image" in _timing else "-"
+        workspace_time = f"{_timing['workspace']:.1f}s" if "workspace" in _timing else "-"
+        state = "ok" if _timing["ok"] else "FAILED"
+        print(f"  {_name:<8} {state:<7} image {image_time:>8}   workspace {workspace_time:>8}")
+    for _result in results:
+        if _result.error is not None:
+            print(f"  {_result.name}: {_result.error}")
+    print(f"  total    {time.monotonic()-start:.1f}s")
+
+def run_image_command(args : argparse.Namespace, command):
+    """
+    Run a command inside the app's Docker container. Optionally supports
     launching VS Code in devcontainer mode.
     
     Args:
         args: Parsed CLI arguments including app name and dev/root options.
-        command_str: Shell command to run inside the container.
+        command: The command and its arguments to run inside the container.
     
     Returns:
         The return code from the container command execution.
     """
     app_conf = AppCoreConf(args.app)
-    extra_docker_args = ""
+    extra_mounts = {}
     as_root=(hasattr(args,"root") and args.root)
     if not as_root:
         dev_container_path = WORKING_PATH/'.devcontainer'/app_conf.container_name
-        extra_docker_args = f" -v {dev_container_path}/.vscode:/home/ras/.vscode-server "
+        extra_mounts[dev_container_path/".vscode"] = "/home/ras/.vscode-server"
     if hasattr(args,"vscode") and args.vscode:
         if as_root:
             print("Error: Cannot run vscode as root")
@@ -179,31 +337,37 @@ def run_image_command(args : argparse.Namespace, command_str):
         else:
             vscode_cmd = f"{code_cmd} {vscode_ws}.code-workspace"
             subprocess.run(vscode_cmd,shell=True)
-    docker_cmd_fmt_local = get_app_spacific_docker_cmd(args,get_docker_cmd_fmt(DockerCmdType.FULL),extra_docker_args=extra_docker_args)
-    return run_image_command_core(docker_cmd_fmt_local,command_str,as_root=as_root)
+    run_spec = get_app_spacific_docker_cmd(args,extra_mounts=extra_mounts)
+    return run_image_command_core(run_spec,command,as_root=as_root)
 
 def run_image_commits(args : argparse.Namespace):
     """
-    Commit changes made inside a running container to a new image and
-    optionally tag it for DockerHub push.
+    Open a root shell in a new container, then keep its changes as a slim
+    snapshot layer on the local app image. Falls back to committing the
+    whole container if the snapshot cannot be built.
     """
-    docker_cmd_fmt_local = get_app_spacific_docker_cmd(args,get_docker_cmd_fmt(DockerCmdType.RAW),remove_cn=False)
-    run_image_command_core(docker_cmd_fmt_local,"/bin/bash",as_root=True)
+    run_spec = get_app_spacific_docker_cmd(args,DockerCmdType.RAW,remove_cn=False)
+    run_image_command_core(run_spec,["/bin/bash"],as_root=True)
+    if is_dry_run():
+        return
     app_conf = AppCoreConf(args.app)
-    ret = subprocess.run(f"docker commit {app_conf.container_name} {app_conf.image_name}",check=True,shell=True)
-    if ret.returncode == 0:
-        print(f"Commited changes to image: {app_conf.image_name}")
-        subprocess.run(f"docker tag {app_conf.image_name} {DOCKERHUB_REPO}:{app_conf.container_name}",check=True,shell=True)
-    subprocess.run(f"docker rm {app_conf.container_name}",shell=True)
+    if snapshot_container(app_conf.container_name,app_conf.image_name):
+        docker_remove_container(app_conf.container_name)
+    elif docker_commit_container(app_conf.container_name,app_conf.image_name):
+        print(f"Warning: Snapshot failed, commited the whole container to image: {app_conf.image_name}")
+        docker_remove_container(app_conf.container_name)
+    else:
+        print(f"Error: Could not save the changes, the container {app_conf.container_name} is kept")
+        return
+    print(f"To publish it: docker tag {app_conf.image_name} {DOCKERHUB_REPO}:{app_conf.container_name} && docker push {DOCKERHUB_REPO}:{app_conf.container_name}")
 
 def run_image_app(args : argparse.Namespace ):
     """
     Execute the app entrypoint inside its Docker container.
     Runs `ras_app` after sourcing environment script.
     """
-    app_name = f"ras_{args.app}_app"
-    bash_cmd = f"source /{app_name}/scripts/env.sh && ras_app " + " ".join(args.args)
-    run_image_command(args=args, command_str=f"bash -c \"{bash_cmd}\"")
+    bash_cmd = f"source {get_app_env_script(args.app)} && ras_app " + shlex.join(args.args)
+    run_image_command(args=args, command=["bash","-c",bash_cmd])
 
 def kill_app(args : argparse.Namespace):
     """
@@ -211,3 +375,139 @@ def kill_app(args : argparse.Namespace):
     """
     app_conf = AppCoreConf(args.app)
     kill_docker_container(app_conf.container_name)
+    get_up_env_path(args.app).unlink(missing_ok=True)
+
+def up_app(args : argparse.Namespace):
+    """
+    Start a long-lived container for the app. Later run, dev and build
+    commands exec into it with a pre-sourced environment instead of
+    starting a new container each time.
+    """
+    app_conf = AppCoreConf(args.app)
+    if check_container_already_running(app_conf.container_name):
+        if is_app_up(args.app):
+            print(f"{app_conf.container_name} is already up")
+            return
+        print(f"{app_conf.container_name} is running from ras {args.app} run/dev, kill it first")
+        exit(1)
+    start = time.monotonic()
+    dev_container_path = WORKING_PATH/'.devcontainer'/app_conf.container_name
+    run_spec = get_app_spacific_docker_cmd(args,extra_mounts={dev_container_path/".vscode": "/home/ras/.vscode-server"},
+                                           labels={UP_LABEL: "1"},detach=True)
+    if not run_image_command_core(run_spec,["sleep","infinity"]):
+        print(f"Error: Failed to start {app_conf.container_name}")
+        exit(1)
+    if is_dry_run():
+        return
+    if not capture_up_env(args.app):
+        print(f"Error: Could not source the environment in {app_conf.container_name}")
+        kill_docker_container(app_conf.container_name)
+        exit(1)
+    print(f"{app_conf.container_name} is up ({time.monotonic()-start:.1f}s), run/dev/build now exec into it")
+    print(f"Stop it with: ras {args.app} down")
+
+def get_image_archive_path(app: str):
+    return WORKING_PATH/"cache"/"images"/f"ras_{app}_app"
+
+def save_app(args : argparse.Namespace):
+    """
+    Export the app image, and the base image if present, into a compressed
+    chunked archive that `ras <app> load` imports without a registry.
+    """
+    app_conf = AppCoreConf(args.app)
+    image_refs = [app_conf.image_name]
+    base_image = f"ras_base:{TAG_SUFFIX}"
+    if docker_image_inspect(base_image) is not None:
+        image_refs.insert(0,base_image)
+    skip_chain_ids = None
+    if args.skip_from:
+        try:
+            skip_chain_ids = read_inventory(args.skip_from)
+        except (OSError,ValueError,KeyError) as e:
+            print(f"Error: Could not read the inventory {args.skip_from}: {e}")
+            exit(1)
+    archive_path = Path(args.output) if args.output else get_image_archive_path(args.app)
+    if not save_images(image_refs,archive_path,skip_chain_ids):
+        exit(1)
+    print(f"Copy {archive_path} to the target machine and run: ras {args.app} load <path>")
+
+def load_app(args : argparse.Namespace):
+    """
+    Import an archive written by `ras <app> save`, or write the inventory of
+    local layers that `save --skip-from` leaves out.
+    """
+    if args.inventory:
+        write_inventory(args.inventory)
+        return
+    archive_path = Path(args.archive) if args.archive else get_image_archive_path(args.app)
+    if not load_images(archive_path):
+        exit(1)
+
+def warm_registry(args : argparse.Namespace):
+    """
+    Populate a registry mirror, by default the first one in ras_conf.yaml
+    that is not Docker Hub, with the base and app images.
+    """
+    mirrors = get_registry_mirrors()
+    if args.mirror:
+        mirror = next((_m for _m in mirrors if _m.repo == args.mirror),RegistryMirror(args.mirror))
+    else:
+        mirror = next((_m for _m in mirrors if _m.repo != DOCKERHUB_REPO),None)
+        if mirror is None:
+            print(f"Error: No mirror besides Docker Hub in {RAS_CONF_PATH} (ras.registry.mirrors), pass --mirror")
+            exit(1)
+    upstream = [_m for _m in mirrors if _m.repo != mirror.repo]
+    if len(upstream) == 0:
+        upstream = [RegistryMirror(DOCKERHUB_REPO)]
+    image_contexts = ["ras_base"] + [f"ras_{_app}_app" for _app in args.apps]
+    print(f"Warming {mirror.repo} from {', '.join(_m.repo for _m in upstream)}")
+    if not warm_registry_mirror(mirror,image_contexts,upstream):
+        exit(1)
+
+def app_status(args : argparse.Namespace):
+    """
+    Print the state of the app container, following changes with --watch.
+    """
+    app_conf = AppCoreConf(args.app)
+    watch_container_status([app_conf.container_name],watch=args.watch,as_json=args.json)
+
+def doctor(args : argparse.Namespace):
+    """
+    Print the host capabilities that app containers are configured from,
+    and how docker is reached.
+    """
+    host = get_host_capabilities(refresh=args.refresh,quiet=True)
+    if args.json:
+        report = asdict(host)
+        report.update(headless=host.headless,gpu_mode=host.gpu_mode,warnings=host.warnings())
+        print(json.dumps(report,indent=2))
+        return
+    displays = []
+    if host.display is not None:
+        displays.append(f"X11 {host.display}" + ("" if host.x11_socket else " (no /tmp/.X11-unix)"))
+    if host.wayland_display is not None:
+        displays.append(f"Wayland {host.wayland_display}")
+    if host.wslg:
+        displays.append("WSLg")
+    gpu = {"nvidia": "nvidia runtime (--gpus all)", "dri": "/dev/dri", "none": "none"}[host.gpu_mode]
+    docker_client = get_docker_client()
+    docker_found = shutil.which("docker") is not None
+    if docker_client is not None:
+        docker = f"API at {docker_client.socket_path}"
+    else:
+        docker = "docker CLI" if docker_found else "not found"
+    mem = f"{host.mem_total_mb/1024:.1f} GiB" if host.mem_total_mb else "unknown"
+    print("*****Host*****")
+    print(f"  GPU            {gpu}")
+    print(f"  nvidia driver  {'yes' if host.nvidia_driver else 'no'}")
+    print(f"  display        {', '.join(displays) if displays else 'headless'}")
+    print(f"  WSL            {'yes' if host.wsl else 'no'}")
+    print(f"  CPUs           {host.cpu_count}")
+    print(f"  memory         {mem}")
+    print(f"  docker         {docker}")
+    print(f"  buildx         {'yes' if docker_found and use_buildx() else 'no'}")
+    for _warning in host.warnings():
+        print(f"Warning: {_warning}")
+    run_spec = get_base_run_spec("<image>","<container>","<work_dir>",host=host)
+    print("*****Base docker command*****")
+    print(format_argv(run_spec.run_argv(["<command>"])))
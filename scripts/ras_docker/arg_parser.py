@@ -1,9 +1,35 @@
 import os
-import argcomplete, argparse
-from .app import build_image_app,run_image_app,init_app,run_image_command,run_image_commits,kill_app
-from .vcs import init_setup,clear_setup,init_app_setup,repos_vcs_version,pull_repos_vcs,url_mode,get_vcs_status
+import argparse
 
+# Parser definitions only: handlers are imported once a command is dispatched,
+# so --help and tab completion do not pay for importing vcstool, yaml and docker
 supported_apps = ["robot","server"]
+CLONE_MODES = ["full","blobless","shallow"]
+LOCKFILE_NAME = "vcs.lock"
+
+class LazyParserMap(dict):
+    """
+    Name to parser map of a subparsers action that adds the subcommands of a
+    parser the first time it is looked up, so only the parsers on the path of
+    the command line are built.
+    """
+    def __init__(self):
+        super().__init__()
+        self._builders = {}
+
+    def defer(self, name: str, builder):
+        self._builders[name] = builder
+
+    def __getitem__(self, name):
+        parser = super().__getitem__(name)
+        builder = self._builders.pop(name,None)
+        if builder is not None:
+            builder(parser)
+        return parser
+
+def use_lazy_parsers(subparsers: argparse._SubParsersAction):
+    subparsers._name_parser_map = subparsers.choices = LazyParserMap()
+    return subparsers
 
 def get_parser(test_func_en = False):
     """
@@ -29,19 +55,36 @@ def get_parser(test_func_en = False):
 
         nested_init_parser = nested_subparsers.add_parser("init", help="Initialize the application")
         nested_init_parser.add_argument("--image-pull","-i", action="store_true",default=False,dest="image_pull", help="Force pull the image from the docker repo")
+        nested_init_parser.add_argument("--clone-mode", choices=CLONE_MODES,default=None,dest="clone_mode", help="How new repositories are cloned (default: full, using the mirror cache)")
+        nested_init_parser.add_argument("--locked", nargs="?", const=os.path.join(os.environ["RAS_DOCKER_PATH"],LOCKFILE_NAME), default=None, metavar="LOCKFILE", help="Check out the exact commits from a lockfile (default: vcs.lock)")
 
         nested_build_parser = nested_subparsers.add_parser("build", help="Build the robot image")
-        nested_build_parser.add_argument("--force", action="store_true", help="Force rebuild of the image")
+        nested_build_parser.add_argument("--force", action="store_true", help="Rebuild the app image even if its inputs are unchanged")
         nested_build_parser.add_argument("--clean", action="store_true", help="Clean up intermediate build files")
 
         nested_run_parser = nested_subparsers.add_parser("run", help="Run the robot robot image")
         nested_run_parser.add_argument("args", nargs=argparse.REMAINDER, help="Arguments to pass to the run command")
         
         nested_kill_parser = nested_subparsers.add_parser("kill", help="Kill the robot image")
+
+        nested_up_parser = nested_subparsers.add_parser("up", help="Keep a container running, later run/dev/build commands exec into it")
+        nested_down_parser = nested_subparsers.add_parser("down", help="Stop the container started by up")
+
+        nested_save_parser = nested_subparsers.add_parser("save", help="Export the app images to a compressed archive for machines without registry access")
+        nested_save_parser.add_argument("--output","-o", default=None, help="Archive directory (default: cache/images/ras_<app>_app)")
+        nested_save_parser.add_argument("--skip-from", default=None, dest="skip_from", metavar="INVENTORY", help="Leave out the layers listed by 'load --inventory' on the target")
+
+        nested_load_parser = nested_subparsers.add_parser("load", help="Import the app images from an archive written by save")
+        nested_load_parser.add_argument("archive", nargs="?", default=None, help="Archive directory (default: cache/images/ras_<app>_app)")
+        nested_load_parser.add_argument("--inventory", default=None, metavar="FILE", help="Only write the layers this machine already has to FILE, for 'save --skip-from'")
+
+        nested_status_parser = nested_subparsers.add_parser("status", help="Show the state of the app container")
+        nested_status_parser.add_argument("--watch","-w", action="store_true", help="Follow state changes from the docker event stream")
+        nested_status_parser.add_argument("--json", action="store_true", help="Print the state as JSON lines")
         
         nested_dev_parser = nested_subparsers.add_parser("dev", help="Open terminal in Container")
         nested_dev_parser.add_argument("--root","-r", action="store_true", help="Open terminal as root user")
-        nested_dev_parser.add_argument("--commit","-c", action="store_true", help="Commit changes to the image")
+        nested_dev_parser.add_argument("--commit","-c", action="store_true", help="Save changes to the image as a slim snapshot layer")
         nested_dev_parser.add_argument("--terminator","-t", action="store_true", help="Open terminal in terminator")
         nested_dev_parser.add_argument("--vscode","-v", action="store_true", help="Attach container in vscode")
 
@@ -51,6 +94,8 @@ def get_parser(test_func_en = False):
         return nested_subparsers
 
     parser = argparse.ArgumentParser(description="RAS Application Interface.\nBuild and run RAS applications")
+    parser.add_argument("--dry-run","--print", action="store_true", dest="dry_run", help="Print the docker commands instead of running them")
+    parser.add_argument("--profile", action="store_true", help="Trace every spawned command to .ras/traces (or to RAS_TRACE) and print the slowest at exit")
     app_subparsers = parser.add_subparsers(dest="app", help="Application to run/build")
 
     def add_app_subparsers(app_subparsers : argparse._SubParsersAction ):
@@ -65,18 +110,36 @@ def get_parser(test_func_en = False):
         """
         for app_name in supported_apps:
             app_parser = app_subparsers.add_parser(app_name, help=f"{app_name} application")
-            nested_app_parsers = add_nested_subparsers(app_parser)
+            app_subparsers.choices.defer(app_name,add_nested_subparsers)
         return app_subparsers
 
-    app_subparsers = add_app_subparsers(app_subparsers)
+    app_subparsers = add_app_subparsers(use_lazy_parsers(app_subparsers))
 
     app_parser : argparse.ArgumentParser = app_subparsers.add_parser("app", help="Application commands")
-    cmd_app_subparsers = app_parser.add_subparsers(title="app",dest="app", help="Application to run/build")
+    cmd_app_subparsers = use_lazy_parsers(app_parser.add_subparsers(title="app",dest="app", help="Application to run/build"))
     cmd_app_subparsers = add_app_subparsers(cmd_app_subparsers)
 
     setup_parser : argparse.ArgumentParser = app_subparsers.add_parser("init", help="Initialize the RAS setup")
+    setup_parser.add_argument("--clone-mode", choices=CLONE_MODES,default=None,dest="clone_mode", help="How new repositories are cloned (default: full, using the mirror cache)")
+    setup_parser.add_argument("--locked", nargs="?", const=os.path.join(os.environ["RAS_DOCKER_PATH"],LOCKFILE_NAME), default=None, metavar="LOCKFILE", help="Check out the exact commits from a lockfile (default: vcs.lock)")
     clear_parser : argparse.ArgumentParser = app_subparsers.add_parser("clear", help="Clear the RAS setup")
 
+    build_parser : argparse.ArgumentParser = app_subparsers.add_parser("build", help="Build several apps concurrently, sharing one base image build")
+    # no choices= here, argparse rejects an empty list for nargs="*" with choices
+    build_apps_arg = build_parser.add_argument("apps", nargs="*", default=None, help=f"Apps to build, from {supported_apps} (default: all)")
+    build_parser.add_argument("--force", action="store_true", help="Rebuild the app images even if their inputs are unchanged")
+    build_parser.add_argument("--clean", action="store_true", help="Clean up intermediate build files")
+
+    doctor_parser : argparse.ArgumentParser = app_subparsers.add_parser("doctor", help="Show the host capabilities used for app containers")
+    doctor_parser.add_argument("--refresh", action="store_true", help="Probe the host again instead of using the cache")
+    doctor_parser.add_argument("--json", action="store_true", help="Print the capabilities as JSON")
+
+    registry_parser : argparse.ArgumentParser = app_subparsers.add_parser("registry", help="Registry mirror commands")
+    cmd_registry_subparsers = registry_parser.add_subparsers(title="registry",dest="registry", help="Registry mirror commands")
+    warm_parser = cmd_registry_subparsers.add_parser("warm", help="Populate a registry mirror with the base and app images")
+    warm_apps_arg = warm_parser.add_argument("apps", nargs="*", default=None, help=f"Apps whose images to include, from {supported_apps} (default: all)")
+    warm_parser.add_argument("--mirror", default=None, help="Repository to populate (default: the first mirror in ras_conf.yaml that is not Docker Hub)")
+
     vcs_parser : argparse.ArgumentParser = app_subparsers.add_parser("vcs", help="VCS commands")
     cmd_vcs_subparsers = vcs_parser.add_subparsers(title="vcs",dest="vcs", help="VCS commands")
 
@@ -91,10 +154,31 @@ def get_parser(test_func_en = False):
     
     status_parser = cmd_vcs_subparsers.add_parser("status", help="Get the status of the repositories")
     status_parser.add_argument("--fetch","-f", action="store_true", help="Fetch the repositories")
+    status_parser.add_argument("--json", action="store_true", help="Print the status as JSON")
 
-    argcomplete.autocomplete(parser)
+    lock_parser = cmd_vcs_subparsers.add_parser("lock", help="Write the exact commit of every repository to a lockfile")
+    lock_parser.add_argument("--output","-o", default=None, help="Lockfile path (default: vcs.lock)")
+
+    # argcomplete is only needed when the shell asks for completions
+    if "_ARGCOMPLETE" in os.environ:
+        import argcomplete
+        for _arg in (build_apps_arg,warm_apps_arg):
+            _arg.completer = argcomplete.completers.ChoicesCompleter(supported_apps)
+        argcomplete.autocomplete(parser)
     return parser
 
+def enable_profiling():
+    """
+    Starts tracing spawned commands to RAS_TRACE, or to a timestamped file in .ras/traces.
+    """
+    from .trace import enable_tracing
+    trace_path = os.environ.get("RAS_TRACE")
+    if not trace_path:
+        from .common import STATE_PATH
+        import time
+        trace_path = STATE_PATH/"traces"/f"{time.strftime('%Y%m%d-%H%M%S')}.json"
+    enable_tracing(trace_path)
+
 def parse_args(parser : argparse.ArgumentParser,test_func = None):
     """
     Parse the command line arguments and call the appropriate handler based on the parsed arguments.
@@ -107,6 +191,11 @@ def parse_args(parser : argparse.ArgumentParser,test_func = None):
         ValueError: If the test_func is not callable and 'test' command is issued.
     """
     args = parser.parse_args()
+    if args.profile or os.environ.get("RAS_TRACE"):
+        enable_profiling()
+    if args.dry_run:
+        from .run_spec import set_dry_run
+        set_dry_run(True)
 
     if hasattr(args, "app") and args.app in supported_apps:
         os.environ["APP_TYPE"] = args.app
@@ -114,21 +203,31 @@ def parse_args(parser : argparse.ArgumentParser,test_func = None):
         parser.print_help()
         exit(1)
     if (args.app == "app") or (args.app in supported_apps):
+        from .app import build_image_app,run_image_app,init_app,run_image_command,run_image_commits,kill_app,app_status,\
+                up_app,save_app,load_app
         if args.command == "build":
             build_image_app(args)
         elif args.command == "run":
             run_image_app(args)
-        elif args.command == "kill":
+        elif args.command in ["kill", "down"]:
             kill_app(args)
+        elif args.command == "up":
+            up_app(args)
+        elif args.command == "status":
+            app_status(args)
+        elif args.command == "save":
+            save_app(args)
+        elif args.command == "load":
+            load_app(args)
         elif args.command == "init":
             init_app(args)
         elif args.command == "dev":
             if hasattr(args,"commit") and args.commit:
                 run_image_commits(args)
             elif hasattr(args,"terminator") and args.terminator:
-                run_image_command(args, "/bin/bash -c terminator")
+                run_image_command(args, ["/bin/bash","-c","terminator"])
             else:
-                run_image_command(args, "/bin/bash")
+                run_image_command(args, ["/bin/bash"])
         elif args.command == "test":
             if callable(test_func):
                 test_func(args)
@@ -137,10 +236,35 @@ def parse_args(parser : argparse.ArgumentParser,test_func = None):
         else:
             parser.print_help()
     elif args.app == "init":
+        from .vcs import init_setup
         init_setup(args)
     elif args.app == "clear":
+        from .vcs import clear_setup
         clear_setup(args)
+    elif args.app == "build":
+        if not args.apps:
+            args.apps = list(supported_apps)
+        for _app in args.apps:
+            if _app not in supported_apps:
+                parser.error(f"invalid app: '{_app}' (choose from {supported_apps})")
+        from .app import build_all_apps
+        build_all_apps(args)
+    elif args.app == "doctor":
+        from .app import doctor
+        doctor(args)
+    elif args.app == "registry":
+        if args.registry == "warm":
+            if not args.apps:
+                args.apps = list(supported_apps)
+            for _app in args.apps:
+                if _app not in supported_apps:
+                    parser.error(f"invalid app: '{_app}' (choose from {supported_apps})")
+            from .app import warm_registry
+            warm_registry(args)
+        else:
+            parser.print_help()
     elif args.app == "vcs":
+        from .vcs import repos_vcs_version,pull_repos_vcs,url_mode,get_vcs_status,lock_vcs
         if args.vcs == "url-mode":
             url_mode(args)
         elif args.vcs == "pull":
@@ -153,6 +277,8 @@ def parse_args(parser : argparse.ArgumentParser,test_func = None):
                 print("Current Version :", version)
         elif args.vcs == "status":
             get_vcs_status(args)
+        elif args.vcs == "lock":
+            lock_vcs(args)
         else:
             parser.print_help()
     else:
@@ -2,15 +2,21 @@ from pathlib import Path
 from enum import Enum
 import ras_docker
 import subprocess
-from functools import partial
 import os
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from functools import partial
+import sys
+import json
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, Future, wait as futures_wait
+from dataclasses import dataclass
+from typing import Any, Callable, List, Tuple
+from .trace import trace_span
 
 WORKING_PATH = Path(os.environ["RAS_DOCKER_PATH"])
 ROS2_PKGS_PATH = WORKING_PATH/"ros2_pkgs"
-
-WORKSPACE_BUILD_CMD = "colcon build --symlink-install"
+STATE_PATH = WORKING_PATH/".ras"
+TIMING_ENABLED = os.environ.get("RAS_TIMING","0") not in ("","0")
 
 class AssetType(Enum):
     """
@@ -29,42 +35,6 @@ class DockerCmdType(Enum):
     RAW = 2
     ATTACH = 3
 
-import re
-from string import Formatter
-
-def parse_with_format(format_string, input_string):
-    """
-    Parses an input string using a Python format string template.
-
-    Args:
-        format_string (str): The format string with named fields.
-        input_string (str): The actual string to be parsed.
-
-    Returns:
-        dict: A dictionary mapping field names to parsed values.
-
-    Raises:
-        ValueError: If the input string does not match the format string.
-    """
-    formatter = Formatter()
-    pattern = "^"
-    field_names = []
-
-    for literal_text, field_name, format_spec, conversion in formatter.parse(format_string):
-        if literal_text:
-            pattern += re.escape(literal_text)
-        if field_name:
-            field_names.append(field_name)
-            pattern += r"(?P<" + field_name + r">[^/]+)"
-
-    pattern += "$"
-
-    match = re.match(pattern, input_string)
-    if not match:
-        raise ValueError(f"Input string does not match the format: {input_string}")
-
-    return match.groupdict()
-
 def is_wsl():
     """
     Checks if the current environment is a Windows Subsystem for Linux (WSL).
@@ -72,86 +42,8 @@ def is_wsl():
     Returns:
         bool: True if running in WSL, False otherwise.
     """
-    return Path("/proc/sys/fs/binfmt_misc/WSLInterop").exists()
-
-def get_docker_cmd_fmt(cmd_type: DockerCmdType):
-    """
-    Generates a Docker command format string or callable depending on the Docker command type.
-
-    Args:
-        cmd_type (DockerCmdType): The type of Docker command to generate.
-
-    Returns:
-        function: A partial function that can be called with required parameters to format a Docker command.
-
-    Raises:
-        ValueError: If the Docker command type is invalid or unexpected.
-    """
-    docker_cmd_fmt_prefix = """docker run -it \
-                -e DISPLAY={display_env} \
-                -e APP_TYPE={app_type} \
-                --user {user_id}:{user_id} \
-                -v /etc/localtime:/etc/localtime:ro \
-                --name {container_name} \
-                --workdir {work_dir} \
-                --network host """
-    passthrough_mounts = ["/tmp/.X11-unix","/mnt/wslg"]
-    passthrough_envvars = ["WAYLAND_DISPLAY","XDG_RUNTIME_DIR"]
-    docker_gen_cmd_opts = """ -v {app_dir}:/{container_name}/ \
-                            {extra_docker_args} -v /var/run/docker.sock:/var/run/docker.sock \
-                                {gpu_arg} \
-                                 -v /dev:/dev --device-cgroup-rule='c 13:* rmw' --device-cgroup-rule 'c 81:* rmw' \
-                            --device-cgroup-rule 'c 189:* rmw' """ + f" -v {ROS2_PKGS_PATH}:/{{container_name}}/ros2_ws/src/common_pkgs "
-    docker_cmd_fmt_suffix= """ {image_name} \
-                {command} """
-    docker_cmd_fmt = None
-    for _dir in passthrough_mounts:
-        _path = Path(_dir).absolute().resolve()
-        if _path.is_dir():
-            docker_gen_cmd_opts += f" -v {_path}:{_path} "
-    for _env in passthrough_envvars:
-        if _env in os.environ.keys():
-            docker_gen_cmd_opts += f" -e {_env} "
-    if (cmd_type == DockerCmdType.RAW):
-        docker_cmd_fmt = (docker_cmd_fmt_prefix + docker_cmd_fmt_suffix).format
-    elif (cmd_type == DockerCmdType.FULL):
-        docker_cmd_fmt = (docker_cmd_fmt_prefix+docker_gen_cmd_opts+docker_cmd_fmt_suffix).format
-    elif (cmd_type == DockerCmdType.ATTACH):
-        docker_cmd_fmt = "docker exec -it -u {user_id}:{user_id} -w /{work_dir}  {container_name} {command} ".format
-        return docker_cmd_fmt
-    else:
-        raise ValueError(f"invalid docker cmd_type {cmd_type}")
-
-    daemon_config_path = Path("/etc/docker/daemon.json")
-    
-    nvidia_ctk = False
-    if daemon_config_path.exists():
-        import json
-        with daemon_config_path.open() as f:
-            config = json.load(f)
-            # Check if nvidia runtime is present in Docker's daemon config
-            if "nvidia" in config.get("runtimes", {}):
-                nvidia_ctk = True
-    elif Path("/proc/driver/nvidia").exists():
-        print("Warning: Docker Daemon Config not found")
-        print("Warning: Please setup nvidia-ctk.")
-    docker_gpu_arg = "--device /dev/dri"
-    if(nvidia_ctk):
-        docker_gpu_arg = "--gpus all -e NVIDIA_VISIBLE_DEVICES=all \
-            -e NVIDIA_DRIVER_CAPABILITIES=all \
-            --runtime nvidia"
-    if (cmd_type==DockerCmdType.FULL):
-        return partial(docker_cmd_fmt,
-                display_env=get_display_var(),
-                gpu_arg= docker_gpu_arg,
-                app_type=os.environ.get("APP_TYPE", "robot")
-            )
-    elif (cmd_type==DockerCmdType.RAW):
-        return partial(docker_cmd_fmt,
-                display_env=get_display_var()
-            )
-    else:
-        raise ValueError(f"Unexpected docker cmd_type{cmd_type}")
+    from .host_probe import get_host_capabilities
+    return get_host_capabilities().wsl
 
 def prepend_root_command(command_str:str):
     """
@@ -169,6 +61,10 @@ def run_command_shell(command_str:str,as_root:bool=False,work_dir:Path=None,read
     """
     Executes a shell command using subprocess.
 
+    When called from a TaskExecutor task with output capture enabled, the
+    preview and the command output are appended to the task output instead
+    of going to the terminal.
+
     Args:
         command_str (str): The command to execute.
         as_root (bool): If True, runs the command as root.
@@ -183,49 +79,335 @@ def run_command_shell(command_str:str,as_root:bool=False,work_dir:Path=None,read
         work_dir = str(work_dir)
     if as_root:
         command_str = prepend_root_command(command_str)
+    task_output = getattr(_task_local,"output",None)
     if preview:
-        print("Running Command:",command_str)
+        if task_output is not None:
+            task_output.append(f"Running Command: {command_str}\n")
+        else:
+            print("Running Command:",command_str)
+    if (task_output is not None) and (not read_output):
+        ret = subprocess.run(command_str,shell=True,cwd=work_dir,executable="/bin/bash",\
+                             stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+        task_output.append(ret.stdout.decode(errors="replace"))
+        return ret
     return subprocess.run(command_str,shell=True,cwd=work_dir,executable="/bin/bash",\
                           capture_output=read_output)
 
-def run_functions_in_threads(functions_with_args):
+DEFAULT_MAX_WORKERS = int(os.environ.get("RAS_JOBS",min(16,(os.cpu_count() or 1)*2)))
+
+# Output fragments of git/network failures that are worth retrying.
+TRANSIENT_ERROR_PATTERNS = [
+    "could not resolve host",
+    "connection reset",
+    "connection timed out",
+    "operation timed out",
+    "connection refused",
+    "early eof",
+    "rpc failed",
+    "the remote end hung up unexpectedly",
+    "gnutls_handshake",
+    "ssl_read",
+    "unable to access",
+    "internal server error",
+    "bad gateway",
+    "service unavailable",
+    "temporary failure in name resolution",
+]
+
+_task_local = threading.local()
+
+@dataclass
+class TaskResult:
+    """
+    Outcome of one task run by a TaskExecutor.
+
+    Attributes:
+        name (str): Label of the task.
+        ok (bool): True if the task neither raised nor returned False.
+        value: Return value of the last attempt.
+        error (Exception): Exception of the last attempt, if any.
+        attempts (int): Number of attempts made.
+        wall_time (float): Total wall time in seconds, retries included.
+        output (str): Captured command output of all attempts.
+        cancelled (bool): True if the task was cancelled before completing.
+    """
+    name: str
+    ok: bool = False
+    value: Any = None
+    error: Exception = None
+    attempts: int = 0
+    wall_time: float = 0.0
+    output: str = ""
+    cancelled: bool = False
+
+_print_lock = threading.Lock()
+
+@contextmanager
+def output_prefix(prefix:str):
     """
-    Runs multiple functions in parallel using threads.
+    Context manager prefixing the output of task_print and run_streamed in
+    the current thread with `[prefix]`, so concurrent tasks can share the terminal.
 
     Args:
-        functions_with_args (list): List of tuples (function, args, kwargs).
+        prefix (str): Label printed before each line.
+    """
+    _task_local.prefix = prefix
+    try:
+        yield
+    finally:
+        _task_local.prefix = None
+
+def get_output_prefix():
+    return getattr(_task_local,"prefix",None)
 
-    Raises:
-        RuntimeError: If any function raises an exception.
+def print_prefixed(prefix:str,text:str):
+    """
+    Prints each line of text with a `[prefix]` label, as one write.
     """
-    with ThreadPoolExecutor() as executor:
-        futures = [executor.submit(partial(func, *args, **kwargs)) for func, args, kwargs in functions_with_args]
-        for future in as_completed(futures):
+    lines = text.splitlines()
+    with _print_lock:
+        sys.stdout.write("".join(f"[{prefix}] {_line}\n" for _line in lines))
+        sys.stdout.flush()
+
+def task_print(*args):
+    """
+    Prints a message, or appends it to the output of the current task when
+    the TaskExecutor captures output. Messages are labelled when an
+    output_prefix is active.
+    """
+    message = " ".join(str(_a) for _a in args)
+    task_output = getattr(_task_local,"output",None)
+    prefix = get_output_prefix()
+    if task_output is not None:
+        task_output.append(message + "\n")
+    elif prefix is not None:
+        print_prefixed(prefix,message)
+    else:
+        print(message)
+
+def run_streamed(command,**kwargs):
+    """
+    Runs a command like subprocess.run. When an output_prefix is active the
+    output is read line by line and printed with the prefix, so concurrent
+    commands are multiplexed line-wise instead of garbling each other.
+
+    Returns:
+        CompletedProcess: The result, without captured output.
+    """
+    prefix = get_output_prefix()
+    if prefix is None:
+        return subprocess.run(command,**kwargs)
+    proc = subprocess.Popen(command,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,stdin=subprocess.DEVNULL,**kwargs)
+    output_size = 0
+    for _line in proc.stdout:
+        output_size += len(_line)
+        print_prefixed(prefix,_line.decode(errors="replace").rstrip("\r\n"))
+    proc.wait()
+    if hasattr(proc,"add_trace_output"):
+        proc.add_trace_output(output_size)
+    return subprocess.CompletedProcess(command,proc.returncode)
+
+def is_transient_failure(result:TaskResult):
+    """
+    Checks whether a failed task looks like a transient git/network error.
+    """
+    text = (result.output + " " + str(result.error or "")).lower()
+    return any(_p in text for _p in TRANSIENT_ERROR_PATTERNS)
+
+class TaskExecutor:
+    """
+    Thread pool returning a TaskResult per task instead of raising on the
+    first failure.
+
+    Tasks are retried with exponential backoff while `retry_if` accepts the
+    failure, can submit more tasks while the executor is running, and are
+    cancelled on `cancel()` or Ctrl-C.
+    """
+    def __init__(self,max_workers:int=None,retries:int=0,backoff:float=1.0,
+                 retry_if:Callable[[TaskResult],bool]=is_transient_failure,capture_output=False,fail_fast=False):
+        self.max_workers = max_workers or DEFAULT_MAX_WORKERS
+        self.retries = retries
+        self.backoff = backoff
+        self.retry_if = retry_if
+        self.capture_output = capture_output
+        self.fail_fast = fail_fast
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers,thread_name_prefix="ras-task")
+        self._lock = threading.Lock()
+        self._futures : List[Tuple[str,Future]] = []
+        self._cancelled = threading.Event()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc,tb):
+        if exc_type is not None:
+            self.cancel()
+        self._pool.shutdown(wait=True)
+
+    def submit(self,func:Callable,*args,name:str=None,on_done:Callable[[TaskResult],None]=None,**kwargs):
+        """
+        Submits a task. `on_done` is called with the TaskResult in the worker
+        thread before the task is marked complete.
+
+        Returns:
+            Future: Resolves to the TaskResult of the task.
+        """
+        name = name or getattr(func,"__name__",str(func))
+        future = self._pool.submit(self._run,func,args,kwargs,name,on_done)
+        with self._lock:
+            self._futures.append((name,future))
+        return future
+
+    def _run(self,func,args,kwargs,name,on_done):
+        result = TaskResult(name)
+        start = time.monotonic()
+        for attempt in range(1,self.retries+2):
+            if self._cancelled.is_set():
+                result.cancelled = True
+                break
+            output = []
+            if self.capture_output:
+                _task_local.output = output
             try:
-                future.result()
+                with trace_span(name,"task",attempt=attempt):
+                    result.value = func(*args,**kwargs)
+                result.error = None
             except Exception as e:
-                raise RuntimeError(f"Function execution failed: {e}")
-
-def run_command_list_in_threads(commands:list,as_root=False,work_dir:Path=None):
+                result.value = None
+                result.error = e
+            finally:
+                _task_local.output = None
+            result.attempts = attempt
+            result.output += "".join(output)
+            result.ok = (result.error is None) and (result.value is not False)
+            if result.ok or attempt > self.retries or not self.retry_if(result):
+                break
+            delay = self.backoff*(2**(attempt-1))
+            # through task_print, so the note lands in the captured or prefixed output of the task
+            output = []
+            if self.capture_output:
+                _task_local.output = output
+            task_print(f"[retry] {name}: attempt {attempt} failed, retrying in {delay:.0f}s")
+            _task_local.output = None
+            result.output += "".join(output)
+            self._cancelled.wait(delay)
+        result.wall_time = time.monotonic() - start
+        if on_done is not None:
+            on_done(result)
+        if self.fail_fast and not result.ok:
+            self.cancel()
+        return result
+
+    def cancel(self):
+        """Cancels pending tasks and stops retries of running ones."""
+        self._cancelled.set()
+        with self._lock:
+            for _, _future in self._futures:
+                _future.cancel()
+
+    def wait(self):
+        """
+        Waits for every submitted task, including tasks submitted while waiting.
+
+        Returns:
+            list: TaskResult of each task, in submission order.
+        """
+        try:
+            while True:
+                with self._lock:
+                    pending = [_f for _,_f in self._futures if not _f.done()]
+                if len(pending) == 0:
+                    break
+                futures_wait(pending)
+        except KeyboardInterrupt:
+            self.cancel()
+            raise
+        results = []
+        with self._lock:
+            futures = list(self._futures)
+        for _name, _future in futures:
+            if _future.cancelled():
+                results.append(TaskResult(_name,cancelled=True))
+            else:
+                results.append(_future.result())
+        return results
+
+    def map(self,functions_with_args):
+        """
+        Runs a list of (function, args, kwargs) tuples and waits for them.
+
+        Returns:
+            list: TaskResult of each function, in order.
+        """
+        for func, args, kwargs in functions_with_args:
+            self.submit(func,*(args or []),**(kwargs or {}))
+        return self.wait()
+
+def read_state(name:str,default=None):
     """
-    Executes a list of shell commands in parallel threads.
+    Reads a JSON state file stored under the working path.
 
     Args:
-        commands (list): List of shell command strings.
-        as_root (bool): Whether to run commands as root.
-        work_dir (Path): Optional working directory.
+        name (str): Name of the state file (without extension).
+        default: Value returned if the state file is missing or unreadable.
 
     Returns:
-        None
+        The decoded JSON content or the default value.
+    """
+    state_file = STATE_PATH/f"{name}.json"
+    try:
+        with state_file.open() as f:
+            return json.load(f)
+    except (OSError,ValueError):
+        return default
+
+def write_state(name:str,data):
+    """
+    Atomically writes a JSON state file under the working path.
+
+    Args:
+        name (str): Name of the state file (without extension).
+        data: JSON serializable content to store.
+    """
+    STATE_PATH.mkdir(parents=True,exist_ok=True)
+    state_file = STATE_PATH/f"{name}.json"
+    tmp_file = STATE_PATH/f".{name}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with tmp_file.open("w") as f:
+        json.dump(data,f,indent=2)
+    tmp_file.replace(state_file)
+
+@contextmanager
+def timed(label:str):
+    """
+    Context manager printing the wall time of a block when RAS_TIMING is set,
+    and recording it as a span when tracing is enabled.
+
+    Args:
+        label (str): Name printed with the timing.
+    """
+    start = time.perf_counter()
+    try:
+        with trace_span(label,"timing"):
+            yield
+    finally:
+        if TIMING_ENABLED:
+            print(f"[timing] {label}: {(time.perf_counter()-start)*1000:.1f} ms")
+
+def format_size(num_bytes: int):
+    """
+    Formats a byte count with a binary unit, e.g. 1.5 MiB.
     """
-    function_list = [(_cmd,None,{"as_root":as_root,"work_dir":work_dir}) for _cmd in commands]
-    return run_functions_in_threads(function_list)
+    size = float(num_bytes)
+    for unit in ("B","KiB","MiB","GiB"):
+        if abs(size) < 1024 or unit == "GiB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
 
 def get_display_var():
     """
     Retrieves the DISPLAY environment variable.
 
     Returns:
-        str: The value of DISPLAY from the environment.
+        str: The value of DISPLAY from the environment, None if unset (headless).
     """
-    return os.environ['DISPLAY']
+    return os.environ.get('DISPLAY') or None
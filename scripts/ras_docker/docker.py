@@ -1,10 +1,62 @@
-from .common import Path,partial,get_display_var,subprocess,ROS2_PKGS_PATH,get_docker_cmd_fmt,DockerCmdType
+from functools import partial
+from .common import Path,subprocess,WORKING_PATH,ROS2_PKGS_PATH,TaskExecutor,\
+        get_output_prefix,run_streamed,task_print
+from .docker_api import get_docker_client,DockerApiError,DockerUnavailable
+from .run_spec import DockerRunSpec,format_argv,is_dry_run
+from .host_probe import get_host_capabilities
 import json
-from dataclasses import dataclass
-import os
+from dataclasses import dataclass, asdict
+import shutil
+import sys
+import threading
+import time
+import yaml
 
 DOCKERHUB_REPO = "rasros2temp/ras"
 TAG_SUFFIX = "ras_local"
+RAS_CONF_PATH = WORKING_PATH/"configs"/"ras_conf.yaml"
+
+@dataclass
+class RegistryMirror:
+    """
+    Data class for a registry the images can be pulled from.
+
+    Attributes:
+        repo (str): Image repository, e.g. `192.168.1.10:5000/rasros2temp/ras`.
+        timeout (float): Seconds without pull progress before the next mirror
+            is tried, None to wait as long as the pull takes.
+    """
+    repo: str
+    timeout: float = None
+
+def get_registry_mirrors():
+    """
+    Reads the ordered registry list from ras.registry.mirrors in ras_conf.yaml.
+    Entries are a repository or a mapping with `repo` and `timeout`.
+
+    Returns:
+        list: RegistryMirror entries, only Docker Hub if none are configured.
+    """
+    try:
+        with RAS_CONF_PATH.open() as f:
+            conf = yaml.safe_load(f) or {}
+        entries = ((conf.get("ras") or {}).get("registry") or {}).get("mirrors") or []
+    except (OSError,yaml.YAMLError,AttributeError) as e:
+        if RAS_CONF_PATH.exists():
+            print(f"Warning: Could not read the registry mirrors from {RAS_CONF_PATH}: {e}")
+        entries = []
+    mirrors = []
+    for _entry in entries:
+        if isinstance(_entry,str):
+            mirrors.append(RegistryMirror(_entry))
+        elif isinstance(_entry,dict) and _entry.get("repo"):
+            timeout = _entry.get("timeout")
+            mirrors.append(RegistryMirror(str(_entry["repo"]),float(timeout) if timeout else None))
+        else:
+            print(f"Warning: Ignoring invalid registry mirror {_entry!r} in {RAS_CONF_PATH}")
+    if len(mirrors) == 0:
+        mirrors.append(RegistryMirror(DOCKERHUB_REPO))
+    return mirrors
 
 @dataclass
 class CoreDockerConf:
@@ -20,6 +72,27 @@ class CoreDockerConf:
     container_name: str
     work_dir: str
 
+def docker_image_inspect(image_tag: str):
+    """
+    Inspect a local Docker image by exact reference.
+
+    Args:
+        image_tag (str): The tag of the Docker image.
+
+    Returns:
+        dict: The image inspect data, or None if the image does not exist.
+    """
+    client = get_docker_client()
+    if client is not None:
+        try:
+            return client.image_inspect(image_tag)
+        except (DockerApiError,DockerUnavailable) as e:
+            print(f"Docker API unavailable, falling back to the CLI: {e}")
+    ret = subprocess.run(["docker", "image", "inspect", image_tag], capture_output=True)
+    if ret.returncode != 0:
+        return None
+    return json.loads(ret.stdout)[0]
+
 def docker_check_image_exists(image_tag: str):
     """
     Check if a Docker image with the given tag exists locally.
@@ -30,114 +103,827 @@ def docker_check_image_exists(image_tag: str):
     Returns:
         bool: True if the image exists, False otherwise.
     """
-    image_exists = False
-    images = subprocess.check_output(["docker", "images", "--format", "{{.Repository}}:{{.Tag}}"]).decode("utf-8").splitlines()
-    if image_tag in images:
-        image_exists = True
-        image_id = subprocess.check_output(["docker", "images", "--format", "{{.ID}}", "--filter", f"reference={image_tag}"]).decode("utf-8").strip()
-        print(f"Older Image ID: {image_id}")
-        print(f"Found Docker Image: {image_tag}")
-    return image_exists
+    image_info = docker_image_inspect(image_tag)
+    if image_info is None:
+        return False
+    print(f"Older Image ID: {image_info['Id']}")
+    print(f"Found Docker Image: {image_tag}")
+    return True
 
-def docker_pull_image(image_tag: str):
+def get_registry_digest(image_tag: str, timeout: float = None):
+    """
+    Resolve the manifest digest of an image tag in its registry.
+
+    Args:
+        image_tag (str): The remote image reference.
+        timeout (float, optional): Seconds to wait for the registry.
+
+    Returns:
+        str: The manifest digest, or None if it could not be resolved.
+    """
+    client = get_docker_client()
+    if client is None:
+        return None
+    try:
+        return client.distribution_inspect(image_tag, timeout=timeout)["Descriptor"]["digest"]
+    except (DockerApiError,DockerUnavailable,KeyError,TypeError):
+        return None
+
+class PullProgress:
+    """
+    Aggregates the layer progress of concurrent pulls into one status line.
+
+    Layers shared between images are counted once. Without a terminal only a
+    summary line per finished image is printed.
+    """
+    DONE_STATUSES = ("Pull complete", "Already exists")
+
+    def __init__(self, stream=None, interval=0.2):
+        self.stream = stream or sys.stdout
+        self.interval = interval
+        self.tty = self.stream.isatty()
+        self.layers = {}
+        self.images = {}
+        self.lock = threading.Lock()
+        self.last_render = 0.0
+
+    def update(self, image_tag: str, message: dict):
+        status = message.get("status", "")
+        layer_id = message.get("id")
+        with self.lock:
+            image_layers = self.images.setdefault(image_tag, set())
+            if (layer_id is None) or status.startswith("Pulling from"):
+                return
+            image_layers.add(layer_id)
+            layer = self.layers.setdefault(layer_id, {"done": False, "current": 0, "total": 0})
+            detail = message.get("progressDetail") or {}
+            if status == "Downloading" and detail.get("total"):
+                layer["current"], layer["total"] = detail.get("current", 0), detail["total"]
+            elif status == "Download complete":
+                layer["current"] = layer["total"]
+            elif status in self.DONE_STATUSES:
+                layer["done"] = True
+                layer["current"] = layer["total"]
+            self._render()
+
+    def _render(self, force=False):
+        if not self.tty:
+            return
+        now = time.monotonic()
+        if (not force) and (now - self.last_render < self.interval):
+            return
+        self.last_render = now
+        done = sum(1 for _l in self.layers.values() if _l["done"])
+        current = sum(_l["current"] for _l in self.layers.values()) / 1e6
+        total = sum(_l["total"] for _l in self.layers.values()) / 1e6
+        line = f"Pulling {len(self.images)} image(s): {done}/{len(self.layers)} layers, {current:.1f}/{total:.1f} MB"
+        self.stream.write(f"\r{line}\033[K")
+        self.stream.flush()
+
+    def image_done(self, image_tag: str, ok: bool, wall_time: float = None):
+        with self.lock:
+            layers = [self.layers[_id] for _id in self.images.get(image_tag, ()) if _id in self.layers]
+            size = sum(_l["total"] for _l in layers) / 1e6
+            if self.tty:
+                self.stream.write("\r\033[K")
+            state = "Pulled" if ok else "Failed to pull"
+            time_note = f" in {wall_time:.1f}s" if wall_time is not None else ""
+            self.stream.write(f"{state} {image_tag} ({len(layers)} layers, {size:.1f} MB downloaded{time_note})\n")
+            self._render(force=True)
+            self.stream.flush()
+
+    def finish(self):
+        with self.lock:
+            if self.tty:
+                self.stream.write("\r\033[K")
+                self.stream.flush()
+
+def is_auth_error(error: DockerApiError):
+    message = error.message.lower()
+    return (error.status in (401, 403)) or ("unauthorized" in message) or ("denied" in message)
+
+def docker_pull_image(image_tag: str, progress: PullProgress = None, timeout: float = None):
     """
     Pull a Docker image from a remote repository.
 
     Args:
         image_tag (str): The tag of the Docker image to pull.
+        progress (PullProgress, optional): Aggregated progress display to report to.
+        timeout (float, optional): Give up after this many seconds without progress.
+            The CLI fallback applies it to the whole pull.
 
     Returns:
         bool: True if the pull was successful, False otherwise.
     """
-    ret = subprocess.run(f"docker pull {image_tag}", shell=True)
+    client = get_docker_client()
+    if client is not None:
+        def _print_progress(message):
+            # only layer state changes, not the byte counters
+            if "progressDetail" in message and message.get("progressDetail"):
+                return
+            _id = f"{message['id']}: " if "id" in message else ""
+            print(f"{_id}{message.get('status','')}")
+        on_message = _print_progress if progress is None else partial(progress.update, image_tag)
+        try:
+            client.pull_image(image_tag, on_message=on_message, timeout=timeout)
+            return True
+        except DockerApiError as e:
+            if not is_auth_error(e):
+                print(f"Error: {e.message}")
+                return False
+            # the CLI may hold credentials the API client could not read
+            print(f"Registry refused {image_tag} ({e.message}), retrying with the docker CLI")
+        except DockerUnavailable as e:
+            print(f"Docker API unavailable, falling back to the CLI: {e}")
+    command = ["docker", "pull", image_tag]
+    if progress is not None:
+        # concurrent CLI pulls would interleave their progress bars
+        command.insert(2, "--quiet")
+    try:
+        ret = subprocess.run(command, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        print(f"Error: Pulling {image_tag} took longer than {timeout:.0f}s")
+        return False
     return ret.returncode == 0
 
-def pull_from_docker_repo(image_context: str, force=False):
+def docker_push_image(image_tag: str):
     """
-    Pull and tag a Docker image from the DockerHub repository.
+    Push a local image through the CLI, which holds the registry credentials.
+
+    Args:
+        image_tag (str): The reference to push.
+
+    Returns:
+        bool: True if the push was successful, False otherwise.
+    """
+    return run_streamed(["docker", "push", image_tag]).returncode == 0
+
+def docker_tag_image(image_tag: str, target_tag: str):
+    """
+    Tag a local Docker image.
+
+    Args:
+        image_tag (str): The existing image reference.
+        target_tag (str): The new reference.
+
+    Returns:
+        bool: True if the image was tagged, False otherwise.
+    """
+    client = get_docker_client()
+    if client is not None:
+        try:
+            client.tag_image(image_tag, target_tag)
+            return True
+        except DockerApiError as e:
+            print(f"Error: {e.message}")
+            return False
+        except DockerUnavailable:
+            pass
+    return subprocess.run(["docker", "tag", image_tag, target_tag]).returncode == 0
+
+def docker_remove_image(image_tag: str):
+    """
+    Remove a local image reference. Layers still used by other images are kept.
+
+    Args:
+        image_tag (str): The image reference to remove.
+
+    Returns:
+        bool: True if the reference was removed, False otherwise.
+    """
+    client = get_docker_client()
+    if client is not None:
+        try:
+            client.remove_image(image_tag, no_prune=True)
+            return True
+        except DockerApiError as e:
+            print(f"Error: {e.message}")
+            return False
+        except DockerUnavailable:
+            pass
+    return subprocess.run(["docker", "image", "rm", "--no-prune", image_tag], stdout=subprocess.DEVNULL).returncode == 0
+
+def docker_commit_container(container_name: str, image_tag: str):
+    """
+    Commit a container's changes to an image.
+
+    Args:
+        container_name (str): The name of the Docker container.
+        image_tag (str): The image reference to commit to.
+
+    Returns:
+        bool: True if the commit succeeded, False otherwise.
+    """
+    client = get_docker_client()
+    if client is not None:
+        try:
+            client.commit_container(container_name, image_tag)
+            return True
+        except DockerApiError as e:
+            print(f"Error: {e.message}")
+            return False
+        except DockerUnavailable:
+            pass
+    return subprocess.run(["docker", "commit", container_name, image_tag]).returncode == 0
+
+def docker_remove_container(container_name: str):
+    """
+    Remove a stopped Docker container.
+
+    Args:
+        container_name (str): The name of the Docker container.
+
+    Returns:
+        bool: True if the container was removed, False otherwise.
+    """
+    client = get_docker_client()
+    if client is not None:
+        try:
+            client.remove_container(container_name)
+            return True
+        except DockerApiError as e:
+            print(f"Error: {e.message}")
+            return False
+        except DockerUnavailable:
+            pass
+    return subprocess.run(["docker", "rm", container_name]).returncode == 0
+
+def image_has_digest(image_info: dict, digest: str):
+    return (digest is not None) and digest in [_d.partition("@")[2] for _d in image_info.get("RepoDigests") or []]
+
+def pull_from_docker_repo(image_context: str, force=False, progress: PullProgress = None, mirrors: list = None):
+    """
+    Pull and tag a Docker image, trying the configured registry mirrors in
+    order until one serves it.
+
+    A forced pull is skipped when the local image already has the registry's
+    manifest digest. The pulled image is tagged as the Docker Hub reference
+    as well, so it is found the same way whichever mirror served it.
 
     Args:
         image_context (str): The context/tag of the Docker image.
         force (bool, optional): Whether to force the pull even if the image exists. Defaults to False.
+        progress (PullProgress, optional): Aggregated progress display to report to.
+        mirrors (list, optional): RegistryMirror entries to try. Defaults to get_registry_mirrors().
+
+    Returns:
+        bool: True if the image is available locally, False if every mirror failed.
     """
     image_tag_local = f"{image_context}:ras_local"
     image_tag_remote = f"{DOCKERHUB_REPO}:{image_context}"
-    if force or (not docker_check_image_exists(image_tag_remote)):
-        print(f"Pulling Image: {image_tag_remote}")
-        if not docker_pull_image(image_tag_remote):
-            print(f"Error: Image {image_tag_remote} not found")
-            exit(1)
-        subprocess.run(f"docker tag {image_tag_remote} {image_tag_local}", shell=True)
-    else:
+    image_info = docker_image_inspect(image_tag_remote)
+    if (image_info is not None) and (not force):
         print(f"Image {image_tag_remote} already exists")
+        return True
+    if mirrors is None:
+        mirrors = get_registry_mirrors()
+    for _mirror in mirrors:
+        mirror_tag = f"{_mirror.repo}:{image_context}"
+        if image_info is not None:
+            remote_digest = get_registry_digest(mirror_tag, timeout=_mirror.timeout)
+            if image_has_digest(image_info, remote_digest):
+                print(f"Image {image_tag_remote} is up to date with {_mirror.repo} ({remote_digest[:19]})")
+                return docker_tag_image(image_tag_remote, image_tag_local)
+        print(f"Pulling Image: {mirror_tag}")
+        start = time.monotonic()
+        ok = docker_pull_image(mirror_tag, progress=progress, timeout=_mirror.timeout)
+        wall_time = time.monotonic() - start
+        if progress is not None:
+            progress.image_done(mirror_tag, ok, wall_time)
+        if ok:
+            task_print(f"{image_context} served by {_mirror.repo} in {wall_time:.1f}s")
+            if (mirror_tag != image_tag_remote) and not docker_tag_image(mirror_tag, image_tag_remote):
+                return False
+            return docker_tag_image(image_tag_remote, image_tag_local)
+        task_print(f"Warning: {_mirror.repo} did not serve {image_context}, trying the next mirror")
+    print(f"Error: Image {image_context} not found on any mirror ({', '.join(_m.repo for _m in mirrors)})")
+    return False
+
+def pull_images_from_docker_repo(image_contexts: list, force=False):
+    """
+    Pull several images from the registry mirrors concurrently, with one
+    aggregated progress display. Exits if any pull fails.
+
+    Args:
+        image_contexts (list): The contexts/tags of the Docker images.
+        force (bool, optional): Whether to force the pulls even if the images exist. Defaults to False.
+    """
+    progress = PullProgress()
+    mirrors = get_registry_mirrors()
+    with TaskExecutor(max_workers=len(image_contexts)) as executor:
+        for _context in image_contexts:
+            executor.submit(pull_from_docker_repo, _context, force, progress, mirrors, name=_context)
+        results = executor.wait()
+    progress.finish()
+    failed = [_r.name for _r in results if not _r.ok]
+    if len(failed) > 0:
+        print(f"Error: Failed to pull {', '.join(failed)}")
+        exit(1)
+
+def warm_registry_mirror(mirror: RegistryMirror, image_contexts: list, upstream: list):
+    """
+    Makes a mirror serve the current images: each image is first brought up
+    to date locally from the `upstream` mirrors, then pushed to the mirror.
+    A pull-through cache refuses pushes and is filled by pulling through it instead.
+
+    Args:
+        mirror (RegistryMirror): The mirror to populate.
+        image_contexts (list): The contexts/tags of the images.
+        upstream (list): RegistryMirror entries the images come from.
+
+    Returns:
+        bool: True if the mirror serves all images.
+    """
+    ok = True
+    for _context in image_contexts:
+        mirror_tag = f"{mirror.repo}:{_context}"
+        image_tag_remote = f"{DOCKERHUB_REPO}:{_context}"
+        if not pull_from_docker_repo(_context, force=True, mirrors=upstream):
+            ok = False
+            continue
+        image_info = docker_image_inspect(image_tag_remote)
+        if image_has_digest(image_info, get_registry_digest(mirror_tag, timeout=mirror.timeout)):
+            print(f"{mirror_tag} is up to date")
+            continue
+        if docker_tag_image(image_tag_remote, mirror_tag) and docker_push_image(mirror_tag):
+            print(f"Pushed {_context} to {mirror.repo}")
+            continue
+        print(f"Push to {mirror.repo} failed, filling it by pulling through it")
+        if docker_pull_image(mirror_tag, timeout=mirror.timeout):
+            print(f"Cached {_context} in {mirror.repo}")
+        else:
+            print(f"Error: Could not populate {mirror_tag}")
+            ok = False
+    return ok
+
+@dataclass
+class ContainerState:
+    """
+    Data class holding the known state of a container.
+
+    Attributes:
+        name (str): The container name.
+        status (str): created, running, paused, restarting, exited, dead or missing.
+        health (str): starting, healthy or unhealthy, None without a healthcheck.
+        exit_code (int): The last exit code, None while it has not exited.
+        container_id (str): The container id, None if missing.
+    """
+    name: str
+    status: str = "missing"
+    health: str = None
+    exit_code: int = None
+    container_id: str = None
+
+    @property
+    def running(self):
+        return self.status == "running"
+
+    @staticmethod
+    def from_inspect(container_name: str, info: dict):
+        # inspect also resolves id prefixes, only accept the exact name
+        if (info is None) or (info.get("Name") != f"/{container_name}"):
+            return ContainerState(container_name)
+        state = info.get("State", {})
+        health = None
+        if state.get("Health") and state.get("Status") == "running":
+            health = state["Health"].get("Status")
+        exit_code = None
+        if state.get("Status") in ("exited", "dead"):
+            exit_code = state.get("ExitCode")
+        return ContainerState(container_name, state.get("Status", "missing"), health, exit_code, info.get("Id"))
+
+    def __str__(self):
+        desc = self.status
+        if self.health:
+            desc += f" ({self.health})"
+        if self.exit_code is not None:
+            desc += f" (exit code {self.exit_code})"
+        return f"{self.name}: {desc}"
+
+def docker_container_inspect(container_name: str, size=False):
+    """
+    Inspect a Docker container by name.
+
+    Args:
+        container_name (str): The name of the Docker container.
+        size (bool, optional): Also compute SizeRw and SizeRootFs. Defaults to False.
+
+    Returns:
+        dict: The container inspect data, or None if it does not exist.
+    """
+    client = get_docker_client()
+    if client is not None:
+        try:
+            return client.container_inspect(container_name, size=size)
+        except (DockerApiError,DockerUnavailable) as e:
+            print(f"Docker API unavailable, falling back to the CLI: {e}")
+    command = ["docker", "container", "inspect"] + (["--size"] if size else []) + [container_name]
+    ret = subprocess.run(command, capture_output=True)
+    if ret.returncode != 0:
+        return None
+    return json.loads(ret.stdout)[0]
+
+# `docker diff` letters to the Kind values of the API
+DIFF_KINDS = {"C": 0, "A": 1, "D": 2}
+
+def docker_container_changes(container_name: str):
+    """
+    List the filesystem changes of a container against its image.
+
+    Args:
+        container_name (str): The name of the Docker container.
+
+    Returns:
+        list: Tuples of (path, kind) with kind 0 modified, 1 added, 2 deleted,
+            or None if the container does not exist.
+    """
+    client = get_docker_client()
+    if client is not None:
+        try:
+            return [(_c["Path"], _c["Kind"]) for _c in client.container_changes(container_name)]
+        except DockerApiError as e:
+            if e.status == 404:
+                return None
+            print(f"Docker API unavailable, falling back to the CLI: {e}")
+        except DockerUnavailable as e:
+            print(f"Docker API unavailable, falling back to the CLI: {e}")
+    ret = subprocess.run(["docker", "diff", container_name], capture_output=True)
+    if ret.returncode != 0:
+        return None
+    changes = []
+    for _line in ret.stdout.decode(errors="replace").splitlines():
+        kind, _, path = _line.partition(" ")
+        if kind in DIFF_KINDS and path:
+            changes.append((path, DIFF_KINDS[kind]))
+    return changes
+
+def docker_container_archive(container_name: str, path: str, out_file):
+    """
+    Write a tar archive of a path inside a container to a binary file.
+
+    Args:
+        container_name (str): The name of the Docker container.
+        path (str): Absolute path inside the container.
+        out_file: Writable binary file object.
+
+    Returns:
+        bool: True if the archive was written.
+    """
+    client = get_docker_client()
+    if client is not None:
+        try:
+            for _chunk in client.container_archive(container_name, path):
+                out_file.write(_chunk)
+            return True
+        except DockerApiError as e:
+            print(f"Failed to archive {path}: {e}")
+            return False
+        except DockerUnavailable as e:
+            print(f"Docker API unavailable, falling back to the CLI: {e}")
+            out_file.seek(0)
+            out_file.truncate()
+    ret = subprocess.run(["docker", "cp", f"{container_name}:{path}", "-"], stdout=out_file, stderr=subprocess.PIPE)
+    if ret.returncode != 0:
+        print(f"Failed to archive {path}: {ret.stderr.decode(errors='replace').strip()}")
+        return False
+    return True
+
+def docker_list_image_ids():
+    """
+    Lists the ids of all local images.
+
+    Returns:
+        list: The image ids, empty if docker is not reachable.
+    """
+    client = get_docker_client()
+    if client is not None:
+        try:
+            return [_image["Id"] for _image in client.list_images()]
+        except (DockerApiError,DockerUnavailable) as e:
+            print(f"Docker API unavailable, falling back to the CLI: {e}")
+    ret = subprocess.run(["docker", "image", "ls", "-q", "--no-trunc"], capture_output=True, text=True)
+    if ret.returncode != 0:
+        return []
+    return list(dict.fromkeys(ret.stdout.split()))
+
+def docker_image_save(image_refs: list, chunk_size: int = 1 << 20):
+    """
+    Yields a `docker save` tar archive of several images, in chunks.
+
+    Args:
+        image_refs (list): The images to save.
+        chunk_size (int, optional): Size of the chunks read from docker.
+
+    Raises:
+        DockerApiError: If docker fails to save the images.
+    """
+    client = get_docker_client()
+    if client is not None:
+        try:
+            yield from client.image_save(image_refs)
+            return
+        except DockerUnavailable as e:
+            print(f"Docker API unavailable, falling back to the CLI: {e}")
+    proc = subprocess.Popen(["docker", "save", *image_refs], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        while True:
+            chunk = proc.stdout.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        proc.stdout.close()
+        stderr = proc.stderr.read().decode(errors="replace").strip()
+        proc.stderr.close()
+        proc.wait()
+    if proc.returncode != 0:
+        raise DockerApiError(500, stderr or f"docker save exited with {proc.returncode}")
+
+def docker_exec_output(container_name: str, command: list, user_id=1000, work_dir: str = None):
+    """
+    Run a command in a running container without a terminal and capture its output.
+
+    Args:
+        container_name (str): The name of the Docker container.
+        command (list): The command and its arguments.
+        user_id (int, optional): The uid/gid to run as. Defaults to 1000.
+        work_dir (str, optional): The working directory inside the container.
+
+    Returns:
+        str: The standard output, or None if the command failed.
+    """
+    docker_cmd = ["docker", "exec", "-u", f"{user_id}:{user_id}"]
+    if work_dir is not None:
+        docker_cmd += ["-w", work_dir]
+    ret = subprocess.run(docker_cmd + [container_name] + list(command), capture_output=True)
+    if ret.returncode != 0:
+        print(f"Error: command failed in {container_name}: {ret.stderr.decode(errors='replace').strip()}")
+        return None
+    return ret.stdout.decode(errors="replace")
+
+def inspect_container_state(container_name: str):
+    """
+    Query the current state of a container by exact name.
+
+    Args:
+        container_name (str): The name of the Docker container.
+
+    Returns:
+        ContainerState: The container state, with status `missing` if it does not exist.
+    """
+    return ContainerState.from_inspect(container_name, docker_container_inspect(container_name))
+
+def stream_container_events(container_names: list, since: float, on_open=None):
+    """
+    Yield daemon events of the given containers, starting at `since`.
+    Uses a dedicated API connection, or `docker events` as the fallback.
+    `on_open` is called with a function that ends the stream from any thread.
+    """
+    client = get_docker_client()
+    filters = {"type": ["container"], "container": list(container_names)}
+    if client is not None:
+        try:
+            yield from client.stream_json("GET", "/events", params={"since": f"{since:.9f}", "filters": json.dumps(filters)},
+                                          on_open=on_open)
+            return
+        except DockerUnavailable:
+            pass
+    command = ["docker", "events", "--since", f"{since:.9f}", "--filter", "type=container", "--format", "{{json .}}"]
+    for _name in container_names:
+        command += ["--filter", f"container={_name}"]
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE)
+    if on_open is not None:
+        on_open(proc.kill)
+    try:
+        for line in proc.stdout:
+            if line.strip():
+                yield json.loads(line)
+    finally:
+        proc.kill()
+
+class ContainerStateView:
+    """
+    In-memory view of app container states.
+
+    Containers passed to `watch` are kept current from the daemon's event
+    stream, so lookups on them cost no request and changes are seen as soon
+    as the daemon reports them. Other containers are inspected on demand.
+    """
+    def __init__(self):
+        self.states = {}
+        self.watched = set()
+        self.callbacks = []
+        self.condition = threading.Condition()
+        self.watch_thread = None
+        self.watch_generation = 0
+        self.stop_watch = None
+
+    def get(self, container_name: str):
+        with self.condition:
+            if container_name in self.watched:
+                return self.states[container_name]
+        return inspect_container_state(container_name)
+
+    def is_running(self, container_name: str):
+        return self.get(container_name).running
+
+    def apply_event(self, event: dict):
+        """
+        Update the view from a daemon event. Returns the new state, or None if unchanged.
+        """
+        actor = event.get("Actor", {})
+        attributes = actor.get("Attributes", {})
+        name = attributes.get("name")
+        action = event.get("Action") or event.get("status") or ""
+        with self.condition:
+            if name not in self.watched:
+                return None
+            old = self.states[name]
+            state = ContainerState(name, old.status, old.health, old.exit_code, old.container_id)
+            if action == "create":
+                state = ContainerState(name, "created", container_id=actor.get("ID"))
+            elif action == "start":
+                state.status, state.health, state.exit_code = "running", None, None
+            elif action == "die":
+                state.status, state.health = "exited", None
+                if "exitCode" in attributes:
+                    state.exit_code = int(attributes["exitCode"])
+            elif action == "pause":
+                state.status = "paused"
+            elif action == "unpause":
+                state.status = "running"
+            elif action == "destroy":
+                state = ContainerState(name)
+            elif action.startswith("health_status"):
+                state.health = action.partition(":")[2].strip() or None
+            else:
+                return None
+            if state == old:
+                return None
+            self.states[name] = state
+            self.condition.notify_all()
+            callbacks = list(self.callbacks)
+        for callback in callbacks:
+            callback(state)
+        return state
+
+    def watch(self, container_names: list, on_change=None):
+        """
+        Start tracking containers from the event stream. Watching containers
+        not tracked yet restarts the stream with all watched containers.
+
+        Args:
+            container_names (list): Exact container names to track.
+            on_change (Callable, optional): Called with each new ContainerState.
+        """
+        since = time.time()
+        snapshot = {_name: inspect_container_state(_name) for _name in container_names if _name not in self.watched}
+        with self.condition:
+            if on_change is not None:
+                self.callbacks.append(on_change)
+            new_names = set(container_names) - self.watched
+            if (self.watch_thread is not None) and (len(new_names) == 0):
+                return
+            self.states.update({_name: snapshot[_name] for _name in new_names})
+            self.watched.update(new_names)
+            # the previous stream is closed now, the new one covers all containers
+            self.watch_generation += 1
+            if self.stop_watch is not None:
+                self.stop_watch()
+                self.stop_watch = None
+            # events since the snapshot are replayed, so nothing in between is lost
+            self.watch_thread = threading.Thread(target=self._watch_loop, args=(sorted(self.watched), since, self.watch_generation), daemon=True)
+            self.watch_thread.start()
+
+    def _set_stop_watch(self, generation: int, stop):
+        with self.condition:
+            if generation == self.watch_generation:
+                self.stop_watch = stop
+                return
+        # superseded while opening
+        stop()
+
+    def _watch_loop(self, container_names: list, since: float, generation: int):
+        events = stream_container_events(container_names, since, on_open=partial(self._set_stop_watch, generation))
+        try:
+            for event in events:
+                # applied before stopping, events the new stream replays are deduplicated by apply_event
+                self.apply_event(event)
+                if generation != self.watch_generation:
+                    break
+        except Exception:
+            # a stream closed mid-message by watch ends with a read error
+            if generation == self.watch_generation:
+                raise
+        finally:
+            events.close()
+
+    def wait(self, container_name: str, predicate, timeout: float = None):
+        """
+        Block until `predicate(state)` holds for a container, watching it first
+        if it is not watched yet.
+
+        Returns:
+            ContainerState: The matching state, or None on timeout.
+        """
+        if container_name not in self.watched:
+            self.watch([container_name])
+        with self.condition:
+            if self.condition.wait_for(lambda: predicate(self.states[container_name]), timeout):
+                return self.states[container_name]
+        return None
+
+CONTAINER_STATE_VIEW = ContainerStateView()
 
 def check_container_already_running(container_name):
     """
     Check if a Docker container is currently running.
 
     Args:
-        container_name (str): The name of the Docker container.
+        container_name (str): The exact name of the Docker container.
 
     Returns:
         bool: True if the container is running, False otherwise.
     """
-    command = ["docker", "ps", "--format", "{{.Names}}"]
-    output = subprocess.check_output(command).decode("utf-8")
-    return container_name in output
+    return CONTAINER_STATE_VIEW.is_running(container_name)
 
-def regen_docker_fmt(docker_cmd_fmt, core_conf: CoreDockerConf, allow_login=False):
+def watch_container_status(container_names: list, watch=False, as_json=False):
     """
-    Regenerate the Docker command format with updated configuration.
+    Print the state of containers, and with `watch` every change until interrupted.
 
     Args:
-        docker_cmd_fmt (Callable): The Docker command format function.
+        container_names (list): Exact container names.
+        watch (bool, optional): Follow the daemon event stream. Defaults to False.
+        as_json (bool, optional): Print JSON lines instead of text. Defaults to False.
+    """
+    def _print_state(state: ContainerState):
+        if as_json:
+            print(json.dumps(asdict(state)), flush=True)
+        else:
+            print(state, flush=True)
+    if not watch:
+        for _name in container_names:
+            _print_state(CONTAINER_STATE_VIEW.get(_name))
+        return
+    CONTAINER_STATE_VIEW.watch(container_names, on_change=_print_state)
+    for _name in container_names:
+        _print_state(CONTAINER_STATE_VIEW.get(_name))
+    try:
+        while CONTAINER_STATE_VIEW.watch_thread.is_alive():
+            CONTAINER_STATE_VIEW.watch_thread.join(1.0)
+    except KeyboardInterrupt:
+        pass
+
+def regen_run_spec(run_spec: DockerRunSpec, core_conf: CoreDockerConf, allow_login=False):
+    """
+    Resolve a run spec against the container state: commands exec into the
+    container if it is already running.
+
+    Args:
+        run_spec (DockerRunSpec): The run spec of the container.
         core_conf (CoreDockerConf): The Docker configuration.
         allow_login (bool, optional): Whether to allow attaching to running containers. Defaults to False.
 
     Returns:
-        Callable: A partial function for Docker command formatting, or None if blocked.
+        DockerRunSpec: A copy of the run spec, or None if blocked.
     """
+    run_spec = run_spec.copy()
+    run_spec.container_name = core_conf.container_name
+    run_spec.work_dir = core_conf.work_dir
+    run_spec.image_name = core_conf.image_name
     if check_container_already_running(core_conf.container_name):
         if not allow_login:
             print(f"Container {core_conf.container_name} is already running")
             print("This command is not allowed to run on a running container")
             return None
-        else:
-            docker_cmd_fmt = get_docker_cmd_fmt(DockerCmdType.ATTACH)
-    docker_cmd_fmt_new = partial(docker_cmd_fmt,
-                                 container_name=core_conf.container_name,
-                                 work_dir=core_conf.work_dir,
-                                 image_name=core_conf.image_name)
-    return docker_cmd_fmt_new
+        run_spec.attach = True
+    return run_spec
 
-def run_image_command_core(docker_command_fmt, command_str, as_root=False):
+def run_image_command_core(run_spec: DockerRunSpec, command: list, as_root=False):
     """
-    Execute a command inside a Docker container.
+    Execute a command inside a Docker container, or only print the docker
+    command in dry-run mode.
 
     Args:
-        docker_command_fmt (Callable): The formatted Docker command.
-        command_str (str): The command to run inside the container.
+        run_spec (DockerRunSpec): How the container is run or attached.
+        command (list): The command and its arguments to run inside the container.
         as_root (bool, optional): Whether to run the command as root. Defaults to False.
 
     Returns:
         bool: True if the command ran successfully, False otherwise.
     """
-    os.system("xhost +local:root")
     user_id = 1000
     if as_root:
         user_id = 0
-    docker_cmd = docker_command_fmt(
-        user_id=user_id,
-        command=command_str
-    )
-    assert isinstance(docker_cmd, str)
-    _cmd_elems = []
-    for _elem in docker_cmd.split(" "):
-        _elem = _elem.strip()
-        if len(_elem) > 0:
-            _cmd_elems.append(_elem)
-    print(f"Running Docker Command: {' '.join(_cmd_elems)}")
-    ret = subprocess.run(docker_cmd, shell=True)
+    # multiplexed output is piped, there is no terminal to attach
+    docker_cmd = run_spec.argv(command,user_id=user_id,tty=get_output_prefix() is None)
+    if is_dry_run():
+        task_print(format_argv(docker_cmd))
+        return True
+    if (get_host_capabilities().display is not None) and shutil.which("xhost"):
+        subprocess.run(["xhost","+local:root"],stdout=subprocess.DEVNULL)
+    task_print(f"Running Docker Command: {format_argv(docker_cmd)}")
+    ret = run_streamed(docker_cmd)
     return ret.returncode == 0
 
 def kill_docker_container(container_name):
@@ -149,6 +935,16 @@ def kill_docker_container(container_name):
     """
     if check_container_already_running(container_name):
         print(f"Killing Container: {container_name}")
-        subprocess.run(f"docker kill {container_name}", shell=True)
+        client = get_docker_client()
+        if client is not None:
+            try:
+                client.kill_container(container_name)
+                return
+            except DockerApiError as e:
+                print(f"Error: {e.message}")
+                return
+            except DockerUnavailable:
+                pass
+        subprocess.run(["docker", "kill", container_name])
     else:
         print(f"Container {container_name} is not running")
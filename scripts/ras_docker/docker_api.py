@@ -0,0 +1,473 @@
+"""
+Copyright (C) 2024 Harsh Davda
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+For inquiries or further information, you may contact:
+Harsh Davda
+Email: info@opensciencestack.org
+"""
+
+import base64
+import http.client
+import json
+import os
+import socket
+import subprocess
+import threading
+from functools import lru_cache, partial
+from pathlib import Path
+from urllib.parse import quote, unquote, urlencode
+from .trace import trace_span
+
+DEFAULT_DOCKER_SOCKET = "/var/run/docker.sock"
+DOCKER_HUB_AUTH_KEY = "https://index.docker.io/v1/"
+
+class DockerApiError(Exception):
+    """
+    Raised when the Docker Engine API answers with an error status.
+    """
+    def __init__(self, status: int, message: str):
+        super().__init__(f"Docker API error {status}: {message}")
+        self.status = status
+        self.message = message
+
+class DockerUnavailable(Exception):
+    """
+    Raised when the Docker Engine socket cannot be reached.
+    """
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    HTTPConnection talking to a Unix domain socket instead of TCP.
+    """
+    def __init__(self, socket_path: str, timeout: float = None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+def shutdown_connection(conn: http.client.HTTPConnection):
+    """
+    Shuts down the socket of a connection, so a read blocked on it in another thread returns.
+    """
+    sock = conn.sock
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+def split_image_ref(image_ref: str):
+    """
+    Splits an image reference into repository and tag.
+
+    Args:
+        image_ref (str): Reference like `repo/name:tag` or `host:5000/name`.
+
+    Returns:
+        tuple: (repository, tag), tag defaulting to `latest`.
+    """
+    repo, sep, tag = image_ref.rpartition(":")
+    if (not sep) or ("/" in tag):
+        return image_ref, "latest"
+    return repo, tag
+
+def get_registry_host(image_ref: str):
+    """
+    Returns the registry host of an image reference, `docker.io` for Docker Hub.
+    """
+    head, sep, _ = image_ref.partition("/")
+    if sep and (("." in head) or (":" in head) or (head == "localhost")) and (head != "index.docker.io"):
+        return head
+    return "docker.io"
+
+def _strip_server_url(server: str):
+    return server.split("://", 1)[-1].split("/", 1)[0]
+
+def read_credential_helper(helper: str, server: str):
+    """
+    Asks a docker credential helper for the credentials of a registry.
+
+    Returns:
+        dict: The helper answer with Username and Secret, or None.
+    """
+    try:
+        ret = subprocess.run([f"docker-credential-{helper}", "get"], input=server.encode(), capture_output=True, timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    if ret.returncode != 0:
+        return None
+    try:
+        return json.loads(ret.stdout)
+    except ValueError:
+        return None
+
+@lru_cache(maxsize=None)
+def get_registry_auth(registry: str):
+    """
+    Builds the X-Registry-Auth header for a registry from the `docker login`
+    credentials in ~/.docker/config.json (or DOCKER_CONFIG), including
+    credential helpers, like the docker CLI does for `docker pull`.
+
+    Args:
+        registry (str): Registry host, `docker.io` for Docker Hub.
+
+    Returns:
+        str: The encoded header value, or None when not logged in.
+    """
+    config_path = Path(os.environ.get("DOCKER_CONFIG", Path.home()/".docker"))/"config.json"
+    try:
+        config = json.loads(config_path.read_text())
+    except (OSError, ValueError):
+        return None
+    server = DOCKER_HUB_AUTH_KEY if registry == "docker.io" else registry
+    auth = None
+    helper = (config.get("credHelpers") or {}).get(registry) or config.get("credsStore")
+    if helper:
+        creds = read_credential_helper(helper, server)
+        if creds and creds.get("Secret"):
+            if creds.get("Username") == "<token>":
+                auth = {"identitytoken": creds["Secret"]}
+            else:
+                auth = {"username": creds.get("Username", ""), "password": creds["Secret"]}
+    if auth is None:
+        for _key, _entry in (config.get("auths") or {}).items():
+            if _strip_server_url(_key) != _strip_server_url(server):
+                continue
+            if _entry.get("identitytoken"):
+                auth = {"identitytoken": _entry["identitytoken"]}
+            elif _entry.get("auth"):
+                try:
+                    username, _, password = base64.b64decode(_entry["auth"]).decode().partition(":")
+                except ValueError:
+                    continue
+                auth = {"username": username, "password": password}
+            if auth is not None:
+                break
+    if auth is None:
+        return None
+    auth["serveraddress"] = server
+    return base64.urlsafe_b64encode(json.dumps(auth).encode()).decode()
+
+def get_registry_auth_headers(image_ref: str):
+    auth = get_registry_auth(get_registry_host(image_ref))
+    return {"X-Registry-Auth": auth} if auth else {}
+
+def get_span_name(method: str, path: str, params: dict = None):
+    if params:
+        path = f"{path}?{urlencode({k: v for k, v in params.items() if v is not None}, doseq=True)}"
+    return f"docker API {method} {unquote(path)}"
+
+class DockerEngineClient:
+    """
+    Minimal Docker Engine API client over the daemon's Unix socket.
+
+    A single keep-alive connection is reused for all requests, so each call
+    costs one HTTP round trip instead of a docker CLI process.
+    """
+    def __init__(self, socket_path: str = None, timeout: float = 30.0):
+        self.socket_path = socket_path or get_docker_socket_path()
+        self.timeout = timeout
+        self._conn = None
+        self._lock = threading.RLock()
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = UnixHTTPConnection(self.socket_path, timeout=self.timeout)
+        return self._conn
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _prepare(self, path: str, params: dict, body, headers: dict):
+        if params:
+            path = f"{path}?{urlencode({k: v for k, v in params.items() if v is not None}, doseq=True)}"
+        headers = dict(headers or {})
+        if body is not None and not isinstance(body, (bytes, str)):
+            body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        return path, body, headers
+
+    @staticmethod
+    def _check_response(resp):
+        if resp.status >= 400:
+            data = resp.read()
+            try:
+                message = json.loads(data).get("message", "")
+            except ValueError:
+                message = data.decode(errors="replace")
+            raise DockerApiError(resp.status, message)
+
+    def request(self, method: str, path: str, params: dict = None, body=None, headers: dict = None):
+        """
+        Sends a request on the shared connection and returns the decoded JSON body.
+
+        Raises:
+            DockerUnavailable: If the socket cannot be reached.
+            DockerApiError: If the daemon answers with a status >= 400.
+        """
+        path, body, headers = self._prepare(path, params, body, headers)
+        with trace_span(get_span_name(method, path), "docker-api") as span, self._lock:
+            for attempt in range(2):
+                conn = self._connection()
+                try:
+                    conn.request(method, path, body=body, headers=headers)
+                    resp = conn.getresponse()
+                    break
+                except (ConnectionError, http.client.HTTPException, OSError) as e:
+                    # a keep-alive connection closed by the daemon is retried once
+                    self.close()
+                    if attempt == 1:
+                        raise DockerUnavailable(f"Cannot reach docker at {self.socket_path}: {e}")
+            span["status"] = resp.status
+            self._check_response(resp)
+            data = resp.read()
+        if not data:
+            return None
+        try:
+            return json.loads(data)
+        except ValueError:
+            return data.decode(errors="replace")
+
+    def _open_stream(self, method: str, path: str, params: dict = None, headers: dict = None, timeout: float = None):
+        path, body, headers = self._prepare(path, params, None, headers)
+        conn = UnixHTTPConnection(self.socket_path, timeout=timeout)
+        try:
+            conn.request(method, path, headers=headers)
+            resp = conn.getresponse()
+        except TimeoutError:
+            conn.close()
+            raise DockerApiError(408, f"no response within {timeout:.0f}s")
+        except (ConnectionError, http.client.HTTPException, OSError) as e:
+            conn.close()
+            raise DockerUnavailable(f"Cannot reach docker at {self.socket_path}: {e}")
+        try:
+            self._check_response(resp)
+        except DockerApiError:
+            conn.close()
+            raise
+        return conn, resp
+
+    def stream_json(self, method: str, path: str, params: dict = None, headers: dict = None, timeout: float = None,
+                    on_open=None):
+        """
+        Yields JSON messages of a streaming endpoint (pull, events, ...).
+
+        Each stream uses its own connection, so streams run concurrently with
+        each other and with regular requests. With `timeout` the stream fails
+        when no message arrives for that many seconds. `on_open` is called with
+        a function that ends the stream from any thread, even while it waits.
+        """
+        with trace_span(get_span_name(method, path, params), "docker-api") as span:
+            conn, resp = self._open_stream(method, path, params, headers, timeout)
+            span["status"] = resp.status
+            if on_open is not None:
+                on_open(partial(shutdown_connection, conn))
+            try:
+                while True:
+                    try:
+                        line = resp.readline()
+                    except TimeoutError:
+                        raise DockerApiError(408, f"no progress for {timeout:.0f}s")
+                    if not line:
+                        break
+                    line = line.strip()
+                    if line:
+                        message = json.loads(line)
+                        if isinstance(message, dict) and "error" in message:
+                            # streams report failures in-band with a 200 status
+                            span["error"] = message["error"]
+                        yield message
+            finally:
+                conn.close()
+
+    def stream_raw(self, method: str, path: str, params: dict = None, headers: dict = None, chunk_size: int = 1 << 20):
+        """
+        Yields the raw body of an endpoint in chunks (archives, exports, ...),
+        on its own connection like stream_json.
+        """
+        with trace_span(get_span_name(method, path, params), "docker-api") as span:
+            conn, resp = self._open_stream(method, path, params, headers)
+            span["status"] = resp.status
+            try:
+                while True:
+                    chunk = resp.read(chunk_size)
+                    if not chunk:
+                        break
+                    span["bytes"] = span.get("bytes", 0) + len(chunk)
+                    yield chunk
+            finally:
+                conn.close()
+
+    def ping(self):
+        return self.request("GET", "/_ping") == "OK"
+
+    def image_inspect(self, image_ref: str):
+        """
+        Returns the inspect data of an image, or None if it does not exist.
+        """
+        try:
+            return self.request("GET", f"/images/{quote(image_ref, safe='')}/json")
+        except DockerApiError as e:
+            if e.status == 404:
+                return None
+            raise
+
+    def distribution_inspect(self, image_ref: str, timeout: float = None):
+        """
+        Returns the registry descriptor of an image without pulling it,
+        resolved by the daemon with the `docker login` credentials of the
+        user. With `timeout` it uses its own connection, so a slow registry
+        does not hold the shared one.
+        """
+        path = f"/distribution/{quote(image_ref, safe='')}/json"
+        headers = get_registry_auth_headers(image_ref)
+        if timeout is None:
+            return self.request("GET", path, headers=headers)
+        with trace_span(get_span_name("GET", path), "docker-api") as span:
+            conn, resp = self._open_stream("GET", path, headers=headers, timeout=timeout)
+            span["status"] = resp.status
+            try:
+                return json.loads(resp.read())
+            except TimeoutError:
+                raise DockerApiError(408, f"no response within {timeout:.0f}s")
+            finally:
+                conn.close()
+
+    def container_inspect(self, container_name: str, size=False):
+        """
+        Returns the inspect data of a container, or None if it does not exist.
+        With `size` the SizeRw/SizeRootFs fields are computed as well.
+        """
+        try:
+            return self.request("GET", f"/containers/{quote(container_name, safe='')}/json",
+                                params={"size": "1" if size else None})
+        except DockerApiError as e:
+            if e.status == 404:
+                return None
+            raise
+
+    def container_changes(self, container_name: str):
+        """
+        Returns the filesystem changes of a container as a list of
+        {"Path", "Kind"} with Kind 0 modified, 1 added, 2 deleted.
+        """
+        return self.request("GET", f"/containers/{quote(container_name, safe='')}/changes") or []
+
+    def container_archive(self, container_name: str, path: str):
+        """
+        Yields a tar archive of a path inside a container, in chunks.
+        """
+        return self.stream_raw("GET", f"/containers/{quote(container_name, safe='')}/archive", params={"path": path})
+
+    def list_images(self):
+        return self.request("GET", "/images/json") or []
+
+    def image_save(self, image_refs: list):
+        """
+        Yields a `docker save` tar archive of several images, in chunks.
+        """
+        return self.stream_raw("GET", "/images/get", params={"names": list(image_refs)})
+
+    def list_containers(self, filters: dict = None, all=False):
+        params = {"all": "1" if all else "0"}
+        if filters:
+            params["filters"] = json.dumps(filters)
+        return self.request("GET", "/containers/json", params=params)
+
+    def kill_container(self, container_name: str, signal: str = None):
+        self.request("POST", f"/containers/{quote(container_name, safe='')}/kill", params={"signal": signal})
+
+    def remove_container(self, container_name: str, force=False):
+        self.request("DELETE", f"/containers/{quote(container_name, safe='')}", params={"force": "1" if force else None})
+
+    def tag_image(self, image_ref: str, target_ref: str):
+        repo, tag = split_image_ref(target_ref)
+        self.request("POST", f"/images/{quote(image_ref, safe='')}/tag", params={"repo": repo, "tag": tag})
+
+    def remove_image(self, image_ref: str, no_prune=False):
+        self.request("DELETE", f"/images/{quote(image_ref, safe='')}", params={"noprune": "1" if no_prune else None})
+
+    def commit_container(self, container_name: str, target_ref: str, changes: list = None):
+        repo, tag = split_image_ref(target_ref)
+        params = {"container": container_name, "repo": repo, "tag": tag}
+        if changes:
+            params["changes"] = changes
+        return self.request("POST", "/commit", params=params)
+
+    def pull_image(self, image_ref: str, on_message=None, timeout: float = None):
+        """
+        Pulls an image with the `docker login` credentials of the user,
+        passing each progress message to `on_message`. Closing the stream on
+        `timeout` also cancels the pull in the daemon.
+
+        Raises:
+            DockerApiError: If the pull reports an error or stalls for `timeout` seconds.
+        """
+        repo, tag = split_image_ref(image_ref)
+        for message in self.stream_json("POST", "/images/create", params={"fromImage": repo, "tag": tag},
+                                        headers=get_registry_auth_headers(image_ref), timeout=timeout):
+            if "error" in message:
+                raise DockerApiError(500, message["error"])
+            if on_message is not None:
+                on_message(message)
+
+def get_docker_socket_path():
+    """
+    Resolves the daemon socket from DOCKER_HOST, defaulting to /var/run/docker.sock.
+    Returns None if DOCKER_HOST points to a non unix endpoint.
+    """
+    docker_host = os.environ.get("DOCKER_HOST", "")
+    if not docker_host:
+        return DEFAULT_DOCKER_SOCKET
+    if docker_host.startswith("unix://"):
+        return docker_host[len("unix://"):]
+    return None
+
+_docker_client = None
+_docker_client_checked = False
+_docker_client_lock = threading.Lock()
+
+def get_docker_client():
+    """
+    Returns a shared DockerEngineClient, or None if the socket is not usable
+    (the docker CLI is used as the fallback then). Set RAS_DOCKER_CLI=1 to
+    always use the CLI.
+    """
+    global _docker_client, _docker_client_checked
+    with _docker_client_lock:
+        if _docker_client_checked:
+            return _docker_client
+        _docker_client_checked = True
+        socket_path = get_docker_socket_path()
+        if os.environ.get("RAS_DOCKER_CLI", "0") not in ("", "0") or socket_path is None:
+            return None
+        if not os.path.exists(socket_path):
+            return None
+        client = DockerEngineClient(socket_path)
+        try:
+            if client.ping():
+                _docker_client = client
+        except (DockerUnavailable, DockerApiError):
+            client.close()
+        return _docker_client
@@ -0,0 +1,197 @@
+"""
+Copyright (C) 2024 Harsh Davda
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+For inquiries or further information, you may contact:
+Harsh Davda
+Email: info@opensciencestack.org
+"""
+
+from .common import Path,read_state,write_state
+from dataclasses import dataclass, field, asdict
+import json
+import os
+import threading
+
+# Bump when HostCapabilities changes, so older cache files are ignored
+PROBE_VERSION = 1
+DAEMON_CONFIG_PATH = "/etc/docker/daemon.json"
+NVIDIA_DRIVER_PATH = "/proc/driver/nvidia"
+DRI_PATH = "/dev/dri"
+X11_SOCKET_PATH = "/tmp/.X11-unix"
+WSLG_PATH = "/mnt/wslg"
+WSL_INTEROP_PATH = "/proc/sys/fs/binfmt_misc/WSLInterop"
+# The probe is redone when one of these changes (mtime, existence or value)
+PROBE_PATHS = [DAEMON_CONFIG_PATH,NVIDIA_DRIVER_PATH,DRI_PATH,X11_SOCKET_PATH,WSLG_PATH,WSL_INTEROP_PATH]
+PROBE_ENVVARS = ["DISPLAY","WAYLAND_DISPLAY","XDG_RUNTIME_DIR"]
+PROBE_STATE = "host_probe"
+
+@dataclass
+class HostCapabilities:
+    """
+    Data class holding what the host offers to app containers.
+
+    Attributes:
+        nvidia_runtime (bool): Docker has the nvidia runtime configured.
+        nvidia_driver (bool): The nvidia kernel driver is loaded.
+        daemon_config_error (str): Why daemon.json could not be read, None if fine or missing.
+        dri (bool): /dev/dri exists for Mesa GPU access.
+        display (str): Value of DISPLAY, None if unset.
+        x11_socket (bool): The X11 socket directory exists.
+        wayland_display (str): Value of WAYLAND_DISPLAY, None if unset.
+        xdg_runtime_dir (str): Value of XDG_RUNTIME_DIR, None if unset.
+        wslg (bool): The WSLg mount exists.
+        wsl (bool): Running in the Windows Subsystem for Linux.
+        passthrough_mounts (list): Resolved host display paths to mount as-is.
+        cpu_count (int): Number of CPUs.
+        mem_total_mb (int): Total memory in MiB, None if unknown.
+    """
+    nvidia_runtime: bool = False
+    nvidia_driver: bool = False
+    daemon_config_error: str = None
+    dri: bool = False
+    display: str = None
+    x11_socket: bool = False
+    wayland_display: str = None
+    xdg_runtime_dir: str = None
+    wslg: bool = False
+    wsl: bool = False
+    passthrough_mounts: list = field(default_factory=list)
+    cpu_count: int = 1
+    mem_total_mb: int = None
+
+    @property
+    def headless(self):
+        return (self.display is None) and (self.wayland_display is None)
+
+    @property
+    def gpu_mode(self):
+        if self.nvidia_runtime:
+            return "nvidia"
+        if self.dri:
+            return "dri"
+        return "none"
+
+    @property
+    def passthrough_env(self):
+        """Display variables passed through by name, with their host value."""
+        return [_name for _name, _value in (("WAYLAND_DISPLAY",self.wayland_display),
+                                            ("XDG_RUNTIME_DIR",self.xdg_runtime_dir)) if _value is not None]
+
+    def warnings(self):
+        warnings = []
+        if self.daemon_config_error:
+            warnings.append(f"Could not read {DAEMON_CONFIG_PATH}: {self.daemon_config_error}")
+        if self.nvidia_driver and not self.nvidia_runtime:
+            warnings.append("Nvidia driver found but docker has no nvidia runtime, please setup nvidia-ctk")
+        if self.headless:
+            warnings.append("No DISPLAY or WAYLAND_DISPLAY set, GUI windows will not open")
+        return warnings
+
+def read_mem_total_mb():
+    try:
+        with open("/proc/meminfo") as f:
+            for _line in f:
+                if _line.startswith("MemTotal:"):
+                    return int(_line.split()[1]) // 1024
+    except (OSError,ValueError,IndexError):
+        pass
+    return None
+
+def probe_host():
+    """
+    Detects the host capabilities, without the cache.
+
+    Returns:
+        HostCapabilities: The detected capabilities.
+    """
+    caps = HostCapabilities()
+    daemon_config_path = Path(DAEMON_CONFIG_PATH)
+    if daemon_config_path.exists():
+        try:
+            with daemon_config_path.open() as f:
+                config = json.load(f)
+            # Check if nvidia runtime is present in Docker's daemon config
+            caps.nvidia_runtime = "nvidia" in config.get("runtimes", {})
+        except (OSError,ValueError,AttributeError) as e:
+            caps.daemon_config_error = str(e)
+    caps.nvidia_driver = Path(NVIDIA_DRIVER_PATH).exists()
+    caps.dri = Path(DRI_PATH).is_dir()
+    caps.display = os.environ.get("DISPLAY") or None
+    caps.wayland_display = os.environ.get("WAYLAND_DISPLAY") or None
+    caps.xdg_runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or None
+    caps.x11_socket = Path(X11_SOCKET_PATH).is_dir()
+    caps.wslg = Path(WSLG_PATH).is_dir()
+    caps.wsl = Path(WSL_INTEROP_PATH).exists()
+    for _dir in (X11_SOCKET_PATH,WSLG_PATH):
+        _path = Path(_dir).absolute().resolve()
+        if _path.is_dir():
+            caps.passthrough_mounts.append(str(_path))
+    caps.cpu_count = os.cpu_count() or 1
+    caps.mem_total_mb = read_mem_total_mb()
+    return caps
+
+def get_probe_key():
+    """
+    The inputs of the probe: mtimes of the probed paths and display variables.
+    """
+    paths = {}
+    for _path in PROBE_PATHS:
+        try:
+            paths[_path] = os.stat(_path).st_mtime_ns
+        except OSError:
+            paths[_path] = None
+    return {
+        "version": PROBE_VERSION,
+        "paths": paths,
+        "env": {_name: os.environ.get(_name) for _name in PROBE_ENVVARS},
+    }
+
+_host_capabilities = None
+_host_capabilities_lock = threading.Lock()
+
+def get_host_capabilities(refresh=False, quiet=False):
+    """
+    Returns the host capabilities, probed once per process and cached in
+    .ras/host_probe.json until one of the probed paths or variables changes.
+
+    Args:
+        refresh (bool, optional): Probe again regardless of the cache. Defaults to False.
+        quiet (bool, optional): Do not print warnings of a new probe. Defaults to False.
+
+    Returns:
+        HostCapabilities: The host capabilities.
+    """
+    global _host_capabilities
+    with _host_capabilities_lock:
+        if (_host_capabilities is not None) and not refresh:
+            return _host_capabilities
+        key = get_probe_key()
+        cached = read_state(PROBE_STATE,None)
+        if (not refresh) and cached and cached.get("key") == key:
+            try:
+                _host_capabilities = HostCapabilities(**cached["capabilities"])
+                return _host_capabilities
+            except TypeError:
+                pass
+        _host_capabilities = probe_host()
+        if not quiet:
+            for _warning in _host_capabilities.warnings():
+                print(f"Warning: {_warning}")
+        try:
+            write_state(PROBE_STATE,{"key": key, "capabilities": asdict(_host_capabilities)})
+        except OSError:
+            pass
+        return _host_capabilities
@@ -0,0 +1,290 @@
+"""
+Copyright (C) 2024 Harsh Davda
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+For inquiries or further information, you may contact:
+Harsh Davda
+Email: info@opensciencestack.org
+"""
+
+from .common import WORKING_PATH,STATE_PATH,Path,subprocess,write_state,task_print,run_streamed
+from .docker import TAG_SUFFIX,docker_image_inspect
+from .run_spec import format_argv,is_dry_run
+from dataclasses import dataclass, field
+from functools import lru_cache
+import hashlib
+import json
+import os
+
+CONTEXT_PATH = WORKING_PATH/"context"
+LABEL_PREFIX = "org.ras.build"
+INPUTS_LABEL = f"{LABEL_PREFIX}.inputs"
+
+# Layer cache exported by BuildKit builds, one directory per image. It can be
+# copied to another machine to warm its builds without a registry.
+BUILD_CACHE_PATH = Path(os.environ.get("RAS_BUILD_CACHE",STATE_PATH/"build-cache"))
+BUILDX_BUILDER = "ras-builder"
+# auto: use buildx when available, 1: require it (fail without it), 0: plain docker build
+BUILDKIT_MODE = os.environ.get("RAS_BUILDKIT","auto")
+
+@lru_cache(maxsize=None)
+def use_buildx():
+    """
+    Checks whether builds go through buildx with an exportable layer cache.
+    """
+    if BUILDKIT_MODE == "0":
+        return False
+    return subprocess.run(["docker","buildx","version"],capture_output=True).returncode == 0
+
+@lru_cache(maxsize=None)
+def ensure_buildx_builder():
+    """
+    Creates the docker-container builder needed for local cache export, once.
+
+    Returns:
+        bool: True if the builder is available.
+    """
+    if subprocess.run(["docker","buildx","inspect",BUILDX_BUILDER],capture_output=True).returncode == 0:
+        return True
+    task_print(f"Creating buildx builder {BUILDX_BUILDER}")
+    ret = subprocess.run(["docker","buildx","create","--name",BUILDX_BUILDER,"--driver","docker-container"])
+    return ret.returncode == 0
+
+def hash_file(path: Path):
+    digest = hashlib.sha256()
+    with open(path,"rb") as f:
+        for chunk in iter(lambda: f.read(1<<20),b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def hash_context(context_path: Path):
+    """
+    Hashes the files of a build context, by relative path, exec bit and content.
+
+    Dockerfiles are left out since each image hashes only its own one, so
+    editing an app Dockerfile does not invalidate the base image.
+    """
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(context_path):
+        dirs.sort()
+        for _name in sorted(files):
+            if _name.startswith("Dockerfile"):
+                continue
+            _path = Path(root)/_name
+            rel_path = _path.relative_to(context_path).as_posix()
+            executable = os.access(_path,os.X_OK)
+            digest.update(f"{rel_path}\0{int(executable)}\0{hash_file(_path)}\n".encode())
+    return digest.hexdigest()
+
+@dataclass
+class ImageBuildSpec:
+    """
+    Data class describing how a local image is built.
+
+    Attributes:
+        image_tag (str): The tag of the built image.
+        dockerfile (Path): The Dockerfile of the image.
+        context_path (Path): The build context directory.
+        build_args (dict): Build arguments passed to docker build.
+        base_tag (str): Local image the Dockerfile builds FROM, if any.
+        base_spec (ImageBuildSpec): How the base image is built, used by buildx.
+        name (str): Short name used for the bake target and the cache directory.
+    """
+    image_tag: str
+    dockerfile: Path
+    context_path: Path = CONTEXT_PATH
+    build_args: dict = field(default_factory=dict)
+    base_tag: str = None
+    base_spec: "ImageBuildSpec" = None
+    name: str = None
+
+    @property
+    def cache_path(self):
+        return BUILD_CACHE_PATH/self.name
+
+    def input_hashes(self):
+        """
+        Hashes each build input. The base input is the id of the local base image.
+
+        Returns:
+            dict: Input name to hash, None for a missing base.
+        """
+        hashes = {
+            "dockerfile": hash_file(self.dockerfile),
+            "context": hash_context(self.context_path),
+            "build-args": hashlib.sha256(json.dumps(self.build_args,sort_keys=True).encode()).hexdigest(),
+        }
+        if self.base_tag is not None:
+            base_info = docker_image_inspect(self.base_tag)
+            hashes["base"] = base_info["Id"] if base_info else None
+        return hashes
+
+    @staticmethod
+    def combine_hashes(hashes: dict):
+        return hashlib.sha256(json.dumps(hashes,sort_keys=True).encode()).hexdigest()
+
+    def get_labels(self, hashes: dict):
+        labels = {f"{LABEL_PREFIX}.{_k}": _v for _k, _v in hashes.items() if _v is not None}
+        labels[INPUTS_LABEL] = self.combine_hashes(hashes)
+        return labels
+
+    def get_rebuild_reasons(self, image_info: dict, hashes: dict, force=False):
+        """
+        Decides whether the image must be rebuilt.
+
+        Returns:
+            tuple: (rebuild, reasons) with human readable reasons.
+        """
+        if force:
+            return True, ["--force given"]
+        if image_info is None:
+            return True, ["image does not exist"]
+        labels = (image_info.get("Config") or {}).get("Labels") or {}
+        if INPUTS_LABEL not in labels:
+            return False, ["image has no build hash (pulled or built by an older ras), use --force to rebuild it"]
+        reasons = []
+        for _name, _hash in hashes.items():
+            old_hash = labels.get(f"{LABEL_PREFIX}.{_name}")
+            if old_hash != _hash:
+                if _name == "base":
+                    reasons.append(f"base image changed ({str(old_hash)[:19]} -> {str(_hash)[:19]})")
+                else:
+                    reasons.append(f"{_name} changed")
+        if len(reasons) > 0:
+            return True, reasons
+        return False, [f"inputs unchanged ({labels[INPUTS_LABEL][:12]})"]
+
+    def get_build_command(self, hashes: dict):
+        command = ["docker","build","-t",self.image_tag,"-f",str(self.dockerfile)]
+        for _key, _value in self.build_args.items():
+            command += ["--build-arg",f"{_key}={_value}"]
+        for _key, _value in self.get_labels(hashes).items():
+            command += ["--label",f"{_key}={_value}"]
+        command.append(".")
+        return command
+
+    def get_bake_target(self, hashes: dict = None):
+        """
+        Describes the image as a buildx bake target with a local layer cache.
+        Without hashes the target only serves as a base for other targets.
+        """
+        target = {
+            "context": str(self.context_path),
+            "dockerfile": str(self.dockerfile),
+            "args": dict(self.build_args),
+            "cache-from": [],
+        }
+        for _spec in (self, self.base_spec):
+            if (_spec is not None) and (_spec.cache_path/"index.json").exists():
+                target["cache-from"].append(f"type=local,src={_spec.cache_path}")
+        if hashes is not None:
+            target["tags"] = [self.image_tag]
+            target["labels"] = self.get_labels(hashes)
+            target["cache-to"] = [f"type=local,dest={self.cache_path},mode=max"]
+            target["output"] = ["type=docker"]
+        return target
+
+    def has_foreign_base(self):
+        """
+        Checks whether the local base image was not built by ras (pulled, or
+        imported with `ras load`). The buildx container builder cannot see
+        the local image store, so such a base must be built FROM directly.
+        """
+        if self.base_spec is None:
+            return False
+        base_info = docker_image_inspect(self.base_tag)
+        labels = ((base_info or {}).get("Config") or {}).get("Labels") or {}
+        return (base_info is not None) and (INPUTS_LABEL not in labels)
+
+    def get_bake_file(self, hashes: dict):
+        targets = {self.name: self.get_bake_target(hashes)}
+        if self.base_spec is not None:
+            targets[self.name]["contexts"] = {self.base_tag: f"target:{self.base_spec.name}"}
+            targets[self.base_spec.name] = self.base_spec.get_bake_target()
+        return {"target": targets}
+
+    def build(self, hashes: dict):
+        """
+        Builds the image with buildx bake and the local layer cache, or with
+        plain `docker build` (BuildKit enabled) if buildx is unavailable or the
+        base image only exists in the local image store.
+        In dry-run mode the docker build command is only printed.
+        """
+        if is_dry_run():
+            task_print(format_argv(self.get_build_command(hashes)))
+            return True
+        buildx = use_buildx() and ensure_buildx_builder()
+        if (not buildx) and (BUILDKIT_MODE == "1"):
+            task_print("Error: RAS_BUILDKIT=1 but docker buildx is not available")
+            return False
+        if buildx and self.has_foreign_base():
+            task_print(f"[build] {self.base_tag} was not built locally, building {self.image_tag} on it without the layer cache")
+            buildx = False
+        if buildx:
+            bake_name = f"bake-{self.name}"
+            write_state(bake_name,self.get_bake_file(hashes))
+            self.cache_path.mkdir(parents=True,exist_ok=True)
+            command = ["docker","buildx","bake","--builder",BUILDX_BUILDER,"-f",str(STATE_PATH/f"{bake_name}.json"),self.name]
+            ret = run_streamed(command,cwd=str(self.context_path))
+        else:
+            command = self.get_build_command(hashes)
+            ret = run_streamed(command,cwd=str(self.context_path),env={**os.environ,"DOCKER_BUILDKIT":"1"})
+        return ret.returncode == 0
+
+def get_base_build_spec():
+    return ImageBuildSpec(f"ras_base:{TAG_SUFFIX}",CONTEXT_PATH/"Dockerfile.base",name="base")
+
+def get_app_build_spec(app: str):
+    return ImageBuildSpec(f"ras_{app}_app:{TAG_SUFFIX}",CONTEXT_PATH/"apps"/f"Dockerfile.{app}",
+                          base_tag=f"ras_base:{TAG_SUFFIX}",base_spec=get_base_build_spec(),name=app)
+
+def ensure_image(spec: ImageBuildSpec, force=False):
+    """
+    Builds an image only if its inputs changed since it was built, printing
+    why it was rebuilt or skipped.
+
+    Args:
+        spec (ImageBuildSpec): The image to build.
+        force (bool, optional): Rebuild regardless of the inputs. Defaults to False.
+
+    Returns:
+        bool: False if the build failed, True otherwise.
+    """
+    hashes = spec.input_hashes()
+    rebuild, reasons = spec.get_rebuild_reasons(docker_image_inspect(spec.image_tag),hashes,force)
+    if not rebuild:
+        task_print(f"[build] Skipping {spec.image_tag}: {'; '.join(reasons)}")
+        return True
+    task_print(f"*****Building Docker Image: {spec.image_tag} ({'; '.join(reasons)})*****")
+    if not spec.build(hashes):
+        task_print(f"Error: Failed to build {spec.image_tag}")
+        return False
+    return True
+
+def ensure_app_images(app: str, force=False):
+    """
+    Brings the base and app images up to date. The base is rebuilt only when
+    its own inputs change; the app also when the base image changed.
+
+    Args:
+        app (str): The app namespace (robot/server).
+        force (bool, optional): Rebuild the app image regardless of its inputs. Defaults to False.
+
+    Returns:
+        bool: True if both images are available and up to date.
+    """
+    if not ensure_image(get_base_build_spec()):
+        return False
+    return ensure_image(get_app_build_spec(app),force=force)
@@ -0,0 +1,501 @@
+"""
+Copyright (C) 2024 Harsh Davda
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+For inquiries or further information, you may contact:
+Harsh Davda
+Email: info@opensciencestack.org
+"""
+
+from .common import Path,subprocess,TaskExecutor,STATE_PATH,read_state,write_state,format_size
+from .docker import docker_image_inspect,docker_image_save,docker_list_image_ids,docker_tag_image
+from .docker_api import DockerApiError
+from collections import deque
+from hashlib import sha256
+import io
+import json
+import os
+import posixpath
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+
+# Bump when the archive layout changes, older archives are then refused
+TRANSPORT_VERSION = 1
+TRANSPORT_CHUNK_SIZE = 16 << 20
+ZSTD_LEVEL = int(os.environ.get("RAS_ZSTD_LEVEL","3"))
+TRANSPORT_JOBS = int(os.environ.get("RAS_JOBS",os.cpu_count() or 1))
+MANIFEST_NAME = "manifest.json"
+INVENTORY_VERSION = 1
+# Members of a docker save archive kept in memory to read the image layout
+SMALL_MEMBER_SIZE = 1 << 20
+
+def check_zstd():
+    if shutil.which("zstd") is None:
+        print("Error: zstd not found, please install it (sudo apt install zstd)")
+        return False
+    return True
+
+def get_chain_ids(diff_ids: list):
+    """
+    Computes the chain id of every layer, which identifies a layer together
+    with all layers below it, the way docker stores them.
+    """
+    chain_ids = []
+    chain_id = None
+    for _diff_id in diff_ids:
+        chain_id = _diff_id if chain_id is None else "sha256:" + sha256(f"{chain_id} {_diff_id}".encode()).hexdigest()
+        chain_ids.append(chain_id)
+    return chain_ids
+
+def get_local_chain_ids():
+    """
+    Returns the chain ids of all layers of all local images.
+    """
+    chain_ids = set()
+    for _image_id in docker_list_image_ids():
+        info = docker_image_inspect(_image_id)
+        if info is not None:
+            chain_ids.update(get_chain_ids((info.get("RootFS") or {}).get("Layers") or []))
+    return chain_ids
+
+def write_inventory(path: Path):
+    """
+    Writes the layers this machine already has, for `ras <app> save --skip-from`.
+    """
+    chain_ids = sorted(get_local_chain_ids())
+    with Path(path).open("w") as f:
+        json.dump({"version": INVENTORY_VERSION, "chain_ids": chain_ids},f,indent=2)
+    print(f"Wrote {len(chain_ids)} layers to {path}")
+
+def read_inventory(path: Path):
+    with Path(path).open() as f:
+        inventory = json.load(f)
+    if inventory.get("version") != INVENTORY_VERSION:
+        raise ValueError(f"unsupported inventory version {inventory.get('version')}")
+    return set(inventory["chain_ids"])
+
+class ChunkReader(io.RawIOBase):
+    """
+    Read-only binary stream over an iterator of byte chunks. Reads fill the
+    buffer across chunk boundaries, tarfile treats a short read as the end of data.
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b""
+        self._offset = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        view = memoryview(b).cast("B")
+        size = 0
+        while size < len(view):
+            if self._offset >= len(self._buffer):
+                self._buffer = next(self._chunks,b"")
+                self._offset = 0
+                if not self._buffer:
+                    break
+            count = min(len(view)-size,len(self._buffer)-self._offset)
+            view[size:size+count] = self._buffer[self._offset:self._offset+count]
+            self._offset += count
+            size += count
+        return size
+
+def iter_file_chunks(fileobj, size: int, chunk_size: int = None):
+    chunk_size = chunk_size or TRANSPORT_CHUNK_SIZE
+    while size > 0:
+        data = fileobj.read(min(chunk_size,size))
+        if not data:
+            raise EOFError("archive ended early")
+        size -= len(data)
+        yield data
+
+def get_blob_digest(member_name: str):
+    """
+    Returns the digest of an OCI layout blob from its name, None for other members.
+    """
+    head, _, digest = member_name.rpartition("/")
+    if head.endswith("blobs/sha256") and len(digest) == 64:
+        return f"sha256:{digest}"
+    return None
+
+def get_chunk_path(archive_path: Path, chunk_id: str):
+    return archive_path/"chunks"/f"{chunk_id}.zst"
+
+def compress_chunk(data: bytes, chunk_path: Path):
+    """
+    Compresses a chunk with zstd, written under a temporary name first so an
+    interrupted save never leaves a truncated chunk behind.
+    """
+    tmp_path = chunk_path.with_name(f".{chunk_path.name}.{threading.get_ident()}.tmp")
+    with tmp_path.open("wb") as f:
+        ret = subprocess.run(["zstd","-q",f"-{ZSTD_LEVEL}","-c"],input=data,stdout=f)
+    if ret.returncode != 0:
+        tmp_path.unlink(missing_ok=True)
+        raise RuntimeError(f"zstd failed on {chunk_path.name}")
+    tmp_path.replace(chunk_path)
+    return chunk_path.stat().st_size
+
+def decompress_chunk(chunk_path: Path):
+    ret = subprocess.run(["zstd","-q","-d","-c",str(chunk_path)],capture_output=True)
+    if ret.returncode != 0:
+        raise RuntimeError(ret.stderr.decode(errors="replace").strip() or f"zstd failed on {chunk_path.name}")
+    return ret.stdout
+
+def verify_chunk(archive_path: Path, chunk_id: str, size: int):
+    """
+    Checks that a chunk exists and decompresses to the content it is named after.
+
+    Returns:
+        str: What is wrong with the chunk, None if it is fine.
+    """
+    chunk_path = get_chunk_path(archive_path,chunk_id)
+    if not chunk_path.exists():
+        return "missing"
+    try:
+        data = decompress_chunk(chunk_path)
+    except RuntimeError as e:
+        return str(e)
+    if (len(data) != size) or (sha256(data).hexdigest() != chunk_id):
+        return "checksum mismatch"
+    return None
+
+def save_images(image_refs: list, archive_path: Path, skip_chain_ids: set = None):
+    """
+    Exports images into a directory of zstd compressed, content addressed
+    chunks and a manifest. Chunks are compressed on all cores, chunks already
+    in the directory are kept, so an interrupted save continues where it
+    stopped. Layers whose chain is in `skip_chain_ids` are left out.
+
+    Args:
+        image_refs (list): The images to export, base images first.
+        archive_path (Path): The archive directory.
+        skip_chain_ids (set, optional): Layers the target machine already has.
+
+    Returns:
+        bool: True if the archive was written.
+    """
+    if not check_zstd():
+        return False
+    skip_chain_ids = skip_chain_ids or set()
+    images = []
+    diff_chains = {}
+    for _ref in image_refs:
+        info = docker_image_inspect(_ref)
+        if info is None:
+            print(f"Error: Image {_ref} not found")
+            return False
+        diff_ids = (info.get("RootFS") or {}).get("Layers") or []
+        chain_ids = get_chain_ids(diff_ids)
+        for _diff_id, _chain_id in zip(diff_ids,chain_ids):
+            diff_chains.setdefault(_diff_id,set()).add(_chain_id)
+        images.append({"ref": _ref, "id": info["Id"], "diff_ids": diff_ids, "chain_ids": chain_ids})
+    # a layer shared by several images is only left out if every image can do without it
+    skip_diff_ids = {_diff_id for _diff_id, _chains in diff_chains.items() if _chains <= skip_chain_ids}
+    (archive_path/"chunks").mkdir(parents=True,exist_ok=True)
+    (archive_path/MANIFEST_NAME).unlink(missing_ok=True)
+
+    files = {}
+    small_members = {}
+    stats = {"size": 0, "skipped": 0, "written": 0, "compressed": 0, "reused": 0}
+    stats_lock = threading.Lock()
+    pending = threading.BoundedSemaphore(TRANSPORT_JOBS*2)
+    scheduled = set()
+    errors = []
+    start = time.perf_counter()
+
+    def _on_compressed(result):
+        with stats_lock:
+            if result.ok:
+                stats["compressed"] += result.value
+            else:
+                errors.append(result.error)
+        pending.release()
+
+    print(f"Saving {', '.join(image_refs)} to {archive_path}")
+    with TaskExecutor(max_workers=TRANSPORT_JOBS) as executor:
+        try:
+            with tarfile.open(fileobj=ChunkReader(docker_image_save(image_refs)),mode="r|") as tar:
+                for _member in tar:
+                    if _member.issym() or _member.islnk():
+                        files[_member.name] = {"link": posixpath.normpath(posixpath.join(posixpath.dirname(_member.name),_member.linkname))
+                                               if _member.issym() else _member.linkname}
+                        continue
+                    if not _member.isreg():
+                        continue
+                    fileobj = tar.extractfile(_member)
+                    entry = {"size": _member.size, "mode": _member.mode, "mtime": int(_member.mtime)}
+                    files[_member.name] = entry
+                    stats["size"] += _member.size
+                    digest = get_blob_digest(_member.name)
+                    spool = None
+                    if skip_diff_ids and (digest is None) and _member.name.endswith("/layer.tar"):
+                        # the legacy layout does not name layers by digest, hash them before compressing
+                        spool = tempfile.TemporaryFile(dir=archive_path)
+                        hasher = sha256()
+                        for _data in iter_file_chunks(fileobj,_member.size):
+                            hasher.update(_data)
+                            spool.write(_data)
+                        spool.seek(0)
+                        fileobj = spool
+                        digest = f"sha256:{hasher.hexdigest()}"
+                    if digest in skip_diff_ids:
+                        entry["skipped"] = digest
+                        stats["skipped"] += _member.size
+                        if spool is not None:
+                            spool.close()
+                        continue
+                    entry["chunks"] = []
+                    for _data in iter_file_chunks(fileobj,_member.size):
+                        if _member.size <= SMALL_MEMBER_SIZE:
+                            small_members[_member.name] = _data
+                        chunk_id = sha256(_data).hexdigest()
+                        entry["chunks"].append([chunk_id,len(_data)])
+                        chunk_path = get_chunk_path(archive_path,chunk_id)
+                        if (chunk_id in scheduled) or chunk_path.exists():
+                            stats["reused"] += len(_data)
+                            continue
+                        scheduled.add(chunk_id)
+                        stats["written"] += len(_data)
+                        pending.acquire()
+                        if errors:
+                            raise RuntimeError(f"Failed to compress a chunk: {errors[0]}")
+                        executor.submit(compress_chunk,_data,chunk_path,name=chunk_id,on_done=_on_compressed)
+                    if spool is not None:
+                        spool.close()
+        except (tarfile.TarError,EOFError,DockerApiError,RuntimeError) as e:
+            executor.cancel()
+            print(f"Error: Failed to save the images: {e}")
+            return False
+        executor.wait()
+    if errors:
+        print(f"Error: Failed to compress {len(errors)} chunks: {errors[0]}")
+        return False
+
+    try:
+        docker_manifest = json.loads(small_members[MANIFEST_NAME])
+    except (KeyError,ValueError):
+        print("Error: docker save archive has no manifest.json")
+        return False
+    requires = set()
+    for _image in images:
+        id_hex = _image["id"].partition(":")[2]
+        entries = [_m for _m in docker_manifest if id_hex in _m.get("Config","")]
+        if len(entries) == 0 or len(entries[0].get("Layers",[])) != len(_image["diff_ids"]):
+            print(f"Error: {_image['ref']} is missing in the docker save archive")
+            return False
+        _image["manifest"] = entries[0]
+        _image["layers"] = [{"name": _name, "diff_id": _diff_id, "chain_id": _chain_id}
+                            for _name, _diff_id, _chain_id in zip(entries[0]["Layers"],_image.pop("diff_ids"),_image.pop("chain_ids"))]
+        for _layer in _image["layers"]:
+            if _layer["diff_id"] in skip_diff_ids:
+                requires.add(_layer["chain_id"])
+    manifest = {
+        "version": TRANSPORT_VERSION,
+        "created": int(time.time()),
+        "chunk_size": TRANSPORT_CHUNK_SIZE,
+        "images": images,
+        "files": files,
+        "requires": sorted(requires),
+    }
+    tmp_path = archive_path/f".{MANIFEST_NAME}.tmp"
+    with tmp_path.open("w") as f:
+        json.dump(manifest,f,indent=1)
+    tmp_path.replace(archive_path/MANIFEST_NAME)
+
+    print(f"Saved {format_size(stats['size'])} in {time.perf_counter()-start:.1f} s: "
+          f"{format_size(stats['written'])} compressed to {format_size(stats['compressed'])}, "
+          f"{format_size(stats['reused'])} already in the archive, "
+          f"{format_size(stats['skipped'])} of layers the target has left out")
+    return True
+
+def read_manifest(archive_path: Path):
+    try:
+        with (archive_path/MANIFEST_NAME).open() as f:
+            manifest = json.load(f)
+    except (OSError,ValueError) as e:
+        print(f"Error: {archive_path} is not a complete ras image archive ({e}), run save again")
+        return None
+    if manifest.get("version") != TRANSPORT_VERSION:
+        print(f"Error: Unsupported archive version {manifest.get('version')}, save it again with this version of ras")
+        return None
+    return manifest
+
+def resolve_file(manifest: dict, name: str):
+    """
+    Follows links in the archive to the entry holding the content.
+    """
+    files = manifest["files"]
+    for _ in range(len(files)):
+        entry = files.get(name)
+        if (entry is None) or ("link" not in entry):
+            return entry
+        name = entry["link"]
+    return None
+
+def get_load_state_name(manifest: dict):
+    # saving the same images again gives the same key, so verified chunks stay verified
+    key = sha256(json.dumps([manifest["images"],manifest["files"]],sort_keys=True).encode()).hexdigest()[:16]
+    return f"image_load_{key}"
+
+def verify_chunks(archive_path: Path, chunks: dict, state_name: str):
+    """
+    Verifies chunks on all cores. Verified chunks are remembered in the state,
+    so a load interrupted after verifying does not check them again.
+
+    Returns:
+        bool: True if all chunks are fine.
+    """
+    state = read_state(state_name,{}) or {}
+    verified = set(state.get("verified",[]))
+    todo = {_id: _size for _id, _size in chunks.items() if _id not in verified}
+    if len(todo) == 0:
+        return True
+    print(f"Verifying {len(todo)} chunks ({len(chunks)-len(todo)} verified before)")
+    lock = threading.Lock()
+
+    def _on_verified(result):
+        if result.ok and result.value is None:
+            with lock:
+                verified.add(result.name)
+
+    try:
+        with TaskExecutor(max_workers=TRANSPORT_JOBS) as executor:
+            for _id, _size in todo.items():
+                executor.submit(verify_chunk,archive_path,_id,_size,name=_id,on_done=_on_verified)
+            results = executor.wait()
+    finally:
+        write_state(state_name,{"verified": sorted(verified)})
+    bad = [_r for _r in results if not (_r.ok and _r.value is None)]
+    for _result in bad[:10]:
+        print(f"  chunks/{_result.name}.zst: {_result.value or _result.error}")
+    if len(bad) > 0:
+        print(f"Error: {len(bad)} chunks are missing or damaged, copy them again from the saved archive and rerun load")
+        return False
+    return True
+
+def iter_decompressed(archive_path: Path, chunk_ids: list):
+    """
+    Yields the content of chunks in order, decompressing the next ones ahead on all cores.
+    """
+    with TaskExecutor(max_workers=TRANSPORT_JOBS) as executor:
+        ahead = deque()
+        chunk_ids = iter(chunk_ids)
+        for _id in chunk_ids:
+            ahead.append(executor.submit(decompress_chunk,get_chunk_path(archive_path,_id),name=_id))
+            if len(ahead) >= TRANSPORT_JOBS*2:
+                break
+        while ahead:
+            result = ahead.popleft().result()
+            if not result.ok:
+                raise RuntimeError(f"Failed to decompress chunks/{result.name}.zst: {result.error}")
+            _id = next(chunk_ids,None)
+            if _id is not None:
+                ahead.append(executor.submit(decompress_chunk,get_chunk_path(archive_path,_id),name=_id))
+            yield result.value
+
+def load_image(archive_path: Path, manifest: dict, image: dict, local_chain_ids: set):
+    """
+    Streams one image into `docker load`, without the layers docker already has.
+
+    Returns:
+        bool: True if the image was loaded.
+    """
+    names = [image["manifest"]["Config"]]
+    for _layer in image["layers"]:
+        if _layer["chain_id"] not in local_chain_ids:
+            names.append(_layer["name"])
+    chunk_ids = []
+    for _name in names:
+        entry = resolve_file(manifest,_name)
+        if (entry is None) or ("skipped" in entry):
+            print(f"Error: {_name} is not in the archive and {image['ref']} needs it, save again without --skip-from")
+            return False
+        chunk_ids += [_id for _id, _ in entry["chunks"]]
+    proc = subprocess.Popen(["docker","load"],stdin=subprocess.PIPE)
+    try:
+        content = ChunkReader(iter_decompressed(archive_path,chunk_ids))
+        with tarfile.open(fileobj=proc.stdin,mode="w|") as tar:
+            data = json.dumps([image["manifest"]]).encode()
+            info = tarfile.TarInfo(MANIFEST_NAME)
+            info.size = len(data)
+            tar.addfile(info,io.BytesIO(data))
+            for _name in names:
+                entry = resolve_file(manifest,_name)
+                info = tarfile.TarInfo(_name)
+                info.size, info.mode, info.mtime = entry["size"], entry["mode"], entry["mtime"]
+                tar.addfile(info,content)
+        proc.stdin.close()
+    except (BrokenPipeError,RuntimeError) as e:
+        print(f"Error: {e}")
+        proc.kill()
+        proc.wait()
+        return False
+    return proc.wait() == 0
+
+def load_images(archive_path: Path):
+    """
+    Loads the images of an archive written by save_images and tags them.
+
+    Chunks are verified before anything is loaded, images are loaded one at a
+    time and images or layers docker already has are not loaded again, so
+    rerunning an interrupted load continues where it stopped.
+
+    Args:
+        archive_path (Path): The archive directory.
+
+    Returns:
+        bool: True if all images were loaded and tagged.
+    """
+    if not check_zstd():
+        return False
+    manifest = read_manifest(archive_path)
+    if manifest is None:
+        return False
+    local_chain_ids = get_local_chain_ids()
+    missing = [_c for _c in manifest["requires"] if _c not in local_chain_ids]
+    if len(missing) > 0:
+        print(f"Error: The archive was saved for a machine with {len(missing)} layers this one does not have, "
+              "save again with an inventory of this machine or without --skip-from")
+        return False
+    todo = [_image for _image in manifest["images"] if docker_image_inspect(_image["id"]) is None]
+    chunks = {}
+    for _image in todo:
+        for _name in [_image["manifest"]["Config"]] + [_l["name"] for _l in _image["layers"]]:
+            entry = resolve_file(manifest,_name)
+            for _id, _size in (entry or {}).get("chunks",[]):
+                chunks[_id] = _size
+    state_name = get_load_state_name(manifest)
+    if not verify_chunks(archive_path,chunks,state_name):
+        return False
+    start = time.perf_counter()
+    for _image in manifest["images"]:
+        if _image in todo:
+            print(f"Loading {_image['ref']}")
+            if not load_image(archive_path,manifest,_image,local_chain_ids):
+                print(f"Error: Failed to load {_image['ref']}, rerun load to continue")
+                return False
+            local_chain_ids.update(_layer["chain_id"] for _layer in _image["layers"])
+        else:
+            print(f"Image {_image['ref']} already loaded ({_image['id'][:19]})")
+        if not docker_tag_image(_image["id"],_image["ref"]):
+            return False
+    (STATE_PATH/f"{state_name}.json").unlink(missing_ok=True)
+    print(f"Loaded {len(todo)} images in {time.perf_counter()-start:.1f} s")
+    return True
@@ -0,0 +1,257 @@
+"""
+Copyright (C) 2024 Harsh Davda
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+For inquiries or further information, you may contact:
+Harsh Davda
+Email: info@opensciencestack.org
+"""
+
+from pathlib import Path
+from dataclasses import dataclass
+from functools import lru_cache
+import os
+import subprocess
+import threading
+
+class RepoStateError(Exception):
+    """
+    Raised when a repository layout cannot be read without the git CLI.
+    """
+
+@dataclass
+class RepoState:
+    """
+    Snapshot of a git repository read directly from its metadata files.
+
+    Attributes:
+        path (Path): The working tree path.
+        head_ref (str): The symbolic ref HEAD points to, None if detached.
+        head_sha (str): The commit HEAD resolves to, None on an unborn branch.
+        origin_url (str): The url of the `origin` remote, None if not set.
+    """
+    path: Path
+    head_ref: str
+    head_sha: str
+    origin_url: str
+
+    @property
+    def branch(self):
+        if self.head_ref and self.head_ref.startswith("refs/heads/"):
+            return self.head_ref[len("refs/heads/"):]
+        return self.head_ref
+
+    @property
+    def detached(self):
+        return self.head_ref is None
+
+    @property
+    def version(self):
+        """Branch name if on a branch, otherwise the detached commit sha."""
+        return self.branch if self.branch else self.head_sha
+
+    @staticmethod
+    def read(repo_path: Path):
+        """
+        Reads the repository state from `.git/HEAD`, the refs and `.git/config`.
+
+        Raises:
+            RepoStateError: If the layout is not supported by the reader.
+        """
+        repo_path = Path(repo_path)
+        git_dir, common_dir = resolve_git_dirs(repo_path)
+        if (common_dir/"reftable").exists():
+            raise RepoStateError(f"reftable storage is not supported: {common_dir}")
+        head = (git_dir/"HEAD").read_text().strip()
+        head_ref = None
+        if head.startswith("ref:"):
+            head_ref = head[4:].strip()
+            head_sha = resolve_ref(git_dir,common_dir,head_ref)
+        else:
+            head_sha = head
+        origin_url = read_remote_url(common_dir/"config","origin")
+        return RepoState(repo_path,head_ref,head_sha,origin_url)
+
+    @staticmethod
+    def from_git_cli(repo_path: Path):
+        """
+        Fallback reader using git subprocesses.
+        """
+        def _git(*args):
+            ret = subprocess.run(["git","-C",str(repo_path),*args],capture_output=True)
+            if ret.returncode != 0:
+                return None
+            return ret.stdout.decode().strip()
+        head_ref = _git("symbolic-ref","-q","HEAD")
+        head_sha = _git("rev-parse","HEAD")
+        origin_url = _git("remote","get-url","origin")
+        if head_ref is None and head_sha is None:
+            raise RepoStateError(f"Not a git repository: {repo_path}")
+        return RepoState(Path(repo_path),head_ref,head_sha,origin_url)
+
+def resolve_git_dirs(repo_path: Path):
+    """
+    Resolves the git dir and common dir of a working tree, following the
+    `gitdir:` files used by submodules and linked worktrees.
+
+    Returns:
+        tuple: (git_dir, common_dir)
+    """
+    dot_git = repo_path/".git"
+    if dot_git.is_dir():
+        git_dir = dot_git
+    elif dot_git.is_file():
+        content = dot_git.read_text().strip()
+        if not content.startswith("gitdir:"):
+            raise RepoStateError(f"Invalid gitfile {dot_git}")
+        git_dir = Path(content[len("gitdir:"):].strip())
+        if not git_dir.is_absolute():
+            git_dir = repo_path/git_dir
+    else:
+        raise RepoStateError(f"Not a git repository: {repo_path}")
+    common_dir = git_dir
+    commondir_file = git_dir/"commondir"
+    if commondir_file.is_file():
+        common_dir = Path(commondir_file.read_text().strip())
+        if not common_dir.is_absolute():
+            common_dir = git_dir/common_dir
+    return git_dir, common_dir
+
+def resolve_ref(git_dir: Path, common_dir: Path, ref: str, depth=0):
+    """
+    Resolves a ref to a commit sha from loose refs or packed-refs.
+    Returns None for an unborn branch.
+    """
+    if depth > 5:
+        raise RepoStateError(f"Symbolic ref loop for {ref}")
+    for _dir in (git_dir,common_dir):
+        ref_file = _dir/ref
+        if ref_file.is_file():
+            value = ref_file.read_text().strip()
+            if value.startswith("ref:"):
+                return resolve_ref(git_dir,common_dir,value[4:].strip(),depth+1)
+            return value
+    packed_refs = common_dir/"packed-refs"
+    if packed_refs.is_file():
+        for line in packed_refs.read_text().splitlines():
+            if not line or line[0] in "#^":
+                continue
+            sha, _, name = line.partition(" ")
+            if name.strip() == ref:
+                return sha
+    return None
+
+def parse_config_value(value: str):
+    value = value.strip()
+    if value.startswith('"'):
+        end = value.find('"',1)
+        if end < 0:
+            raise RepoStateError(f"Unterminated config value {value}")
+        return value[1:end]
+    for _comment in (" #"," ;","\t#","\t;"):
+        if _comment in value:
+            value = value[:value.index(_comment)]
+    return value.strip()
+
+def read_remote_url(config_path: Path, remote: str):
+    """
+    Reads `remote.<remote>.url` from a git config file.
+
+    Raises:
+        RepoStateError: If the config uses includes or url rewrites which
+            only the git CLI resolves faithfully.
+    """
+    if not config_path.is_file():
+        return None
+    if has_global_url_rewrites():
+        raise RepoStateError("Global url rewrites present")
+    section = None
+    url = None
+    for line in config_path.read_text().splitlines():
+        line = line.strip()
+        if not line or line[0] in "#;":
+            continue
+        if line.startswith("["):
+            header = line[1:line.index("]")].strip()
+            name, _, subsection = header.partition(" ")
+            name = name.lower()
+            if name in ("include","includeif"):
+                raise RepoStateError(f"Config includes are not supported: {config_path}")
+            if "." in name and not subsection:
+                name, _, subsection = name.partition(".")
+            section = (name,subsection.strip().strip('"'))
+            continue
+        key, _, value = line.partition("=")
+        key = key.strip().lower()
+        if key == "insteadof" or key == "pushinsteadof":
+            raise RepoStateError(f"Url rewrites are not supported: {config_path}")
+        if section == ("remote",remote) and key == "url" and url is None:
+            url = parse_config_value(value)
+    return url
+
+@lru_cache(maxsize=None)
+def has_global_url_rewrites():
+    """
+    Checks the user level git configs for `insteadOf` rewrites.
+    """
+    xdg_config = Path(os.environ.get("XDG_CONFIG_HOME",Path.home()/".config"))
+    config_paths = [Path("/etc/gitconfig"),Path.home()/".gitconfig",xdg_config/"git"/"config"]
+    for _env in ("GIT_CONFIG_SYSTEM","GIT_CONFIG_GLOBAL"):
+        if _env in os.environ:
+            config_paths.append(Path(os.environ[_env]))
+    for config_path in config_paths:
+        try:
+            if "insteadof" in config_path.read_text().lower():
+                return True
+        except OSError:
+            pass
+    return False
+
+_repo_state_cache = {}
+_repo_state_lock = threading.Lock()
+
+def get_repo_state(repo_path: Path):
+    """
+    Returns the cached RepoState of a repository, reading it on first use.
+
+    Returns:
+        RepoState: The repository state, or None if the path is not a git repository.
+    """
+    key = Path(repo_path).absolute()
+    with _repo_state_lock:
+        if key in _repo_state_cache:
+            return _repo_state_cache[key]
+    if not (key/".git").exists():
+        return None
+    try:
+        state = RepoState.read(key)
+    except (RepoStateError,OSError,ValueError):
+        try:
+            state = RepoState.from_git_cli(key)
+        except RepoStateError:
+            state = None
+    with _repo_state_lock:
+        _repo_state_cache[key] = state
+    return state
+
+def invalidate_repo_state(repo_path: Path = None):
+    """
+    Drops cached state after a write operation. Clears everything if no path is given.
+    """
+    with _repo_state_lock:
+        if repo_path is None:
+            _repo_state_cache.clear()
+        else:
+            _repo_state_cache.pop(Path(repo_path).absolute(),None)
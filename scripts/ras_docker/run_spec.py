@@ -0,0 +1,197 @@
+"""
+Copyright (C) 2024 Harsh Davda
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+For inquiries or further information, you may contact:
+Harsh Davda
+Email: info@opensciencestack.org
+"""
+
+from .common import DockerCmdType
+from .host_probe import HostCapabilities,get_host_capabilities,DRI_PATH
+from dataclasses import dataclass, field, replace
+import os
+import shlex
+
+# tty, input and usb character devices
+DEVICE_CGROUP_RULES = ["c 13:* rmw","c 81:* rmw","c 189:* rmw"]
+
+_dry_run = os.environ.get("RAS_DRY_RUN","0") not in ("","0")
+
+def set_dry_run(enabled: bool):
+    """Print docker run/exec commands instead of running them."""
+    global _dry_run
+    _dry_run = enabled
+
+def is_dry_run():
+    return _dry_run
+
+@dataclass
+class DockerMount:
+    """
+    Data class for a bind mount.
+
+    Attributes:
+        source (str): Host path.
+        target (str): Path inside the container.
+        read_only (bool): Mount read-only.
+    """
+    source: str
+    target: str
+    read_only: bool = False
+
+    def to_arg(self):
+        return f"{self.source}:{self.target}" + (":ro" if self.read_only else "")
+
+@dataclass
+class DockerRunSpec:
+    """
+    Data class describing how an app container is run, turned into a docker
+    argv without going through a shell. Mounts are keyed by container path and
+    env by name, so later additions replace earlier ones instead of repeating.
+
+    Attributes:
+        image_name (str): The image to run.
+        container_name (str): The container name.
+        work_dir (str): The working directory inside the container.
+        mounts (dict): Container path to DockerMount.
+        env (dict): Variable name to value, None to pass the host value through.
+        devices (list): Host devices to expose.
+        device_cgroup_rules (list): Device cgroup rules.
+        gpus (str): Value of --gpus, None for no GPU request.
+        runtime (str): Container runtime, None for the default.
+        network (str): Network mode.
+        labels (dict): Container labels.
+        remove (bool): Remove the container when it exits.
+        detach (bool): Start the container in the background.
+        attach (bool): Exec into the running container instead of starting one.
+    """
+    image_name: str
+    container_name: str
+    work_dir: str
+    mounts: dict = field(default_factory=dict)
+    env: dict = field(default_factory=dict)
+    devices: list = field(default_factory=list)
+    device_cgroup_rules: list = field(default_factory=list)
+    gpus: str = None
+    runtime: str = None
+    network: str = "host"
+    labels: dict = field(default_factory=dict)
+    remove: bool = False
+    detach: bool = False
+    attach: bool = False
+
+    def add_mount(self, source, target: str, read_only=False):
+        self.mounts[target] = DockerMount(str(source),target,read_only)
+
+    def add_device(self, device: str):
+        if device not in self.devices:
+            self.devices.append(device)
+
+    def copy(self):
+        return replace(self,mounts=dict(self.mounts),env=dict(self.env),devices=list(self.devices),
+                       device_cgroup_rules=list(self.device_cgroup_rules),labels=dict(self.labels))
+
+    def run_argv(self, command: list, user_id=1000, tty=True):
+        argv = ["docker","run"]
+        if tty:
+            argv.append("-it")
+        if self.detach:
+            argv.append("-d")
+        if self.remove:
+            argv.append("--rm")
+        for _name, _value in self.env.items():
+            argv += ["-e",_name if _value is None else f"{_name}={_value}"]
+        argv += ["--user",f"{user_id}:{user_id}","--name",self.container_name,
+                 "--workdir",self.work_dir,"--network",self.network]
+        for _key, _value in self.labels.items():
+            argv += ["--label",f"{_key}={_value}"]
+        for _mount in self.mounts.values():
+            argv += ["-v",_mount.to_arg()]
+        if self.gpus is not None:
+            argv += ["--gpus",self.gpus]
+        if self.runtime is not None:
+            argv += ["--runtime",self.runtime]
+        for _device in self.devices:
+            argv += ["--device",_device]
+        for _rule in self.device_cgroup_rules:
+            argv += ["--device-cgroup-rule",_rule]
+        return argv + [self.image_name] + list(command)
+
+    def exec_argv(self, command: list, user_id=1000, tty=True):
+        argv = ["docker","exec"]
+        if tty:
+            argv.append("-it")
+        argv += ["-u",f"{user_id}:{user_id}","-w",self.work_dir,self.container_name]
+        return argv + list(command)
+
+    def argv(self, command: list, user_id=1000, tty=True):
+        """
+        The docker command running `command`: an exec into the running
+        container if attached, otherwise a new container.
+        """
+        if self.attach:
+            return self.exec_argv(command,user_id,tty)
+        return self.run_argv(command,user_id,tty)
+
+def format_argv(argv: list):
+    """Shell-quoted form of an argv, for printing and copy-pasting."""
+    return shlex.join(argv)
+
+def get_base_run_spec(image_name: str, container_name: str, work_dir: str, cmd_type=DockerCmdType.FULL,
+                      app_type: str = None, host: HostCapabilities = None):
+    """
+    Builds the run spec shared by all apps. Everything host dependent comes
+    from `host`, so the same probe always gives the same spec.
+
+    Args:
+        image_name (str): The image to run.
+        container_name (str): The container name.
+        work_dir (str): The working directory inside the container.
+        cmd_type (DockerCmdType, optional): RAW for a bare container, FULL for
+            one with GPU, devices, docker socket and display passthrough.
+        app_type (str, optional): Value of APP_TYPE. Defaults to the APP_TYPE env var or robot.
+        host (HostCapabilities, optional): The host probe. Defaults to get_host_capabilities().
+
+    Returns:
+        DockerRunSpec: The run spec.
+
+    Raises:
+        ValueError: If the Docker command type is invalid.
+    """
+    if cmd_type not in (DockerCmdType.FULL,DockerCmdType.RAW):
+        raise ValueError(f"invalid docker cmd_type {cmd_type}")
+    if host is None:
+        host = get_host_capabilities()
+    spec = DockerRunSpec(image_name,container_name,work_dir)
+    if host.display is not None:
+        spec.env["DISPLAY"] = host.display
+    spec.add_mount("/etc/localtime","/etc/localtime",read_only=True)
+    if cmd_type == DockerCmdType.RAW:
+        return spec
+    spec.env["APP_TYPE"] = app_type or os.environ.get("APP_TYPE","robot")
+    spec.add_mount("/var/run/docker.sock","/var/run/docker.sock")
+    spec.add_mount("/dev","/dev")
+    spec.device_cgroup_rules = list(DEVICE_CGROUP_RULES)
+    if host.gpu_mode == "nvidia":
+        spec.gpus, spec.runtime = "all", "nvidia"
+        spec.env.update({"NVIDIA_VISIBLE_DEVICES": "all", "NVIDIA_DRIVER_CAPABILITIES": "all"})
+    elif host.gpu_mode == "dri":
+        spec.add_device(DRI_PATH)
+    for _path in host.passthrough_mounts:
+        spec.add_mount(_path,_path)
+    for _env in host.passthrough_env:
+        spec.env[_env] = None
+    return spec
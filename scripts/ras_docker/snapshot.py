@@ -0,0 +1,255 @@
+"""
+Copyright (C) 2024 Harsh Davda
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+For inquiries or further information, you may contact:
+Harsh Davda
+Email: info@opensciencestack.org
+"""
+
+from .common import STATE_PATH,run_streamed,format_size
+from .docker import docker_image_inspect,docker_container_inspect,docker_container_changes,docker_container_archive,docker_tag_image,\
+        docker_remove_image
+from dataclasses import dataclass, field
+from collections import Counter
+from fnmatch import fnmatch
+import os
+import posixpath
+import shutil
+import tarfile
+import tempfile
+
+SNAPSHOT_PATH = STATE_PATH/"snapshot"
+SNAPSHOT_LABEL = "org.ras.snapshot.from"
+# Paths that only hold caches, logs and build output, left out of snapshots
+SNAPSHOT_JUNK_PATTERNS = [
+    "/var/lib/apt/lists/*",
+    "/var/cache/apt/*",
+    "/var/cache/debconf/*-old",
+    "/var/log/*",
+    "/tmp/*",
+    "/root/.cache/*",
+    "/home/*/.cache/*",
+    "/root/.bash_history",
+    "/home/*/.bash_history",
+    "*/.ros/log/*",
+    "*/__pycache__/*",
+    "*.pyc",
+    "*_ws/build/*",
+    "*_ws/log/*",
+]
+
+def match_junk(path: str):
+    """
+    Returns the junk pattern matching a path or the directory it names, or None.
+    """
+    for _pattern in SNAPSHOT_JUNK_PATTERNS:
+        if fnmatch(path,_pattern) or fnmatch(path + "/",_pattern):
+            return _pattern
+    return None
+
+@dataclass
+class SnapshotPlan:
+    """
+    Data class describing what a snapshot keeps from a container diff.
+
+    Attributes:
+        roots (list): Topmost changed paths to copy into the layer.
+        deleted (list): Paths deleted in the container.
+        dropped (Counter): Junk pattern to the number of changed paths it dropped.
+        sizes (dict): Root path to the bytes it adds, filled by write_layer.
+        dropped_sizes (Counter): Junk pattern to the bytes dropped inside copied roots.
+    """
+    roots: list = field(default_factory=list)
+    deleted: list = field(default_factory=list)
+    dropped: Counter = field(default_factory=Counter)
+    sizes: dict = field(default_factory=dict)
+    dropped_sizes: Counter = field(default_factory=Counter)
+
+    @property
+    def empty(self):
+        return (len(self.roots) == 0) and (len(self.deleted) == 0)
+
+    @property
+    def layer_size(self):
+        return sum(self.sizes.values())
+
+def plan_snapshot(changes: list):
+    """
+    Reduces a container diff to the paths worth keeping. A modified directory
+    with changed children is left to its children, an added directory covers
+    everything below it.
+
+    Args:
+        changes (list): Tuples of (path, kind) from docker_container_changes.
+
+    Returns:
+        SnapshotPlan: The paths to copy and delete.
+    """
+    plan = SnapshotPlan()
+    parent_dirs = set()
+    for _path, _ in changes:
+        _parent = posixpath.dirname(_path)
+        while _parent not in parent_dirs and _parent != "/":
+            parent_dirs.add(_parent)
+            _parent = posixpath.dirname(_parent)
+    roots = set()
+    for _path, _kind in sorted(changes):
+        pattern = match_junk(_path)
+        if pattern is not None:
+            # the junk directory itself (/tmp for /tmp/*) is not a dropped path
+            if fnmatch(_path,pattern):
+                plan.dropped[pattern] += 1
+            continue
+        if _kind == 2:
+            plan.deleted.append(_path)
+            continue
+        if _kind == 0 and _path in parent_dirs:
+            continue
+        _parent = posixpath.dirname(_path)
+        covered = False
+        while _parent != "/":
+            if _parent in roots:
+                covered = True
+                break
+            _parent = posixpath.dirname(_parent)
+        if not covered:
+            roots.add(_path)
+            plan.roots.append(_path)
+    return plan
+
+def write_layer(container_name: str, plan: SnapshotPlan, tar_path):
+    """
+    Copies the planned roots out of the container into one tar, leaving out
+    junk below them and recording the size of every root.
+
+    Returns:
+        bool: True if every root was copied.
+    """
+    with tarfile.open(tar_path,"w") as out:
+        for _root in plan.roots:
+            parent = posixpath.dirname(_root).lstrip("/")
+            size = 0
+            with tempfile.TemporaryFile() as archive:
+                if not docker_container_archive(container_name,_root,archive):
+                    return False
+                archive.seek(0)
+                with tarfile.open(fileobj=archive,mode="r:") as src:
+                    for _member in src:
+                        full_path = posixpath.join("/",parent,_member.name)
+                        pattern = match_junk(full_path)
+                        if pattern is not None:
+                            plan.dropped_sizes[pattern] += _member.size
+                            continue
+                        _member.name = posixpath.join(parent,_member.name)
+                        if _member.islnk():
+                            _member.linkname = posixpath.join(parent,_member.linkname)
+                        out.addfile(_member,src.extractfile(_member) if _member.isreg() else None)
+                        if _member.isreg():
+                            size += _member.size
+            plan.sizes[_root] = size
+    return True
+
+def print_snapshot_report(container_name: str, plan: SnapshotPlan, container_size: int = None, top: int = 20):
+    print(f"*****Snapshot of {container_name}*****")
+    roots = sorted(plan.sizes.items(),key=lambda _item: _item[1],reverse=True)
+    for _root, _size in roots[:top]:
+        print(f"  {format_size(_size):>10}  {_root}")
+    if len(roots) > top:
+        rest = sum(_size for _, _size in roots[top:])
+        print(f"  {format_size(rest):>10}  ... {len(roots)-top} more paths")
+    for _pattern in sorted(set(plan.dropped) | set(plan.dropped_sizes)):
+        notes = []
+        if plan.dropped[_pattern]:
+            notes.append(f"{plan.dropped[_pattern]} paths")
+        if plan.dropped_sizes[_pattern]:
+            notes.append(format_size(plan.dropped_sizes[_pattern]))
+        print(f"  dropped {_pattern} ({', '.join(notes)})")
+    if plan.deleted:
+        print(f"  deleted {len(plan.deleted)} paths")
+    summary = f"  layer {format_size(plan.layer_size)}"
+    if container_size is not None:
+        summary += f", a full docker commit would add {format_size(container_size)}"
+    print(summary)
+
+def get_snapshot_dockerfile(base_ref: str, base_id: str, has_layer: bool, has_deleted: bool, user: str):
+    # no syntax directive, fetching the frontend image would need the network
+    lines = [f"FROM {base_ref}"]
+    if has_layer:
+        lines.append("ADD changes.tar /")
+    if has_deleted:
+        lines.append("USER root")
+        lines.append("RUN --mount=type=bind,source=deleted.list,target=/tmp/ras_deleted.list "
+                     "xargs -d '\\n' rm -rf -- < /tmp/ras_deleted.list")
+        if user:
+            lines.append(f"USER {user}")
+    lines.append(f"LABEL {SNAPSHOT_LABEL}={base_id}")
+    return "\n".join(lines) + "\n"
+
+def snapshot_container(container_name: str, image_tag: str):
+    """
+    Builds a slim image layer from the filesystem diff of a stopped container,
+    without caches, logs and build output, and tags it as `image_tag` after
+    printing a size report.
+
+    Args:
+        container_name (str): The container with the changes.
+        image_tag (str): The tag of the resulting image.
+
+    Returns:
+        bool: False if the snapshot failed, True otherwise (also if there was nothing to keep).
+    """
+    info = docker_container_inspect(container_name,size=True)
+    changes = docker_container_changes(container_name)
+    if (info is None) or (changes is None):
+        print(f"Error: Container {container_name} not found")
+        return False
+    plan = plan_snapshot(changes)
+    context_path = SNAPSHOT_PATH/container_name
+    shutil.rmtree(context_path,ignore_errors=True)
+    context_path.mkdir(parents=True)
+    try:
+        if not write_layer(container_name,plan,context_path/"changes.tar"):
+            return False
+        print_snapshot_report(container_name,plan,info.get("SizeRw"))
+        if plan.empty:
+            print("No changes to keep, the image is left as it is")
+            return True
+        (context_path/"deleted.list").write_text("".join(f"{_p}\n" for _p in plan.deleted))
+        base_id = info["Image"]
+        # BuildKit resolves FROM by name, the image tag may also have moved since the container started
+        base_ref = f"ras_snapshot_base:{container_name}"
+        if not docker_tag_image(base_id,base_ref):
+            return False
+        try:
+            # the container ran as root, restore the user of the image
+            user = ((docker_image_inspect(base_id) or {}).get("Config") or {}).get("User") or ""
+            dockerfile = get_snapshot_dockerfile(base_ref,base_id,len(plan.roots) > 0,len(plan.deleted) > 0,user)
+            (context_path/"Dockerfile").write_text(dockerfile)
+            iid_path = context_path/"image.id"
+            ret = run_streamed(["docker","build","--iidfile",str(iid_path),str(context_path)],
+                               env={**os.environ,"DOCKER_BUILDKIT":"1"})
+        finally:
+            docker_remove_image(base_ref)
+        if ret.returncode != 0:
+            print("Error: Failed to build the snapshot image")
+            return False
+        image_id = iid_path.read_text().strip()
+        if not docker_tag_image(image_id,image_tag):
+            return False
+        print(f"Snapshot tagged as {image_tag} ({image_id[:19]})")
+        return True
+    finally:
+        shutil.rmtree(context_path,ignore_errors=True)
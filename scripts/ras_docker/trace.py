@@ -0,0 +1,229 @@
+"""
+Copyright (C) 2024 Harsh Davda
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+For inquiries or further information, you may contact:
+Harsh Davda
+Email: info@opensciencestack.org
+"""
+
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+import atexit
+import json
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+
+TRACE_TOP = int(os.environ.get("RAS_TRACE_TOP","15"))
+# Span categories listed with the spawned commands in the summary
+SUMMARY_CATEGORIES = ("docker-api",)
+_OriginalPopen = subprocess.Popen
+
+def format_command(args):
+    if isinstance(args,(str,bytes)):
+        return args.decode(errors="replace") if isinstance(args,bytes) else args
+    return shlex.join(str(_a) for _a in args)
+
+class Tracer:
+    """
+    Collects spawned commands and spans, and writes them as a Chrome
+    trace-event JSON (chrome://tracing, ui.perfetto.dev) with one track per thread.
+    """
+    def __init__(self, path: Path, top: int = TRACE_TOP):
+        self.path = Path(path)
+        self.top = top
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.commands = []
+        self.spans = []
+        self.threads = {}
+        self.get_tid()
+
+    def get_tid(self):
+        thread = threading.current_thread()
+        with self.lock:
+            if thread.ident not in self.threads:
+                self.threads[thread.ident] = (len(self.threads),thread.name)
+            return self.threads[thread.ident][0]
+
+    def command_started(self, args, cwd, start: float):
+        event = {"command": format_command(args), "cwd": str(cwd or os.getcwd()), "tid": self.get_tid(),
+                 "thread": threading.current_thread().name, "start": start, "end": None, "exit": None, "output": 0}
+        with self.lock:
+            self.commands.append(event)
+        return event
+
+    def add_span(self, name: str, category: str, start: float, end: float, args: dict = None):
+        event = {"name": name, "cat": category, "tid": self.get_tid(), "thread": threading.current_thread().name,
+                 "start": start, "end": end, "args": args or {}}
+        with self.lock:
+            self.spans.append(event)
+
+    def _to_us(self, t: float):
+        return round((t - self.start) * 1e6)
+
+    def get_trace_events(self, end: float):
+        pid = os.getpid()
+        events = [{"ph": "M", "name": "process_name", "pid": pid, "tid": 0, "args": {"name": "ras"}},
+                  {"ph": "X", "name": format_command(["ras"] + sys.argv[1:]), "cat": "command", "pid": pid,
+                   "tid": self.get_tid(), "ts": 0, "dur": self._to_us(end), "args": {}}]
+        for _tid, _name in self.threads.values():
+            events.append({"ph": "M", "name": "thread_name", "pid": pid, "tid": _tid, "args": {"name": _name}})
+        for _span in self.spans:
+            events.append({"ph": "X", "name": _span["name"], "cat": _span["cat"], "pid": pid, "tid": _span["tid"],
+                           "ts": self._to_us(_span["start"]), "dur": self._to_us(_span["end"]) - self._to_us(_span["start"]),
+                           "args": _span["args"]})
+        for _cmd in self.commands:
+            cmd_end = _cmd["end"] if _cmd["end"] is not None else end
+            events.append({"ph": "X", "name": _cmd["command"][:80], "cat": "subprocess", "pid": pid, "tid": _cmd["tid"],
+                           "ts": self._to_us(_cmd["start"]), "dur": self._to_us(cmd_end) - self._to_us(_cmd["start"]),
+                           "args": {"command": _cmd["command"], "cwd": _cmd["cwd"], "exit_code": _cmd["exit"],
+                                    "output_bytes": _cmd["output"], **({"error": _cmd["error"]} if "error" in _cmd else {})}})
+        return events
+
+    def get_operations(self, end: float):
+        """
+        Returns the spawned commands and the summary spans as (duration, result, thread, label, program).
+        """
+        operations = []
+        for _cmd in self.commands:
+            result = "error" if "error" in _cmd else "running" if _cmd["end"] is None else f"exit {_cmd['exit']}"
+            operations.append(((_cmd["end"] if _cmd["end"] is not None else end) - _cmd["start"], result, _cmd["thread"],
+                               _cmd["command"], (_cmd["command"].split() or ["?"])[0]))
+        for _span in self.spans:
+            if _span["cat"] in SUMMARY_CATEGORIES:
+                args = _span["args"]
+                result = "error" if "error" in args else str(args.get("status",""))
+                operations.append((_span["end"] - _span["start"], result, _span["thread"], _span["name"], _span["cat"]))
+        return sorted(operations,key=lambda _op: _op[0],reverse=True)
+
+    def print_summary(self, end: float):
+        operations = self.get_operations(end)
+        busy = sum(_op[0] for _op in operations)
+        print(f"*****Trace: {len(operations)} operations, {busy:.1f}s in commands and docker API calls, {end-self.start:.1f}s wall*****")
+        for _duration, _result, _thread, _label, _ in operations[:self.top]:
+            label = _label if len(_label) <= 100 else _label[:97] + "..."
+            print(f"  {_duration:7.2f}s  {_result:<8} [{_thread}] {label}")
+        by_program = defaultdict(lambda: [0,0.0])
+        for _duration, _, _, _, _program in operations:
+            by_program[_program][0] += 1
+            by_program[_program][1] += _duration
+        totals = sorted(by_program.items(),key=lambda _item: _item[1][1],reverse=True)
+        print("  by program: " + ", ".join(f"{_p} {_t:.1f}s ({_n})" for _p, (_n, _t) in totals[:8]))
+
+    def finish(self):
+        end = time.perf_counter()
+        try:
+            self.path.parent.mkdir(parents=True,exist_ok=True)
+            with self.path.open("w") as f:
+                json.dump({"traceEvents": self.get_trace_events(end), "displayTimeUnit": "ms"},f)
+        except OSError as e:
+            print(f"Warning: Could not write the trace to {self.path}: {e}")
+            return
+        self.print_summary(end)
+        print(f"Trace written to {self.path} (open it in chrome://tracing or https://ui.perfetto.dev)")
+
+_tracer: Tracer = None
+
+class TracedPopen(_OriginalPopen):
+    """
+    Popen recording its command, thread, cwd, duration, exit code and
+    captured output size in the active tracer.
+    """
+    def __init__(self, args, *pargs, **kwargs):
+        self.trace_event = None
+        start = time.perf_counter()
+        try:
+            super().__init__(args, *pargs, **kwargs)
+        except OSError as e:
+            if _tracer is not None:
+                event = _tracer.command_started(args,kwargs.get("cwd"),start)
+                event["end"], event["error"] = time.perf_counter(), str(e)
+            raise
+        if _tracer is not None:
+            self.trace_event = _tracer.command_started(args,kwargs.get("cwd"),start)
+
+    def _trace_finished(self):
+        if (self.trace_event is not None) and (self.returncode is not None) and (self.trace_event["end"] is None):
+            self.trace_event["end"] = time.perf_counter()
+            self.trace_event["exit"] = self.returncode
+
+    def wait(self, timeout=None):
+        try:
+            return super().wait(timeout)
+        finally:
+            self._trace_finished()
+
+    def poll(self):
+        ret = super().poll()
+        self._trace_finished()
+        return ret
+
+    def communicate(self, input=None, timeout=None):
+        stdout, stderr = super().communicate(input, timeout)
+        self.add_trace_output(len(stdout or b"") + len(stderr or b""))
+        return stdout, stderr
+
+    def add_trace_output(self, size: int):
+        if self.trace_event is not None:
+            self.trace_event["output"] += size
+
+def enable_tracing(path: Path, top: int = TRACE_TOP):
+    """
+    Records every command spawned through subprocess from now on, and writes
+    the trace and a summary of the slowest commands and docker API calls when
+    the process exits.
+
+    Args:
+        path (Path): Where to write the Chrome trace JSON.
+        top (int, optional): Number of operations in the summary.
+    """
+    global _tracer
+    if _tracer is not None:
+        return _tracer
+    _tracer = Tracer(path,top)
+    subprocess.Popen = TracedPopen
+    atexit.register(_tracer.finish)
+    return _tracer
+
+def is_tracing():
+    return _tracer is not None
+
+@contextmanager
+def trace_span(name: str, category: str = "task", **args):
+    """
+    Context manager recording a block as a span on the track of the current thread.
+    It yields the span args, so results known only at the end can be added.
+    Does nothing unless tracing is enabled.
+    """
+    if _tracer is None:
+        yield args
+        return
+    start = time.perf_counter()
+    try:
+        yield args
+    except GeneratorExit:
+        # a generator closed early by its consumer, not a failure
+        raise
+    except BaseException as e:
+        args.setdefault("error",str(e) or type(e).__name__)
+        raise
+    finally:
+        _tracer.add_span(name,category,start,time.perf_counter(),args)
@@ -22,15 +22,31 @@ Email: info@opensciencestack.org
 from pathlib import Path
 from enum import Enum
 import yaml
-from .common import run_command_shell,WORKING_PATH,ROS2_PKGS_PATH,AssetType,run_functions_in_threads,parse_with_format
-from .arg_parser import argparse
-from dataclasses import dataclass,field
+from .common import run_command_shell,WORKING_PATH,ROS2_PKGS_PATH,AssetType,TaskExecutor,TaskResult,task_print,\
+        read_state,write_state,STATE_PATH,timed,TIMING_ENABLED
+from .repo_state import get_repo_state,invalidate_repo_state
+from .arg_parser import LOCKFILE_NAME
+import argparse
+from dataclasses import dataclass,field,asdict
 from typing import List,Dict,ClassVar
 import vcstool
 import subprocess
+import threading
+import time
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache,partial
+import json
+import hashlib
 from enum import Enum
 repos_url = "https://github.com/ras-ros2/ras_vcs_repos.git"
 vcs_repos_path = WORKING_PATH/'repos'
+VCS_MAX_WORKERS = int(os.environ.get("RAS_VCS_JOBS",min(16,(os.cpu_count() or 1)*2)))
+VCS_HOST_MAX_CONNECTIONS = int(os.environ.get("RAS_VCS_HOST_JOBS",4))
+VCS_RETRIES = int(os.environ.get("RAS_VCS_RETRIES",2))
+VCS_MIRROR_PATH = STATE_PATH/"mirrors"
+LOCKFILE_PATH = WORKING_PATH/LOCKFILE_NAME
 supported_assets = ["manipulator"]
 supported_apps = ["robot","server"]
 
@@ -40,6 +56,14 @@ def get_repos_vcs():
 def get_setup_vcs_mapping():
     if not vcs_repos_path.exists():
         return VCS.from_git_repo(WORKING_PATH)
+    with timed("manifest load"):
+        main_vcs = build_setup_vcs_mapping()
+        MANIFEST_CACHE.save()
+    if TIMING_ENABLED:
+        print(f"[timing] manifest sources: {MANIFEST_CACHE.stats}")
+    return main_vcs
+
+def build_setup_vcs_mapping():
     main_vcs_mapping = parse_vcs_file(vcs_repos_path/"main.repos",WORKING_PATH.parent)
     main_vcs : VCS = next(iter(main_vcs_mapping.values()))
     main_vcs.add_child("deps",VcsMap(vcs_repos_path/"common.repos",WORKING_PATH/"ros2_pkgs",default_pull=True))
@@ -59,8 +83,37 @@ class GitUrlType(Enum):
     SSH = "git@{hostname}:{org_name}/{repo_name}"
     HTTPS = "https://{hostname}/{org_name}/{repo_name}"
 
+# Url forms accepted for each GitUrlType, compiled once at import.
+# The ".git" suffix and a trailing slash are optional in every form.
+_URL_TAIL = r"/(?P<org_name>[^/]+)/(?P<repo_name>[^/]+?)(?:\.git)?/?$"
+GIT_URL_PATTERNS = {
+    GitUrlType.SSH: [
+        re.compile(r"^[\w.-]+@(?P<hostname>[^/:@]+):(?P<org_name>[^/]+)/(?P<repo_name>[^/]+?)(?:\.git)?/?$"),
+        re.compile(r"^(?:git\+)?ssh://(?:[\w.-]+@)?(?P<hostname>[^/:@]+)(?::(?P<port>\d+))?" + _URL_TAIL),
+    ],
+    GitUrlType.HTTPS: [
+        re.compile(r"^https://(?P<hostname>[^/:@]+)(?::(?P<port>\d+))?" + _URL_TAIL),
+    ],
+}
+GIT_URL_PORT_FORMATS = {
+    GitUrlType.SSH: "ssh://git@{hostname}:{port}/{org_name}/{repo_name}",
+    GitUrlType.HTTPS: "https://{hostname}:{port}/{org_name}/{repo_name}",
+}
+
+@lru_cache(maxsize=4096)
+def parse_remote_url(url:str):
+    """Match a url against GIT_URL_PATTERNS, returning (url_type, fields) or None."""
+    for url_type, patterns in GIT_URL_PATTERNS.items():
+        for pattern in patterns:
+            match = pattern.match(url)
+            if match:
+                return url_type, tuple(match.groupdict().items())
+    return None
+
 
 def switch_url(url:str,git_type:GitUrlType=None):
+    if not is_remote_url(url):
+        return url
     remote = VcsRemote.from_url(url)
     if git_type:
         remote.url_type = git_type
@@ -69,16 +122,14 @@ def switch_url(url:str,git_type:GitUrlType=None):
         return remote.get_url(reformed=True)
 
 def get_repo_version(repo_path:Path):
-    ret = subprocess.run(f"git -C {repo_path} rev-parse --abbrev-ref HEAD",shell=True,capture_output=True)
-    if ret.returncode == 0:
-        version = ret.stdout.decode().strip()
-    else:
-        ret = subprocess.run(f"git -C {repo_path} rev-parse HEAD",capture_output=True,shell=True)
-        if ret.returncode == 0:
-            version = ret.stdout.decode().strip()
-        else:
-            raise Exception("Could not get version")
-    return version
+    state = get_repo_state(repo_path)
+    if (state is None) or (state.version is None):
+        raise Exception("Could not get version")
+    return state.version
+
+def is_remote_url(url:str):
+    """False for urls such as local paths or file:// which have no https/ssh form."""
+    return isinstance(url,str) and parse_remote_url(url) is not None
 
 def check_url_git_type(url:str):
     return VcsRemote.from_url(url).url_type
@@ -93,9 +144,15 @@ class VCS(object):
     type:str = "git"
     parent: 'VCS' = None
     children: Dict[str,'VcsMap'] = field(default_factory=dict)
+    clone_mode: str = None
+    depth: int = None
+    locked: bool = False
+    default_clone_mode: ClassVar[str] = os.environ.get("RAS_CLONE_MODE","full")
 
     @property
     def reformed_url(self):
+        if not is_remote_url(self.url):
+            return self.url
         return VcsRemote.from_url(self.url).get_url(reformed=True)
     
     def reform_repo_url(self):
@@ -103,7 +160,7 @@ class VCS(object):
 
     @staticmethod
     def from_dict(path:str,d:dict):
-        return VCS(path,d['url'],d['version'],d['type'])
+        return VCS(path,d['url'],d['version'],d['type'],clone_mode=d.get('clone_mode'),depth=d.get('depth'))
     
     @staticmethod
     def from_git_repo(repo_path:Path):
@@ -114,18 +171,26 @@ class VCS(object):
         return VCS(str(repo_path),url,version,"git")
     
     def to_dict(self):
-        return {
+        d = {
             'url':self.url,
             'version':self.version,
             'type':self.type
         }
+        if self.clone_mode:
+            d['clone_mode'] = self.clone_mode
+        if self.depth:
+            d['depth'] = self.depth
+        return d
     
     
     def update_vcs_from_repo(self):
         if self.type == "git":
             repo_path = Path(self.repo_path)
-            self.url = get_remote_url(repo_path)
-            self.version = get_repo_version(repo_path)
+            state = get_repo_state(repo_path)
+            if (state is None) or (state.version is None):
+                raise Exception("Could not get version")
+            self.url = state.origin_url
+            self.version = state.version
         else:
             raise Exception("Unsupported VCS type")
         
@@ -151,9 +216,17 @@ class VCS(object):
             repo_path = Path(self.repo_path)
             set_remote_url(repo_path,self.reformed_url)
             run_command_shell(f"git -C {repo_path} checkout {self.version}")
+            invalidate_repo_state(repo_path)
         else:
             raise Exception("Unsupported VCS type")
     
+    def iterate_tree(self):
+        """Yields this repo and every repo below it."""
+        yield self
+        for _child in self.children.values():
+            for _v in _child.iterate_vcs():
+                yield from _v.iterate_tree()
+
     def iterate_children(self,log=False):
         for _child in self.children.values():
             if log:
@@ -167,6 +240,7 @@ class VCS(object):
             if not self.is_repo_path_valid():
                 raise ValueError(f"Repo path {self.repo_path} is invalid")
             subprocess.run(f"git -C {self.repo_path} remote set-url origin {self.url}",shell=True,check=True)
+            invalidate_repo_state(self.repo_path)
         for _child in self.iterate_children(log=False):
             _child.switch_git_type(git_type,write)
 
@@ -176,6 +250,10 @@ class VCS(object):
             if repo_path.exists():
                 if (repo_path/".git").exists():
                     url = get_remote_url(repo_path)
+                    if url is None:
+                        return False
+                    if not (is_remote_url(url) and is_remote_url(self.url)):
+                        return url.rstrip("/") == self.url.rstrip("/")
                     return VcsRemote.from_url(url).is_same_remote(VcsRemote.from_url(self.url))
         return False
     @property
@@ -184,45 +262,103 @@ class VCS(object):
             return Path(self.parent.repo_path)/self.path
         return Path(self.path)
     
+    def get_clone_args(self,url:str):
+        """Extra `git clone` arguments for the clone mode of this repo."""
+        clone_mode = self.clone_mode or VCS.default_clone_mode
+        if clone_mode == "blobless":
+            return "--filter=blob:none"
+        elif clone_mode == "shallow":
+            return f"--depth {self.depth or 1} --shallow-submodules"
+        elif clone_mode == "full":
+            mirror_path = MIRROR_CACHE.prepare(url)
+            if mirror_path is None:
+                return ""
+            return f"--reference {mirror_path} --dissociate"
+        raise ValueError(f"Invalid clone mode {clone_mode}")
+
     def import_repo(self):
         if self.type == "git":
-            ret = run_command_shell(f"git clone --recursive {self.reformed_url} -b {self.version} {self.repo_path}")
+            invalidate_repo_state(self.repo_path)
+            url = self.reformed_url
+            clone_args = " ".join(["--recursive",self.get_clone_args(url)]).strip()
+            if self.locked:
+                ret = run_command_shell(f"git clone {clone_args} {url} {self.repo_path}")
+                if ret.returncode != 0:
+                    return False
+                return self.checkout_locked()
+            ret = run_command_shell(f"git clone {clone_args} {url} -b {self.version} {self.repo_path}")
             if ret.returncode != 0:
                 return False
             ret = run_command_shell(f"git -C {self.repo_path} checkout --recurse-submodules {self.version}")
+            invalidate_repo_state(self.repo_path)
             return ret.returncode == 0
         return False
     
+    def checkout_locked(self):
+        """Fetch the locked commit if it is missing and check it out detached, without pulling."""
+        if self.type != "git":
+            return False
+        repo_path = self.repo_path
+        if get_remote_url(repo_path) != self.reformed_url:
+            set_remote_url(repo_path,self.reformed_url)
+        ret = subprocess.run(["git","-C",str(repo_path),"cat-file","-e",f"{self.version}^{{commit}}"],capture_output=True)
+        if ret.returncode != 0:
+            depth_arg = f"--depth {self.depth or 1} " if (self.clone_mode or VCS.default_clone_mode) == "shallow" else ""
+            ret = run_command_shell(f"git -C {repo_path} fetch {depth_arg}origin {self.version}")
+            if ret.returncode != 0:
+                ret = run_command_shell(f"git -C {repo_path} fetch origin")
+                if ret.returncode != 0:
+                    return False
+        ret = run_command_shell(f"git -C {repo_path} checkout --detach --recurse-submodules {self.version}")
+        invalidate_repo_state(repo_path)
+        return ret.returncode == 0
+
     def pull_repo(self,switch_version=False):
         if self.type == "git":
             if switch_version:
                 ret = run_command_shell(f"git -C {self.repo_path} checkout --recurse-submodules {self.version}")
+                invalidate_repo_state(self.repo_path)
                 if ret.returncode != 0:
                     return False
             ret = run_command_shell(f"git -C {self.repo_path} pull")
+            invalidate_repo_state(self.repo_path)
             return ret.returncode == 0
         return False
     
-    def init_repo(self,from_repo=False):
-        # print(self.repo_path,from_repo)
+    def init_self(self,from_repo=False):
+        """Clone or update this repo only, without touching its children."""
         self_init_status  = True
         if self.repo_path.exists():
             if not self.is_repo_path_valid():
                 raise Exception(f"Invalid repo path {self.repo_path}")
             if from_repo:
                 self.update_vcs_from_repo()
+            if SYNC_ENGINE.is_up_to_date(self):
+                if (not from_repo) and (get_remote_url(self.repo_path) != self.reformed_url):
+                    set_remote_url(self.repo_path,self.reformed_url)
+                task_print(f"{self.repo_path} is up to date")
+            elif self.locked:
+                self_init_status = self.checkout_locked()
             else:
-                self.update_repo_from_vcs()
-            self_init_status = self.pull_repo()
+                if not from_repo:
+                    self.update_repo_from_vcs()
+                self_init_status = self.pull_repo()
         else:
             self_init_status = self.import_repo()
         if self_init_status:
-            for _v in self.iterate_children(log=True):
-                if _v.default_pull:
-                    _v.init_vcs(from_repo=from_repo)
-                elif _v.absoulte_work_dir.exists():
-                    _v.init_vcs(from_repo=from_repo)
+            SYNC_ENGINE.record(self)
         return self_init_status
+
+    def get_init_children(self):
+        """Child VcsMaps to initialize once this repo is checked out."""
+        for _v in self.iterate_children(log=True):
+            if _v.default_pull or _v.absoulte_work_dir.exists():
+                yield _v
+
+    def init_repo(self,from_repo=False):
+        scheduler = VcsScheduler()
+        scheduler.run([self],from_repo=from_repo)
+        return scheduler.get_status(self)
             
     
     def clear_child_repos(self):
@@ -232,6 +368,7 @@ class VCS(object):
     def switch_version(self,version:str):
         if self.type == "git":
             ret = run_command_shell(f"git -C {self.repo_path} checkout --recurse-submodules {version}")
+            invalidate_repo_state(self.repo_path)
             return ret.returncode == 0
         return False
     
@@ -259,18 +396,21 @@ class VCS(object):
     def clear_repo(self):
         if self.repo_path.exists():
             run_command_shell(f"rm -rf {self.repo_path}")
+            invalidate_repo_state(self.repo_path)
     
     def new_version(self,version:str):
         if self.type == "git":
             if version in self.get_branches_and_versions():
                 return self.switch_version(version)
             ret = run_command_shell(f"git -C {self.repo_path} checkout -b {version}")
+            invalidate_repo_state(self.repo_path)
             return ret.returncode == 0
         return False
     
     def add_child(self,label:str,vcs_map:'VcsMap'):
         # vcs_map.parent = self
-        self.children[label] = VcsMap(vcs_map.file_path,vcs_map.work_dir,default_pull=vcs_map.default_pull,parent=self)
+        self.children[label] = VcsMap(vcs_map.file_path,vcs_map.work_dir,vcs_map=vcs_map.vcs_map,\
+                                      default_pull=vcs_map.default_pull,parent=self)
         return self.children[label]
 
 @dataclass
@@ -318,39 +458,55 @@ class VcsMap:
     def import_vcs(self):
         # ret = run_command_shell(f"vcs import --recursive < {self.file_path}", work_dir=self.work_dir)
         # return ret.returncode == 0
-        function_list = []
-        for _v in self.iterate_vcs(log=True):
-            function_list.append((_v.import_repo,[],{}))
-        return run_functions_in_threads(function_list)
+        with TaskExecutor(max_workers=VCS_MAX_WORKERS,retries=VCS_RETRIES) as executor:
+            for _v in self.iterate_vcs(log=True):
+                executor.submit(_v.import_repo,name=str(_v.repo_path))
+            results = executor.wait()
+        return all(_r.ok for _r in results)
 
     def pull_vcs(self):
-        repos = [ _v.repo_path for _v in self.iterate_vcs(log=True)]
-        ret = run_command_shell(f"vcs pull {' '.join(repos)}", work_dir=self.work_dir)
-        return ret.returncode == 0
+        SYNC_ENGINE.prefetch(list(self.iterate_vcs()))
+        repos = []
+        for _v in self.iterate_vcs(log=True):
+            if SYNC_ENGINE.is_up_to_date(_v):
+                print(f"{_v.repo_path} is up to date")
+            else:
+                repos.append(str(_v.repo_path))
+        if len(repos) == 0:
+            return True
+        ret = run_command_shell(f"vcs pull {' '.join(repos)}", work_dir=self.absoulte_work_dir)
+        if ret.returncode != 0:
+            return False
+        for _v in self.iterate_vcs():
+            invalidate_repo_state(_v.repo_path)
+            SYNC_ENGINE.record(_v)
+        SYNC_ENGINE.save()
+        return True
     
     def print_status(self,fetch=False,children=False):
         for _v in self.iterate_vcs(log=True):
             _v.print_status(fetch=fetch,children=children)
             
     def init_vcs(self,from_repo=False):
-        function_list = []
+        scheduler = VcsScheduler()
+        scheduler.run(list(self.iterate_vcs()),from_repo=from_repo)
         for _v in self.iterate_vcs():
-            function_list.append((_v.init_repo,[],{"from_repo":from_repo}))
-        try:
-            run_functions_in_threads(function_list)
-        except Exception as e:
-            print(f"Error in init_vcs: {e}")
-            return False
+            if not scheduler.get_status(_v):
+                return False
         for _v in self.iterate_vcs():
             if not _v.is_repo_path_valid():
                 return False
         return True
 
     def clear_vcs(self):
-        function_list = []
-        for _v in self.iterate_vcs():
-            function_list.append((_v.clear_repo,[],{}))
-        return run_functions_in_threads(function_list)
+        with TaskExecutor(max_workers=VCS_MAX_WORKERS) as executor:
+            for _v in self.iterate_vcs():
+                executor.submit(_v.clear_repo,name=str(_v.repo_path))
+            results = executor.wait()
+        for _r in results:
+            if not _r.ok:
+                print(f"Failed to clear {_r.name}: {_r.error}")
+        return all(_r.ok for _r in results)
     
     def iterate_vcs(self,log=False):
         for _v in self.vcs_map.values():
@@ -359,10 +515,352 @@ class VcsMap:
             yield _v
 
 
+def get_dir_size(path:Path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for _f in files:
+            try:
+                size += os.lstat(os.path.join(root,_f)).st_size
+            except OSError:
+                pass
+    return size
+
+class MirrorCache:
+    """
+    Bare mirrors of every cloned remote, kept under the working path.
+
+    Full clones borrow objects from the mirror with `--reference --dissociate`,
+    so re-initializing a setup only fetches what changed upstream.
+    """
+    def __init__(self,cache_path:Path,enabled=True):
+        self.cache_path = cache_path
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+        self._path_locks : Dict[Path,threading.Lock] = {}
+
+    def mirror_path(self,url:str):
+        if is_remote_url(url):
+            remote = VcsRemote.from_url(url)
+            return self.cache_path/remote.hostname/remote.org_name/f"{remote.repo_name}.git"
+        local_name = re.sub(r"[^\w.-]+","_",url.split("://")[-1].strip("/"))
+        if not local_name.endswith(".git"):
+            local_name += ".git"
+        return self.cache_path/"local"/local_name
+
+    def _path_lock(self,path:Path):
+        with self._lock:
+            if path not in self._path_locks:
+                self._path_locks[path] = threading.Lock()
+            return self._path_locks[path]
+
+    def prepare(self,url:str):
+        """
+        Creates or refreshes the mirror of a url.
+
+        Returns:
+            Path: The mirror to reference, or None if no usable mirror exists.
+        """
+        if not self.enabled:
+            return None
+        path = self.mirror_path(url)
+        with self._path_lock(path):
+            if (path/"HEAD").exists():
+                run_command_shell(f"git -C {path} remote set-url origin {url}",preview=False)
+                # what is already local before the fetch is what the clone does not download again
+                cached_size = get_dir_size(path/"objects")
+                ret = run_command_shell(f"git -C {path} fetch --prune --quiet")
+                if ret.returncode != 0:
+                    print(f"Warning: could not refresh mirror {path}, using it as is")
+                    with self._lock:
+                        self.stale += 1
+                else:
+                    with self._lock:
+                        self.hits += 1
+                        self.bytes_saved += cached_size
+            else:
+                path.parent.mkdir(parents=True,exist_ok=True)
+                ret = run_command_shell(f"git clone --mirror --quiet {url} {path}")
+                with self._lock:
+                    self.misses += 1
+                if ret.returncode != 0:
+                    run_command_shell(f"rm -rf {path}",preview=False)
+                    return None
+        return path
+
+    def report(self):
+        """
+        Prints and resets the counters. Only refreshed mirrors count as hits, and
+        the size they held before the refresh is what was not downloaded again.
+        """
+        with self._lock:
+            hits, misses, stale, bytes_saved = self.hits, self.misses, self.stale, self.bytes_saved
+            self.hits = self.misses = self.stale = self.bytes_saved = 0
+        if hits + misses + stale == 0:
+            return
+        stale_note = f", {stale} not refreshed" if stale else ""
+        print(f"[mirror] {hits} hits, {misses} misses{stale_note}, ~{bytes_saved/(1024*1024):.1f} MiB not downloaded again"
+              f" ({self.cache_path})")
+
+MIRROR_CACHE = MirrorCache(VCS_MIRROR_PATH,enabled=os.environ.get("RAS_VCS_MIRROR","1") != "0")
+
+class HostLimiter:
+    """Hands out one semaphore per git host to cap concurrent connections to it."""
+    def __init__(self,host_limit:int=None):
+        self.host_limit = host_limit or VCS_HOST_MAX_CONNECTIONS
+        self._lock = threading.Lock()
+        self._semaphores : Dict[str,threading.Semaphore] = {}
+
+    def get(self,url:str):
+        host = VcsRemote.from_url(url).hostname if is_remote_url(url) else "local"
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.Semaphore(self.host_limit)
+            return self._semaphores[host]
+
+SHA_PATTERN = re.compile(r"^[0-9a-f]{40}$")
+
+def query_remote_tip(url:str,version:str):
+    """
+    Resolves a branch or tag on a remote to a commit sha with `git ls-remote`.
+
+    Returns:
+        str: The commit sha, or None if the ref cannot be resolved.
+    """
+    if SHA_PATTERN.match(version):
+        return version
+    ret = subprocess.run(["git","ls-remote",url,f"refs/heads/{version}",f"refs/tags/{version}",f"refs/tags/{version}^{{}}"],
+                         capture_output=True,env={**os.environ,"GIT_TERMINAL_PROMPT":"0"})
+    if ret.returncode != 0:
+        return None
+    refs = {}
+    for line in ret.stdout.decode().splitlines():
+        sha, _, ref = line.partition("\t")
+        refs[ref.strip()] = sha.strip()
+    for ref in (f"refs/heads/{version}",f"refs/tags/{version}^{{}}",f"refs/tags/{version}"):
+        if ref in refs:
+            return refs[ref]
+    return None
+
+class SyncEngine:
+    """
+    Detects repos whose checkout already matches the remote tip, so init and
+    pull can skip the checkout/pull round trips for them.
+
+    Remote tips of all existing repos are queried up front, grouped by host and
+    bounded by the per-host connection limit. Last-synced shas are recorded in
+    the `sync_manifest` state file.
+    """
+    def __init__(self,host_limit:int=None):
+        self.host_limit = host_limit or VCS_HOST_MAX_CONNECTIONS
+        self._lock = threading.Lock()
+        self._tips : Dict[tuple,str] = {}
+        self._manifest = None
+
+    def remote_tip(self,vcs:VCS):
+        key = (vcs.reformed_url,vcs.version)
+        with self._lock:
+            if key in self._tips:
+                return self._tips[key]
+        tip = query_remote_tip(*key)
+        with self._lock:
+            self._tips[key] = tip
+        return tip
+
+    def prefetch(self,roots:List[VCS]):
+        """Queries the remote tips of every existing repo below the roots."""
+        hosts : Dict[str,List[VCS]] = {}
+        for _root in roots:
+            for _v in _root.iterate_tree():
+                if _v.type == "git" and (_v.repo_path/".git").exists():
+                    host = VcsRemote.from_url(_v.url).hostname if is_remote_url(_v.url) else "local"
+                    hosts.setdefault(host,[]).append(_v)
+        def _query_host(vcs_list:List[VCS]):
+            with ThreadPoolExecutor(max_workers=self.host_limit) as executor:
+                list(executor.map(self.remote_tip,vcs_list))
+        if len(hosts) > 0:
+            with ThreadPoolExecutor(max_workers=len(hosts)) as executor:
+                list(executor.map(_query_host,hosts.values()))
+
+    def is_up_to_date(self,vcs:VCS):
+        if vcs.type != "git":
+            return False
+        state = get_repo_state(vcs.repo_path)
+        if (state is None) or (state.head_sha is None):
+            return False
+        tip = self.remote_tip(vcs)
+        if tip != state.head_sha:
+            return False
+        return (state.branch == vcs.version) or (state.detached and vcs.version == tip)
+
+    def record(self,vcs:VCS):
+        state = get_repo_state(vcs.repo_path)
+        if state is None:
+            return
+        with self._lock:
+            if self._manifest is None:
+                self._manifest = read_state("sync_manifest",{})
+            self._manifest[str(vcs.repo_path)] = {
+                "url": state.origin_url,
+                "version": vcs.version,
+                "sha": state.head_sha,
+                "synced_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            }
+
+    def save(self):
+        with self._lock:
+            if self._manifest is not None:
+                write_state("sync_manifest",self._manifest)
+
+SYNC_ENGINE = SyncEngine()
+
+class VcsScheduler:
+    """
+    Initializes a tree of VCS nodes on a single bounded TaskExecutor.
+
+    A node is started as soon as its parent checkout exists, so independent
+    subtrees do not wait on each other. The number of concurrent operations
+    against one git host is limited separately from the global worker count,
+    and transient git/network failures are retried with backoff.
+    """
+    def __init__(self,max_workers:int=None,host_limit:int=None,retries:int=None):
+        self.max_workers = max_workers or VCS_MAX_WORKERS
+        self.host_limit = host_limit or VCS_HOST_MAX_CONNECTIONS
+        self.retries = VCS_RETRIES if retries is None else retries
+        self._lock = threading.Lock()
+        self._host_limiter = HostLimiter(self.host_limit)
+        self._status : Dict[int,bool] = {}
+        self._results : List[TaskResult] = []
+        self._running = 0
+        self._total = 0
+        self._executor = None
+
+    def run(self,roots:List[VCS],from_repo=False):
+        """Initialize the roots and all their children, returning True if every node succeeded."""
+        if len(roots) == 0:
+            return True
+        start_time = time.monotonic()
+        SYNC_ENGINE.prefetch(roots)
+        with TaskExecutor(max_workers=self.max_workers,retries=self.retries,capture_output=True) as executor:
+            self._executor = executor
+            for _v in roots:
+                self._submit(_v,from_repo)
+            executor.wait()
+        self._executor = None
+        SYNC_ENGINE.save()
+        failed = [_r for _r in self._results if not _r.ok]
+        retried = [_r for _r in self._results if _r.attempts > 1]
+        print(f"[vcs] {self._total} repos in {time.monotonic()-start_time:.1f}s, "
+              f"{len(failed)} failed, {len(retried)} retried")
+        for _r in failed:
+            reason = "cancelled" if _r.cancelled else (_r.error or "command failed")
+            print(f"[vcs] failed: {_r.name} after {_r.attempts} attempt(s): {reason}")
+        return len(failed) == 0
+
+    def get_status(self,vcs:VCS):
+        return self._status.get(id(vcs),False)
+
+    def get_results(self):
+        return list(self._results)
+
+    def _submit(self,vcs:VCS,from_repo:bool):
+        with self._lock:
+            self._total += 1
+        self._executor.submit(self._init_node,vcs,from_repo,name=str(vcs.repo_path),
+                              on_done=partial(self._node_done,vcs,from_repo))
+
+    def _init_node(self,vcs:VCS,from_repo:bool):
+        with self._host_limiter.get(vcs.url):
+            with self._lock:
+                self._running += 1
+            try:
+                return vcs.init_self(from_repo=from_repo)
+            finally:
+                with self._lock:
+                    self._running -= 1
+
+    def _node_done(self,vcs:VCS,from_repo:bool,result:TaskResult):
+        if result.ok:
+            for _vcs_map in vcs.get_init_children():
+                for _child in _vcs_map.iterate_vcs():
+                    self._submit(_child,from_repo)
+        with self._lock:
+            self._status[id(vcs)] = result.ok
+            self._results.append(result)
+            done = len(self._status)
+            message = result.output
+            if result.error is not None:
+                message += f"Error in init of {vcs.repo_path}: {result.error}\n"
+            retry_info = f", {result.attempts} attempts" if result.attempts > 1 else ""
+            message += (f"[vcs {done}/{self._total}, {self._running} running] "
+                        f"{'done' if result.ok else 'FAILED'} {vcs.repo_path} ({result.wall_time:.1f}s{retry_info})\n")
+            # single write so the output of one repo is not interleaved with others
+            print(message,end="",flush=True)
+
+YamlLoader = getattr(yaml,"CSafeLoader",yaml.SafeLoader)
+
+class ManifestCache:
+    """
+    Parsed contents of the .repos files, kept in memory for the process and on
+    disk in the `manifest_cache` state file.
+
+    An entry is reused while the file's mtime and size are unchanged, or when
+    they changed but its sha256 did not. Only the file contents are cached:
+    the VCS/VcsMap tree is rebuilt from them on every call because callers
+    mutate it.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = None
+        self._dirty = False
+        self.stats = {"memory":0,"disk":0,"parsed":0}
+
+    def _load_entries(self):
+        if self._entries is None:
+            self._entries = read_state("manifest_cache",{})
+
+    def load(self,vcs_file:Path):
+        """Returns the `repositories` mapping of a .repos file."""
+        key = str(Path(vcs_file).absolute())
+        stat = os.stat(key)
+        with self._lock:
+            self._load_entries()
+            entry = self._entries.get(key)
+            if entry and entry["mtime_ns"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+                self.stats["memory" if entry.get("loaded") else "disk"] += 1
+                entry["loaded"] = True
+                return entry["repositories"]
+        data = Path(key).read_bytes()
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            if entry and entry["sha256"] == digest:
+                self.stats["disk"] += 1
+            else:
+                entry = {"sha256":digest,"repositories":yaml.load(data,Loader=YamlLoader)["repositories"]}
+                self.stats["parsed"] += 1
+            entry.update({"mtime_ns":stat.st_mtime_ns,"size":stat.st_size,"loaded":True})
+            self._entries[key] = entry
+            self._dirty = True
+            return entry["repositories"]
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = {k:{_k:_v for _k,_v in v.items() if _k != "loaded"} for k,v in self._entries.items()}
+            self._dirty = False
+        try:
+            write_state("manifest_cache",entries)
+        except OSError as e:
+            print(f"Warning: could not write manifest cache: {e}")
+
+MANIFEST_CACHE = ManifestCache()
+
 def parse_vcs_file(vcs_file:Path,parent_path:Path=None):
-    vcs_dict = {}
-    with vcs_file.open() as f:
-        vcs_dict = yaml.safe_load(f)["repositories"]
+    vcs_dict = MANIFEST_CACHE.load(vcs_file)
     ret_dict = {}
     for k,v in vcs_dict.items():
         path = k
@@ -377,14 +875,15 @@ def write_vcs_file(vcs_file:Path,vcs_dict:Dict[str,VCS]):
         yaml.dump({'repositories':vcs_dict},f)
 
 def get_remote_url(repo_path:Path):
-    ret = subprocess.run(f'git -C {repo_path} remote get-url origin',shell=True,capture_output=True)
-    if ret.returncode != 0:
+    state = get_repo_state(repo_path)
+    if state is None:
         return None
-    return ret.stdout.decode().strip()
+    return state.origin_url
 
 def set_remote_url(repo_path:Path,url:str):
-    print(f"Switch url {repo_path}")
+    task_print(f"Switch url {repo_path}")
     ret = run_command_shell(f'git -C {repo_path} remote set-url origin {url}')
+    invalidate_repo_state(repo_path)
     return ret.returncode == 0
 
 def get_path_GitUrlType(repo_path:Path):
@@ -412,27 +911,52 @@ class RemoteMeta(type):
     # def get_reformed_url(cls,url):
 @dataclass
 class VcsRemote(object):
-    url_mode : ClassVar[GitUrlType] = GitUrlType.HTTPS
+    url_mode : ClassVar[GitUrlType] = None
+    url_mode_lock : ClassVar[threading.Lock] = threading.Lock()
     url_type : GitUrlType
     hostname : str
     org_name : str
     repo_name : str
+    port : str = None
 
     @classmethod
     def init(cls):
+        """Resolve the url mode from the setup repo remote and persist it."""
+        cls.url_mode = GitUrlType.HTTPS
         setup_repo = get_setup_vcs_mapping()
-        setup_repo.update_vcs_from_repo()
-        if setup_repo.is_repo_path_valid():
+        if isinstance(setup_repo,VCS) and (setup_repo.repo_path/".git").exists():
             setup_repo.update_vcs_from_repo()
-            cls.url_mode = VcsRemote.from_url(setup_repo.url).url_type
+            if setup_repo.is_repo_path_valid():
+                cls.url_mode = VcsRemote.from_url(setup_repo.url).url_type
+        cls.save_url_mode()
+        return cls.url_mode
+
+    @classmethod
+    def get_url_mode(cls):
+        """Lazily resolve the url mode, preferring the persisted state over git."""
+        with cls.url_mode_lock:
+            if cls.url_mode is None:
+                url_mode = read_state("vcs",{}).get("url_mode")
+                if url_mode in GitUrlType._member_names_:
+                    cls.url_mode = GitUrlType[url_mode]
+                else:
+                    cls.init()
+        return cls.url_mode
+
+    @classmethod
+    def save_url_mode(cls):
+        state = read_state("vcs",{})
+        state["url_mode"] = cls.url_mode.name
+        write_state("vcs",state)
 
     @classmethod
     def set_url_mode(cls,mode:GitUrlType):
         if not isinstance(mode,GitUrlType):
             raise ValueError(f"Invalid modetype {type(mode)}")
-        if mode==cls.url_mode:
+        if mode==cls.get_url_mode():
             return
         cls.url_mode = mode
+        cls.save_url_mode()
         setup_repo = get_setup_vcs_mapping()
         setup_repo.update_vcs_from_repo()
         if setup_repo.is_repo_path_valid():
@@ -445,36 +969,31 @@ class VcsRemote(object):
 
     def get_url(self,reformed=False):
         if reformed:
+            url_mode = VcsRemote.get_url_mode()
             return VcsRemote(
-                url_type=VcsRemote.url_mode,
+                url_type=url_mode,
                 hostname=self.hostname,
                 org_name=self.org_name,
-                repo_name=self.repo_name).get_url()
+                repo_name=self.repo_name,
+                # a port only applies to the scheme it was given for
+                port=self.port if url_mode == self.url_type else None).get_url()
+        if self.port:
+            return GIT_URL_PORT_FORMATS[self.url_type].format_map(self.__dict__)
         return self.url_type.value.format_map(self.__dict__)
     
     
     @staticmethod
     def from_url(url : str):
-        url_type : GitUrlType
-        _except = None
-        for url_type in GitUrlType._member_map_.values():
-            try:
-                parsed_dict = parse_with_format(url_type.value,url)
-                return VcsRemote(
-                    url_type=url_type,
-                    **parsed_dict
-                )
-            except Exception as e:
-                _except = e
-        raise ValueError(f"No way to form remote from url {url}: {_except}")
+        parsed = parse_remote_url(url) if isinstance(url,str) else None
+        if parsed is None:
+            raise ValueError(f"No way to form remote from url {url}")
+        url_type, fields = parsed
+        return VcsRemote(url_type=url_type,**dict(fields))
 
     def is_same_remote(self,other:'VcsRemote'):
         return (self.repo_name==other.repo_name) and\
                 (self.org_name==other.org_name) and\
                 (self.hostname==other.hostname)
-    
-    
-VcsRemote.init()
 
 
 
@@ -515,14 +1034,88 @@ def vcs_fetch_repos(repos_file:Path,target_path:Path,pull=False):
 #     vcs_fetch_repos(WORKING_PATH/'repos'/"ros2.repos",ROS2_PKGS_PATH,pull=True)
 
 
+def set_clone_mode(args: argparse.Namespace):
+    if getattr(args,"clone_mode",None):
+        VCS.default_clone_mode = args.clone_mode
+
+def get_lock_base_path():
+    """Lockfile keys are repo paths relative to the parent of the setup repo."""
+    return WORKING_PATH.parent
+
+def get_lock_key(vcs:VCS):
+    repo_path = Path(vcs.repo_path).absolute()
+    base_path = get_lock_base_path()
+    if repo_path.is_relative_to(base_path):
+        return str(repo_path.relative_to(base_path))
+    return str(repo_path)
+
+def read_lockfile(lock_path:Path):
+    with Path(lock_path).open() as f:
+        return yaml.load(f,Loader=YamlLoader)["repositories"]
+
+def apply_lockfile(vcs_list:List[VCS],lock:dict):
+    """Pins every VCS found in the lock to its locked commit."""
+    for _v in vcs_list:
+        entry = lock.get(get_lock_key(_v))
+        if entry is None:
+            print(f"Warning: {_v.repo_path} is not in the lockfile, using {_v.version}")
+            continue
+        _v.version = entry["version"]
+        _v.locked = True
+
+def get_locked(args: argparse.Namespace):
+    locked = getattr(args,"locked",None)
+    if not locked:
+        return None
+    lock_path = Path(locked)
+    if not lock_path.exists():
+        raise FileNotFoundError(f"Lockfile {lock_path} not found, run 'ras vcs lock' first")
+    print(f"Using lockfile {lock_path}")
+    return read_lockfile(lock_path)
+
+def lock_vcs(args: argparse.Namespace):
+    """Writes the exact commit of every repo in the setup tree to a lockfile."""
+    repos_vcs = get_repos_vcs()
+    main_vcs = get_setup_vcs_mapping()
+    main_vcs.update_vcs_from_repo()
+    vcs_list = [repos_vcs] + list(main_vcs.iterate_tree())
+    def _resolve(vcs:VCS):
+        state = get_repo_state(vcs.repo_path) if vcs.repo_path.exists() else None
+        if state is not None:
+            if not vcs.is_repo_path_valid():
+                print(f"Warning: {vcs.repo_path} has an unexpected remote")
+            return state.head_sha
+        return query_remote_tip(vcs.reformed_url,vcs.version)
+    with ThreadPoolExecutor(max_workers=VCS_MAX_WORKERS) as executor:
+        shas = list(executor.map(_resolve,vcs_list))
+    lock = {}
+    for _v,_sha in zip(vcs_list,shas):
+        if _sha is None:
+            print(f"Warning: could not resolve {_v.repo_path} at {_v.version}, not locked")
+            continue
+        lock[get_lock_key(_v)] = {"type":_v.type,"url":_v.url,"version":_sha,"ref":_v.version}
+    lock_path = Path(getattr(args,"output",None) or LOCKFILE_PATH)
+    with lock_path.open("w") as f:
+        yaml.safe_dump({"repositories":lock},f,sort_keys=False)
+    print(f"Locked {len(lock)} repositories to {lock_path}")
+    return lock_path
+
 def init_setup(args: argparse.Namespace):
     status = True
+    set_clone_mode(args)
+    lock = get_locked(args)
     repos_vcs = get_repos_vcs()
-    status = repos_vcs.init_repo(from_repo=True)
+    if lock is not None:
+        apply_lockfile([repos_vcs],lock)
+    status = repos_vcs.init_repo(from_repo=(lock is None))
     if not status:
+        MIRROR_CACHE.report()
         return False
     main_vcs = get_setup_vcs_mapping()
+    if lock is not None:
+        apply_lockfile(list(main_vcs.iterate_tree()),lock)
     status = main_vcs.init_repo(from_repo=False)
+    MIRROR_CACHE.report()
     if not status:
         return False
     return True
@@ -532,7 +1125,12 @@ def pull_repos_vcs(args: argparse.Namespace):
     repos_vcs.update_vcs_from_repo()
     if args.version:
         repos_vcs.switch_version(args.version)
-    repos_vcs.pull_repo(switch_version=False)
+        repos_vcs.update_vcs_from_repo()
+    if SYNC_ENGINE.is_up_to_date(repos_vcs):
+        print(f"{repos_vcs.repo_path} is up to date")
+    elif repos_vcs.pull_repo(switch_version=False):
+        SYNC_ENGINE.record(repos_vcs)
+        SYNC_ENGINE.save()
     return repos_vcs.get_current_version()
 
 def repos_vcs_version(args: argparse.Namespace):
@@ -549,9 +1147,95 @@ def repos_vcs_version(args: argparse.Namespace):
     return repos_vcs.get_current_version()
 
 def init_app_setup(args: argparse.Namespace):
+    set_clone_mode(args)
+    lock = get_locked(args)
     main_vcs = get_setup_vcs_mapping()
     main_vcs.update_vcs_from_repo()
-    return main_vcs.children[args.app].init_vcs(from_repo=False)
+    app_vcs_map = main_vcs.children[args.app]
+    if lock is not None:
+        for _v in app_vcs_map.iterate_vcs():
+            apply_lockfile(list(_v.iterate_tree()),lock)
+    status = app_vcs_map.init_vcs(from_repo=False)
+    MIRROR_CACHE.report()
+    return status
+
+@dataclass
+class RepoStatus:
+    path: str
+    state: str
+    expected: str = None
+    actual: str = None
+    branch: str = None
+    upstream: str = None
+    ahead: int = 0
+    behind: int = 0
+    dirty: int = 0
+    untracked: int = 0
+    fetch_ok: bool = None
+
+    @property
+    def version_ok(self):
+        return self.expected in (self.actual,self.branch)
+
+    def to_dict(self):
+        return {**asdict(self),"version_ok": self.version_ok}
+
+def parse_porcelain_status(text:str,status:RepoStatus):
+    """Fills a RepoStatus from `git status --porcelain=v2 --branch` output."""
+    for line in text.splitlines():
+        if line.startswith("# branch.head "):
+            head = line[len("# branch.head "):]
+            status.branch = None if head == "(detached)" else head
+        elif line.startswith("# branch.upstream "):
+            status.upstream = line[len("# branch.upstream "):]
+        elif line.startswith("# branch.ab "):
+            ahead, behind = line[len("# branch.ab "):].split()
+            status.ahead, status.behind = int(ahead), -int(behind)
+        elif line[:2] in ("1 ","2 ","u "):
+            status.dirty += 1
+        elif line.startswith("? "):
+            status.untracked += 1
+    return status
+
+def collect_repo_status(vcs:VCS,fetch=False,host_limiter:HostLimiter=None):
+    status = RepoStatus(str(vcs.repo_path),"ok",expected=vcs.version)
+    if not vcs.is_repo_path_valid():
+        status.state = "corrupted" if vcs.repo_path.exists() else "missing"
+        return status
+    if fetch:
+        with host_limiter.get(vcs.url):
+            ret = subprocess.run(["git","-C",str(vcs.repo_path),"fetch","--quiet"],capture_output=True,
+                                 env={**os.environ,"GIT_TERMINAL_PROMPT":"0"})
+        status.fetch_ok = ret.returncode == 0
+        invalidate_repo_state(vcs.repo_path)
+    state = get_repo_state(vcs.repo_path)
+    status.actual = state.version if state else None
+    ret = subprocess.run(["git","-C",str(vcs.repo_path),"status","--porcelain=v2","--branch"],capture_output=True)
+    if ret.returncode != 0:
+        status.state = "error"
+        return status
+    return parse_porcelain_status(ret.stdout.decode(),status)
+
+def format_status_table(statuses:List[RepoStatus],base_path:Path=None):
+    header = ["repo","branch","expected","ahead","behind","dirty","untracked","state"]
+    rows = []
+    for _s in statuses:
+        path = _s.path
+        if base_path is not None and Path(path).is_relative_to(base_path):
+            path = str(Path(path).relative_to(base_path)) or "."
+        state = _s.state
+        if state == "ok" and not _s.version_ok:
+            state = "version mismatch"
+        if _s.fetch_ok is False:
+            state += " (fetch failed)"
+        branch = _s.branch or (_s.actual[:10] if _s.actual else "-")
+        rows.append([path,branch,_s.expected or "-",str(_s.ahead),str(_s.behind),str(_s.dirty),str(_s.untracked),state])
+    widths = [max(len(r[i]) for r in [header]+rows) for i in range(len(header))]
+    lines = ["  ".join(c.ljust(w) for c,w in zip(header,widths)).rstrip()]
+    lines.append("  ".join("-"*w for w in widths))
+    for _r in rows:
+        lines.append("  ".join(c.ljust(w) for c,w in zip(_r,widths)).rstrip())
+    return "\n".join(lines)
 
 def get_vcs_status(args: argparse.Namespace):
     main_vcs = get_setup_vcs_mapping()
@@ -559,7 +1243,15 @@ def get_vcs_status(args: argparse.Namespace):
     fetch_vcs=False
     if hasattr(args,"fetch") and args.fetch:
         fetch_vcs=True
-    main_vcs.print_status(fetch=fetch_vcs,children=True)
+    vcs_list = list(main_vcs.iterate_tree())
+    host_limiter = HostLimiter()
+    with ThreadPoolExecutor(max_workers=VCS_MAX_WORKERS) as executor:
+        statuses = list(executor.map(partial(collect_repo_status,fetch=fetch_vcs,host_limiter=host_limiter),vcs_list))
+    if getattr(args,"json",False):
+        print(json.dumps([_s.to_dict() for _s in statuses],indent=2))
+    else:
+        print(format_status_table(statuses,main_vcs.repo_path.parent))
+    return statuses
 
 def clear_setup(args: argparse.Namespace):
     main_vcs = get_setup_vcs_mapping()
@@ -575,7 +1267,9 @@ def url_mode(args: argparse.Namespace):
             VcsRemote.set_url_mode(GitUrlType._member_map_[url_mode])
         else:
             print(f"Invalid url_mode {url_mode}")
-    print(f"Current url-mode: {VcsRemote.url_mode.name.lower()}")
+    else:
+        VcsRemote.init()
+    print(f"Current url-mode: {VcsRemote.get_url_mode().name.lower()}")
     
 
 
@@ -0,0 +1,276 @@
+"""
+Copyright (C) 2024 Harsh Davda
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+For inquiries or further information, you may contact:
+Harsh Davda
+Email: info@opensciencestack.org
+"""
+
+from .common import WORKING_PATH,ROS2_PKGS_PATH,Path,subprocess,read_state,write_state,TaskExecutor
+from .repo_state import get_repo_state
+from dataclasses import dataclass, field
+import xml.etree.ElementTree as ET
+import hashlib
+import os
+
+# colcon builds this many packages at once, each with its own make jobs
+BUILD_JOBS = int(os.environ.get("RAS_BUILD_JOBS",os.cpu_count() or 1))
+
+def get_workspace_paths(app: str):
+    """
+    Host source directories of an app workspace, as mounted into its container.
+
+    Returns:
+        tuple: (workspace path, list of source roots)
+    """
+    workspace_path = WORKING_PATH/"apps"/f"ras_{app}_app"/"ros2_ws"
+    src_roots = [workspace_path/"src",ROS2_PKGS_PATH]
+    if app == "server":
+        src_roots.append(WORKING_PATH/"assets")
+    return workspace_path, src_roots
+
+def read_package_name(package_xml: Path):
+    try:
+        name = ET.parse(package_xml).getroot().findtext("name")
+    except (ET.ParseError,OSError):
+        return None
+    return name.strip() if name else None
+
+def find_packages(src_roots: list):
+    """
+    Finds ROS packages the way colcon does: directories with a package.xml,
+    not descending into packages or directories marked COLCON_IGNORE.
+
+    Returns:
+        dict: Package name to host path.
+    """
+    packages = {}
+    mount_points = {ROS2_PKGS_PATH.name,"common_pkgs","assets"}
+    for _root in src_roots:
+        if not _root.is_dir():
+            continue
+        for dir_path, dirs, files in os.walk(_root):
+            if "COLCON_IGNORE" in files:
+                dirs.clear()
+                continue
+            if "package.xml" in files:
+                name = read_package_name(Path(dir_path)/"package.xml")
+                if name is not None:
+                    packages.setdefault(name,Path(dir_path))
+                dirs.clear()
+                continue
+            if Path(dir_path) == _root:
+                # empty mount points of the other source roots
+                dirs[:] = [_d for _d in dirs if _d not in mount_points]
+            dirs[:] = sorted(_d for _d in dirs if not _d.startswith("."))
+    return packages
+
+def hash_path_entry(digest, path: Path, rel_path: str):
+    digest.update(rel_path.encode() + b"\0")
+    try:
+        with open(path,"rb") as f:
+            for chunk in iter(lambda: f.read(1<<20),b""):
+                digest.update(chunk)
+    except (IsADirectoryError,FileNotFoundError):
+        digest.update(b"<missing>")
+    digest.update(b"\n")
+
+def fingerprint_repo_packages(repo_path: Path, packages: dict):
+    """
+    Fingerprints the packages inside one git repository with a single
+    `git cat-file` and a single `git status` call.
+
+    Args:
+        repo_path (Path): The repository working tree.
+        packages (dict): Package name to path, all inside repo_path.
+
+    Returns:
+        dict: Package name to {"path","commit","tree","dirty"}.
+    """
+    state = get_repo_state(repo_path)
+    rel_paths = {_name: _path.relative_to(repo_path).as_posix() for _name, _path in packages.items()}
+    rel_paths = {_name: ("" if _rel == "." else _rel) for _name, _rel in rel_paths.items()}
+    query = "".join(f"HEAD:{_rel}\n" for _rel in rel_paths.values())
+    ret = subprocess.run(["git","-C",str(repo_path),"cat-file","--batch-check"],input=query.encode(),capture_output=True)
+    trees = {}
+    for _name, _line in zip(rel_paths, ret.stdout.decode().splitlines()):
+        _fields = _line.split()
+        if len(_fields) == 3 and _fields[1] == "tree":
+            trees[_name] = _fields[0]
+    ret = subprocess.run(["git","-C",str(repo_path),"status","--porcelain=v1","-z","--untracked-files=all"],capture_output=True)
+    changed = []
+    entries = ret.stdout.decode(errors="replace").split("\0")
+    index = 0
+    while index < len(entries):
+        entry = entries[index]
+        index += 1
+        if len(entry) < 4:
+            continue
+        changed.append(entry[3:])
+        if entry[0] in "RC" and index < len(entries):
+            # the source path of a rename/copy follows as its own entry
+            changed.append(entries[index])
+            index += 1
+    fingerprints = {}
+    for _name, _rel in rel_paths.items():
+        if _name not in trees:
+            # ignored by this repo or a nested repo, git does not see its changes
+            fingerprints[_name] = fingerprint_plain_package(packages[_name])
+            continue
+        prefix = f"{_rel}/" if _rel else ""
+        digest = hashlib.sha256()
+        for _changed in sorted(_p for _p in changed if _p.startswith(prefix)):
+            hash_path_entry(digest,repo_path/_changed,_changed)
+        fingerprints[_name] = {
+            "path": str(packages[_name]),
+            "commit": state.head_sha if state else None,
+            "tree": trees.get(_name),
+            "dirty": digest.hexdigest(),
+        }
+    return fingerprints
+
+def fingerprint_plain_package(package_path: Path):
+    """
+    Fingerprints a package outside any known repository by file stats.
+    """
+    digest = hashlib.sha256()
+    for dir_path, dirs, files in os.walk(package_path):
+        dirs[:] = sorted(_d for _d in dirs if not _d.startswith("."))
+        for _name in sorted(files):
+            _path = Path(dir_path)/_name
+            try:
+                _stat = _path.stat()
+            except OSError:
+                continue
+            digest.update(f"{_path.relative_to(package_path)}\0{_stat.st_size}\0{_stat.st_mtime_ns}\n".encode())
+    return {"path": str(package_path), "commit": None, "tree": None, "dirty": digest.hexdigest()}
+
+def get_known_repo_paths():
+    from .vcs import get_setup_vcs_mapping
+    main_vcs = get_setup_vcs_mapping()
+    if main_vcs is None:
+        return []
+    repo_paths = [Path(_v.repo_path).absolute() for _v in main_vcs.iterate_tree()]
+    return [_p for _p in repo_paths if (_p/".git").exists()]
+
+def collect_package_fingerprints(app: str):
+    """
+    Fingerprints every package of an app workspace, grouping packages by the
+    deepest repository from get_setup_vcs_mapping() that contains them.
+
+    Returns:
+        dict: Package name to fingerprint.
+    """
+    _, src_roots = get_workspace_paths(app)
+    packages = find_packages(src_roots)
+    repo_paths = sorted(get_known_repo_paths(),key=lambda _p: len(_p.parts),reverse=True)
+    by_repo = {}
+    plain = {}
+    for _name, _path in packages.items():
+        _path = _path.absolute()
+        repo_path = next((_r for _r in repo_paths if _path.is_relative_to(_r)),None)
+        if repo_path is None:
+            plain[_name] = _path
+        else:
+            by_repo.setdefault(repo_path,{})[_name] = _path
+    fingerprints = {}
+    with TaskExecutor() as executor:
+        for _repo_path, _packages in by_repo.items():
+            executor.submit(fingerprint_repo_packages,_repo_path,_packages,name=str(_repo_path))
+        for _name, _path in plain.items():
+            executor.submit(lambda name, path: {name: fingerprint_plain_package(path)},_name,_path,name=_name)
+        results = executor.wait()
+    for _result in results:
+        if not _result.ok:
+            raise RuntimeError(f"Could not fingerprint {_result.name}: {_result.error}")
+        fingerprints.update(_result.value)
+    return fingerprints
+
+@dataclass
+class WorkspaceBuildPlan:
+    """
+    Data class describing which packages of an app workspace need building.
+
+    Attributes:
+        app (str): The app namespace (robot/server).
+        fingerprints (dict): Current fingerprint of every package.
+        packages (list): Changed packages, None for a full build.
+        reason (str): Why the build is full, partial or skipped.
+    """
+    app: str
+    fingerprints: dict = field(default_factory=dict)
+    packages: list = None
+    reason: str = ""
+
+    @property
+    def up_to_date(self):
+        return self.packages is not None and len(self.packages) == 0
+
+    def record(self):
+        """Stores the fingerprints after a successful build."""
+        write_state(f"workspace_{self.app}",self.fingerprints)
+
+def is_same_source(old: dict, new: dict):
+    keys = ("path","tree","dirty")
+    return all(old.get(_k) == new.get(_k) for _k in keys)
+
+def plan_workspace_build(app: str, clean=False):
+    """
+    Compares the packages of an app workspace with the last successful build.
+
+    Args:
+        app (str): The app namespace (robot/server).
+        clean (bool, optional): Plan a full build. Defaults to False.
+
+    Returns:
+        WorkspaceBuildPlan: The packages to build.
+    """
+    workspace_path, _ = get_workspace_paths(app)
+    try:
+        fingerprints = collect_package_fingerprints(app)
+    except RuntimeError as e:
+        return WorkspaceBuildPlan(app,{},None,f"full build, {e}")
+    if clean:
+        return WorkspaceBuildPlan(app,fingerprints,None,"full build, --clean given")
+    if not (workspace_path/"install").exists():
+        return WorkspaceBuildPlan(app,fingerprints,None,"full build, workspace was never built")
+    recorded = read_state(f"workspace_{app}",None)
+    if not recorded:
+        return WorkspaceBuildPlan(app,fingerprints,None,"full build, no record of the last build")
+    changed = sorted(_name for _name, _fp in fingerprints.items()
+                     if (_name not in recorded) or not is_same_source(recorded[_name],_fp))
+    if len(changed) == 0:
+        return WorkspaceBuildPlan(app,fingerprints,[],"all packages unchanged since the last build")
+    return WorkspaceBuildPlan(app,fingerprints,changed,f"{len(changed)} changed package(s): {' '.join(changed)}")
+
+def get_ccache_path(app: str):
+    """
+    Host ccache directory, inside the cache dir mounted at /ras_<app>_app/cache.
+    """
+    return WORKING_PATH/"cache"/"ccache"/app
+
+def get_workspace_build_cmd(app: str, packages: list = None):
+    """
+    The colcon command for an app workspace, building only `packages` and
+    their dependents if given. ccache is used when the image provides it.
+    """
+    ccache_dir = f"/ras_{app}_app/cache/ccache/{app}"
+    ccache_setup = (f"if command -v ccache >/dev/null; then export CCACHE_DIR={ccache_dir} "
+                    f"CMAKE_C_COMPILER_LAUNCHER=ccache CMAKE_CXX_COMPILER_LAUNCHER=ccache; fi")
+    build_cmd = f"colcon build --symlink-install --parallel-workers {BUILD_JOBS}"
+    if packages:
+        build_cmd += " --packages-above " + " ".join(packages)
+    return f"{ccache_setup} && {build_cmd}"
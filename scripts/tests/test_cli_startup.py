@@ -0,0 +1,53 @@
+"""
+Startup check of the ras CLI: `ras --help` and tab completion must not import
+the command handlers, and must stay within a generous time budget on top of a
+bare interpreter start. benchmarks/startup.py reports the same cases in
+detail and compares them with another revision.
+
+Run from the scripts directory:
+    python3 -m unittest discover tests
+"""
+
+import statistics
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+SCRIPTS_PATH = Path(__file__).absolute().parent.parent
+sys.path.insert(0, str(SCRIPTS_PATH/"benchmarks"))
+
+import startup
+
+# Far above the usual 20-40 ms, so only a regression like importing the handlers fails it
+STARTUP_BUDGET_MS = 300
+STARTUP_RUNS = 3
+
+class CliStartup(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.TemporaryDirectory(prefix="ras_startup_test_")
+        # other test modules point RAS_DOCKER_PATH at their temporary directories
+        cls.env = {**startup.get_env(), "RAS_DOCKER_PATH": str(SCRIPTS_PATH.parent)}
+        cls.cases = startup.get_cases(SCRIPTS_PATH, str(Path(cls.tmp_dir.name)/"completions"))
+        cls.interpreter = startup.get_interpreter_time(cls.env, STARTUP_RUNS)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+
+    def test_no_handler_imports(self):
+        for case, (argv, case_env) in self.cases.items():
+            with self.subTest(case=case):
+                imports = startup.get_imports(argv, {**self.env, **case_env})
+                self.assertIn("ras_docker.arg_parser", imports)
+                self.assertEqual(startup.get_handler_imports(imports), [])
+
+    def test_budget(self):
+        for case, (argv, case_env) in self.cases.items():
+            with self.subTest(case=case):
+                median = statistics.median(startup.run_case(argv, {**self.env, **case_env}, STARTUP_RUNS))
+                self.assertLess(median - self.interpreter, STARTUP_BUDGET_MS)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,178 @@
+"""
+DockerEngineClient against a stub daemon on a Unix socket.
+
+The stub serves canned responses per path: plain JSON bodies, chunked
+JSON-lines and raw streams, and error statuses with a docker error message.
+
+Run from the scripts directory:
+    python3 -m unittest discover tests
+"""
+
+import json
+import os
+import shutil
+import socketserver
+import sys
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler
+from pathlib import Path
+
+TMP_PATH = Path(tempfile.mkdtemp(prefix="ras_docker_api_test_"))
+os.environ["RAS_DOCKER_PATH"] = str(TMP_PATH/"ras")
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+
+from ras_docker import docker_api
+from ras_docker.docker_api import DockerEngineClient, DockerApiError, DockerUnavailable
+
+RAW_BODY = bytes(range(256)) * 1000 + b"tail"
+# path -> (status, body, chunks); chunks are sent with chunked transfer encoding
+ROUTES = {
+    "/_ping": (200, b"OK", None),
+    "/images/ras_base%3Aras_local/json": (200, json.dumps({"Id": "sha256:aaa"}).encode(), None),
+    "/images/missing/json": (404, json.dumps({"message": "No such image: missing"}).encode(), None),
+    "/containers/broken/json": (500, b"daemon exploded", None),
+    "/events": (200, None, [json.dumps({"Action": "start"}).encode() + b"\n",
+                            b"\n",
+                            # one message split across two chunks
+                            b'{"Action": "di', b'e"}\n']),
+    "/images/get": (200, None, [RAW_BODY[:100003], RAW_BODY[100003:]]),
+}
+
+class StubDaemonHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def address_string(self):
+        return "unix"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        status, body, chunks = ROUTES.get(self.path.partition("?")[0], (404, b'{"message": "page not found"}', None))
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if chunks is None:
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for _chunk in chunks:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(_chunk), _chunk))
+        self.wfile.write(b"0\r\n\r\n")
+
+class StubDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str):
+        super().__init__(socket_path, StubDaemonHandler)
+        self.paths = []
+
+class DockerEngineClientTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.socket_path = str(TMP_PATH/"docker.sock")
+        cls.daemon = StubDaemon(cls.socket_path)
+        threading.Thread(target=cls.daemon.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.daemon.shutdown()
+        cls.daemon.server_close()
+        os.unlink(cls.socket_path)
+
+    def setUp(self):
+        self.client = DockerEngineClient(self.socket_path)
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_request(self):
+        self.assertTrue(self.client.ping())
+        self.assertEqual(self.client.image_inspect("ras_base:ras_local"), {"Id": "sha256:aaa"})
+        self.assertIsNone(self.client.image_inspect("missing"))
+
+    def test_error_status(self):
+        with self.assertRaises(DockerApiError) as ctx:
+            self.client.request("GET", "/images/missing/json")
+        self.assertEqual((ctx.exception.status, ctx.exception.message), (404, "No such image: missing"))
+        with self.assertRaises(DockerApiError) as ctx:
+            self.client.request("GET", "/containers/broken/json")
+        self.assertEqual((ctx.exception.status, ctx.exception.message), (500, "daemon exploded"))
+        # the shared connection is still usable after an error
+        self.assertTrue(self.client.ping())
+
+    def test_stream_json(self):
+        messages = list(self.client.stream_json("GET", "/events", params={"filters": json.dumps({"type": ["container"]})}))
+        self.assertEqual(messages, [{"Action": "start"}, {"Action": "die"}])
+        self.assertEqual(self.daemon.paths[-1], "/events?filters=%7B%22type%22%3A+%5B%22container%22%5D%7D")
+
+    def test_stream_raw(self):
+        chunks = list(self.client.stream_raw("GET", "/images/get", chunk_size=65536))
+        self.assertEqual(b"".join(chunks), RAW_BODY)
+        self.assertTrue(all(len(_chunk) <= 65536 for _chunk in chunks))
+
+    def test_stream_error_status(self):
+        with self.assertRaises(DockerApiError) as ctx:
+            list(self.client.stream_json("GET", "/images/missing/json"))
+        self.assertEqual(ctx.exception.status, 404)
+
+    def test_unavailable(self):
+        client = DockerEngineClient(str(TMP_PATH/"missing.sock"))
+        with self.assertRaises(DockerUnavailable):
+            client.ping()
+        with self.assertRaises(DockerUnavailable):
+            list(client.stream_json("GET", "/events"))
+
+class GetDockerClientTest(unittest.TestCase):
+    def setUp(self):
+        self.environ = dict(os.environ)
+        self.socket_path = str(TMP_PATH/"client.sock")
+        self.daemon = StubDaemon(self.socket_path)
+        threading.Thread(target=self.daemon.serve_forever, daemon=True).start()
+        os.environ["DOCKER_HOST"] = f"unix://{self.socket_path}"
+        os.environ.pop("RAS_DOCKER_CLI", None)
+        self.reset_client()
+
+    def tearDown(self):
+        self.reset_client()
+        os.environ.clear()
+        os.environ.update(self.environ)
+        self.daemon.shutdown()
+        self.daemon.server_close()
+        os.unlink(self.socket_path)
+
+    def reset_client(self):
+        if docker_api._docker_client is not None:
+            docker_api._docker_client.close()
+        docker_api._docker_client = None
+        docker_api._docker_client_checked = False
+
+    def test_socket(self):
+        client = docker_api.get_docker_client()
+        self.assertIsNotNone(client)
+        self.assertEqual(client.socket_path, self.socket_path)
+        self.assertIs(docker_api.get_docker_client(), client)
+
+    def test_cli_fallback(self):
+        os.environ["RAS_DOCKER_CLI"] = "1"
+        self.assertIsNone(docker_api.get_docker_client())
+        self.assertEqual(self.daemon.paths, [])
+
+    def test_missing_socket(self):
+        os.environ["DOCKER_HOST"] = f"unix://{TMP_PATH/'missing.sock'}"
+        self.assertIsNone(docker_api.get_docker_client())
+
+    def test_tcp_host(self):
+        os.environ["DOCKER_HOST"] = "tcp://127.0.0.1:2375"
+        self.assertIsNone(docker_api.get_docker_client())
+
+def tearDownModule():
+    shutil.rmtree(TMP_PATH, ignore_errors=True)
+
+if __name__ == "__main__":
+    unittest.main()
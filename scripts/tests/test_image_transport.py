@@ -0,0 +1,185 @@
+"""
+Round trip of `ras <app> save` and `ras <app> load` against a fake docker CLI.
+
+The fake docker keeps its images in a JSON file, answers `image inspect`,
+`image ls`, `save`, `load` and `tag`, and checks that every layer it loads
+has the content of its diff id. Chunk and layer sizes are deliberately not
+aligned to tarfile's copy buffer.
+
+Run from the scripts directory:
+    python3 -m unittest discover tests
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+TMP_PATH = Path(tempfile.mkdtemp(prefix="ras_transport_test_"))
+os.environ["RAS_DOCKER_PATH"] = str(TMP_PATH/"ras")
+os.environ["RAS_DOCKER_CLI"] = "1"
+os.environ["PATH"] = f"{TMP_PATH/'bin'}{os.pathsep}{os.environ['PATH']}"
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+
+from ras_docker import image_transport
+
+FAKE_DOCKER = r'''#!{python}
+import hashlib, io, json, os, sys, tarfile
+STORE = os.environ["FAKE_DOCKER_STORE"]
+LAYER_SIZES = {{"L1": 3000017, "L2": 123457, "L3": 77777}}
+IMAGES = {{"ras_base:ras_local": ["L1", "L2"], "ras_robot_app:ras_local": ["L1", "L2", "L3"]}}
+
+def make_layer(name):
+    data = hashlib.sha256(name.encode()).digest() * (LAYER_SIZES[name] // 32 + 1)
+    out = io.BytesIO()
+    with tarfile.open(fileobj=out, mode="w") as tar:
+        info = tarfile.TarInfo(name)
+        info.size = LAYER_SIZES[name]
+        tar.addfile(info, io.BytesIO(data[:info.size]))
+    return out.getvalue()
+
+LAYERS = {{_name: make_layer(_name) for _name in LAYER_SIZES}}
+def diff_id(name): return "sha256:" + hashlib.sha256(LAYERS[name]).hexdigest()
+def config(ref): return json.dumps({{"rootfs": {{"diff_ids": [diff_id(_l) for _l in IMAGES[ref]]}}, "ref": ref}}).encode()
+def image_id(ref): return "sha256:" + hashlib.sha256(config(ref)).hexdigest()
+
+state = json.load(open(STORE)) if os.path.exists(STORE) else {{"images": [], "tags": {{}}}}
+def save_state(): json.dump(state, open(STORE, "w"))
+def resolve(ref):
+    for _ref in state["images"]:
+        if ref in (_ref, image_id(_ref)):
+            return _ref
+    return None
+
+args = sys.argv[1:]
+if args[:2] == ["image", "inspect"]:
+    ref = resolve(args[2])
+    if ref is None:
+        sys.exit(1)
+    print(json.dumps([{{"Id": image_id(ref), "RootFS": {{"Layers": [diff_id(_l) for _l in IMAGES[ref]]}}}}]))
+elif args[:2] == ["image", "ls"]:
+    for _ref in state["images"]:
+        print(image_id(_ref))
+elif args[0] == "save":
+    seen, manifest = {{}}, []
+    with tarfile.open(fileobj=sys.stdout.buffer, mode="w|") as out:
+        def add(name, data):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            out.addfile(info, io.BytesIO(data))
+        for _ref in args[1:]:
+            layers = []
+            for _layer in IMAGES[_ref]:
+                layer_dir = hashlib.sha256((_ref + _layer).encode()).hexdigest()
+                if _layer in seen:
+                    info = tarfile.TarInfo(f"{{layer_dir}}/layer.tar")
+                    info.type, info.linkname = tarfile.SYMTYPE, f"../{{seen[_layer]}}/layer.tar"
+                    out.addfile(info)
+                else:
+                    seen[_layer] = layer_dir
+                    add(f"{{layer_dir}}/layer.tar", LAYERS[_layer])
+                layers.append(f"{{layer_dir}}/layer.tar")
+            config_name = image_id(_ref).partition(":")[2] + ".json"
+            add(config_name, config(_ref))
+            manifest.append({{"Config": config_name, "RepoTags": [_ref], "Layers": layers}})
+        add("manifest.json", json.dumps(manifest).encode())
+elif args[0] == "load":
+    files = {{}}
+    with tarfile.open(fileobj=sys.stdin.buffer, mode="r|") as tar:
+        for _member in tar:
+            files[_member.name] = tar.extractfile(_member).read()
+    for _entry in json.loads(files["manifest.json"]):
+        ref = _entry["RepoTags"][0]
+        if files.get(_entry["Config"]) != config(ref):
+            sys.exit(f"bad config of {{ref}}")
+        for _path, _layer in zip(_entry["Layers"], IMAGES[ref]):
+            if (_path in files) and (files[_path] != LAYERS[_layer]):
+                sys.exit(f"bad layer {{_path}} of {{ref}}")
+        state["images"].append(ref)
+    save_state()
+elif args[0] == "tag":
+    state["tags"][args[2]] = args[1]
+    save_state()
+else:
+    sys.exit(f"unsupported: {{args}}")
+'''
+
+class ImageTransportRoundTrip(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        if shutil.which("zstd") is None:
+            raise unittest.SkipTest("zstd is not installed")
+        bin_path = TMP_PATH/"bin"
+        bin_path.mkdir(parents=True, exist_ok=True)
+        (bin_path/"docker").write_text(FAKE_DOCKER.format(python=sys.executable))
+        (bin_path/"docker").chmod(0o755)
+        cls.refs = ["ras_base:ras_local", "ras_robot_app:ras_local"]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(TMP_PATH, ignore_errors=True)
+
+    def setUp(self):
+        self.chunk_size = image_transport.TRANSPORT_CHUNK_SIZE
+        # not a multiple of the 16 KiB tarfile copy buffer, so reads cross chunk boundaries
+        image_transport.TRANSPORT_CHUNK_SIZE = 100003
+        self.source_store = TMP_PATH/"source.json"
+        self.target_store = TMP_PATH/"target.json"
+        self.source_store.write_text(json.dumps({"images": self.refs, "tags": {}}))
+        self.target_store.unlink(missing_ok=True)
+        self.archive_path = TMP_PATH/"archive"
+        shutil.rmtree(self.archive_path, ignore_errors=True)
+        shutil.rmtree(TMP_PATH/"ras", ignore_errors=True)
+
+    def tearDown(self):
+        image_transport.TRANSPORT_CHUNK_SIZE = self.chunk_size
+
+    def use_store(self, store: Path):
+        os.environ["FAKE_DOCKER_STORE"] = str(store)
+
+    def test_save_load(self):
+        self.use_store(self.source_store)
+        self.assertTrue(image_transport.save_images(self.refs, self.archive_path))
+        manifest = image_transport.read_manifest(self.archive_path)
+        chunk_sizes = {_size for _entry in manifest["files"].values() for _, _size in _entry.get("chunks", [])}
+        self.assertIn(100003, chunk_sizes)
+
+        self.use_store(self.target_store)
+        self.assertTrue(image_transport.load_images(self.archive_path))
+        target = json.loads(self.target_store.read_text())
+        self.assertEqual(target["images"], self.refs)
+        # loading again finds everything in place
+        self.assertTrue(image_transport.load_images(self.archive_path))
+        self.assertEqual(json.loads(self.target_store.read_text())["images"], self.refs)
+
+    def test_skip_layers_the_target_has(self):
+        self.use_store(self.target_store)
+        self.target_store.write_text(json.dumps({"images": self.refs[:1], "tags": {}}))
+        inventory_path = TMP_PATH/"inventory.json"
+        image_transport.write_inventory(inventory_path)
+
+        self.use_store(self.source_store)
+        skip_chain_ids = image_transport.read_inventory(inventory_path)
+        self.assertTrue(image_transport.save_images(self.refs, self.archive_path, skip_chain_ids))
+        manifest = image_transport.read_manifest(self.archive_path)
+        self.assertEqual(sum("skipped" in _entry for _entry in manifest["files"].values()), 2)
+
+        self.use_store(self.target_store)
+        self.assertTrue(image_transport.load_images(self.archive_path))
+        self.assertEqual(json.loads(self.target_store.read_text())["images"], self.refs)
+
+    def test_damaged_chunk(self):
+        self.use_store(self.source_store)
+        self.assertTrue(image_transport.save_images(self.refs, self.archive_path))
+        chunk_path = sorted((self.archive_path/"chunks").iterdir())[0]
+        chunk_path.write_bytes(chunk_path.read_bytes()[:-1])
+
+        self.use_store(self.target_store)
+        self.assertFalse(image_transport.load_images(self.archive_path))
+        self.assertFalse(self.target_store.exists())
+
+if __name__ == "__main__":
+    unittest.main()